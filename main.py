@@ -5,6 +5,8 @@ import yaml
 
 from tpau_gtfsutilities.config.utilityconfig import utilityconfig
 from tpau_gtfsutilities.config.utilityoutput import utilityoutput
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
+from tpau_gtfsutilities.config.utilitycache import utilitycache
 from tpau_gtfsutilities.utilities.utility_manager import UtilityManager
 
 def run():
@@ -17,12 +19,24 @@ def run():
     output_help = 'Output directory (defaults to output/)'
     config_help = 'Yaml config file. If not provided, it will look for a matching file in the configs/ directory (i.e. one_day.yaml)'
     continue_on_error_help = 'Continue on error. If a common error is thrown before all feeds have been processed, utilities will proceed with the rest of the feeds. Mostly useful for testing.'
+    profile_help = 'Write profile.json to the output directory, with wall time, rows in/out and peak memory of each stage (loading tables, filters, analyses etc.) for each feed.'
+    zip_level_help = 'Compression level (0-9) of output feeds. Lower is faster but makes larger zips (defaults to zlib default).'
+    write_threads_help = 'Number of tables to write at once when writing output feeds, each in memory (defaults to 1).'
+    no_cache_help = 'Always read feeds from their zips. Otherwise feeds are cached (in ~/.cache/tpau_gtfsutilities or the cache_dir set in the config, up to 2GB) as their tables are first read and preprocessed, so later runs on the same zip load faster. Requires pyarrow.'
+    memory_budget_help = 'Memory (in MB) to process stop_times in, for feeds too large to load. stop_times is read from the zip in chunks of whole trips that fit, instead of loaded (other tables still are). Supported by one_day, stop_visits and interpolate_stoptimes, and stop_times is not cached.'
+    jobs_help = 'Number of feeds to process at once, each in its own process (defaults to 1). Reports are the same as when processing feeds one at a time.'
 
     parser.add_argument('-u', '--utility', help=utility_help, required=True, choices=valid_utilities, nargs='?')
     parser.add_argument('-i', '--input-dir', help=input_help, required=False, nargs='?')
     parser.add_argument('-c', '--config', help=config_help, required=False, nargs='?')
     parser.add_argument('-o', '--output-dir', help=output_help, required=False, nargs='?')
     parser.add_argument('-e', '--continue-on-error', help=continue_on_error_help, action='store_true')
+    parser.add_argument('-p', '--profile', help=profile_help, action='store_true')
+    parser.add_argument('-j', '--jobs', help=jobs_help, required=False, type=int, default=1)
+    parser.add_argument('-z', '--zip-level', help=zip_level_help, required=False, type=int, choices=range(10))
+    parser.add_argument('-w', '--write-threads', help=write_threads_help, required=False, type=int, default=1)
+    parser.add_argument('--no-cache', help=no_cache_help, action='store_true')
+    parser.add_argument('-m', '--memory-budget', help=memory_budget_help, required=False, type=float)
     
     args = parser.parse_args()
     utility = args.utility
@@ -30,6 +44,12 @@ def run():
     output_dir = args.output_dir
     config = args.config
     continue_on_error = args.continue_on_error
+    jobs = args.jobs
+    profile = args.profile
+    zip_level = args.zip_level
+    write_threads = args.write_threads
+    no_cache = args.no_cache
+    memory_budget = args.memory_budget
 
     utilityconfig.set_utility(utility)
     if input_dir:
@@ -39,10 +59,21 @@ def run():
     if output_dir:
         utilityoutput.set_parent_output_dir(output_dir)
 
+    if profile:
+        utilityprofile.enable()
+
+    if no_cache:
+        utilitycache.disable()
+
+    if memory_budget:
+        utilityconfig.set_memory_budget(memory_budget)
+
+    utilityoutput.set_zip_options(compression_level=zip_level, write_threads=write_threads)
+
     utilityoutput.initialize_utility(utility)
 
     utilityrunner = utilitymanager.get_utility(utility)
-    utilityrunner.run(continue_on_error=continue_on_error)
+    utilityrunner.run(continue_on_error=continue_on_error, jobs=jobs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+import os
+import random
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+# Compares the output of utilities that support a memory budget (-m) when stop_times is loaded
+# and when it is read in chunks, for a feed with stop_times grouped by trip and one without
+# (which is split into partition files first). A budget of 0.05MB makes chunks of a few trips
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MEMORY_BUDGET = '0.05'
+
+CONFIGS = {
+    'one_day': [
+        'gtfs_feeds:',
+        '  - feed.zip',
+        'date_range:',
+        "  start: '20201102'",
+        "  end: '20201104'",
+        'time_range:',
+        "  start: '06:00:00'",
+        "  end: '16:00:00'",
+    ],
+    'stop_visits': [
+        'gtfs_feeds:',
+        '  - feed.zip',
+        'polygon:',
+        'date_range:',
+        "  start: '20201102'",
+        "  end: '20201108'",
+        'time_range:',
+        "  start: '06:00:00'",
+        "  end: '16:10:00'",
+    ],
+    'interpolate_stoptimes': [
+        'gtfs_feeds:',
+        '  - feed.zip',
+    ],
+}
+
+def to_time(seconds):
+    return '%02d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def get_feed_tables(num_stops=30, stops_per_trip=8):
+    # returns dict of tablename: rows (header first) of a small feed with regular and frequency
+    # trips on several services, stop times only at some stops, and quoted values. The stop_visits
+    # time range ends partway through a frequency trip, so stop times are added for its partial trip
+    tables = {
+        'agency': [
+            ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+            ['A1', '"Test Agency"', 'http://example.com', 'America/Los_Angeles'],
+        ],
+        'stops': [['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'parent_station']],
+        'routes': [
+            ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'],
+            ['R1', 'A1', '1', '"Main, St"', 3],
+            ['R2', 'A1', '2', 'Rail', 2],
+            ['R3', 'A1', '3', 'Tram', 0],
+        ],
+        'trips': [['route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id']],
+        'stop_times': [['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'shape_dist_traveled']],
+        'shapes': [['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence', 'shape_dist_traveled']],
+        'frequencies': [
+            ['trip_id', 'start_time', 'end_time', 'headway_secs'],
+            ['F1', '06:00:00', '10:00:00', 900],
+            ['F1', '15:00:00', '18:00:00', 1200],
+        ],
+        'calendar': [
+            ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'],
+            ['WK', 1, 1, 1, 1, 1, 0, 0, 20201001, 20201231],
+            ['SA', 0, 0, 0, 0, 0, 1, 0, 20201001, 20201231],
+            ['ALL', 1, 1, 1, 1, 1, 1, 1, 20201101, 20201130],
+        ],
+        'calendar_dates': [
+            ['service_id', 'date', 'exception_type'],
+            ['WK', '20201103', 2],
+            ['EX', '20201103', 1],
+        ],
+    }
+
+    for i in range(num_stops):
+        parent_station = 'S0' if i in (1, 2) else ''
+        tables['stops'].append(['S' + str(i), '"Stop ' + str(i) + '"', 45.5 + 0.001 * i, -122.6 + 0.0007 * (i % 7), parent_station])
+
+    for shape_id in ['SH1', 'SH2']:
+        for i in range(5):
+            tables['shapes'].append([shape_id, 45.5 + 0.01 * i, -122.6, i + 1, 1000 * i])
+
+    trip_number = 0
+    for route_id, service_id in [('R1', 'WK'), ('R1', 'SA'), ('R2', 'WK'), ('R3', 'ALL'), ('R1', 'EX')]:
+        for direction_id in [0, 1]:
+            for i in range(6):
+                trip_id = 'T' + str(trip_number)
+                start = 5 * 3600 + i * 2700 + direction_id * 600 + (trip_number % 3) * 60
+                first_stop = (trip_number * 3) % (num_stops - stops_per_trip)
+                trip_number += 1
+                tables['trips'].append([route_id, service_id, trip_id, direction_id, 'SH' + str(direction_id + 1)])
+
+                for j in range(stops_per_trip):
+                    # only some stops are timepoints, so there are times to interpolate
+                    timepoint = j == 0 or j == stops_per_trip - 1 or j % 3 == 0
+                    arrival = to_time(start + j * 240) if timepoint else ''
+                    departure = to_time(start + j * 240 + 30) if timepoint else ''
+                    tables['stop_times'].append([trip_id, arrival, departure, 'S' + str(first_stop + j), j + 1, j * 500.0])
+
+    tables['trips'].append(['R2', 'WK', 'F1', 0, 'SH1'])
+    for j in range(5):
+        tables['stop_times'].append(['F1', to_time(6 * 3600 + j * 300), to_time(6 * 3600 + j * 300), 'S' + str(j), j + 1, j * 500.0])
+
+    return tables
+
+def write_feed(path, grouped=True):
+    # writes feed zip to path, with stop_times rows shuffled (so not grouped by trip) if not grouped
+    tables = get_feed_tables()
+    if not grouped:
+        rows = tables['stop_times'][1:]
+        random.Random(1).shuffle(rows)
+        tables['stop_times'] = tables['stop_times'][:1] + rows
+
+    with zipfile.ZipFile(path, 'w') as feed:
+        for tablename, rows in tables.items():
+            feed.writestr(tablename + '.txt', '\n'.join(','.join(str(value) for value in row) for row in rows) + '\n')
+
+def run_utility(utility, input_dir, config_path, output_dir, memory_budget=None):
+    os.makedirs(output_dir)
+    command = [sys.executable, 'main.py', '-u', utility, '-i', str(input_dir), '-c', str(config_path), \
+        '-o', str(output_dir), '--no-cache']
+    if memory_budget is not None:
+        command += ['-m', memory_budget]
+
+    result = subprocess.run(command, cwd=REPO_DIR, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+def get_outputs(output_dir):
+    # returns dict of path (relative to output_dir): bytes, of each report and output feed table
+    outputs = {}
+    for parent, dirs, files in os.walk(output_dir):
+        for filename in files:
+            path = os.path.join(parent, filename)
+            name = os.path.relpath(path, output_dir)
+            if filename.endswith('.csv'):
+                with open(path, 'rb') as file:
+                    outputs[name] = file.read()
+            elif filename.endswith('.zip'):
+                with zipfile.ZipFile(path) as feed:
+                    for member in feed.namelist():
+                        outputs[name + ':' + member] = feed.read(member)
+    return outputs
+
+def get_sorted_rows(contents):
+    # header, then the other rows sorted
+    lines = contents.decode('utf-8').splitlines()
+    return lines[:1] + sorted(lines[1:])
+
+@pytest.mark.parametrize('grouped', [True, False], ids=['grouped', 'ungrouped'])
+@pytest.mark.parametrize('utility', sorted(CONFIGS.keys()))
+def test_memory_budget_output_matches(tmp_path, utility, grouped):
+    input_dir = tmp_path / 'data'
+    input_dir.mkdir()
+    write_feed(input_dir / 'feed.zip', grouped=grouped)
+    config_path = tmp_path / (utility + '.yaml')
+    config_path.write_text('\n'.join(CONFIGS[utility]) + '\n')
+
+    run_utility(utility, input_dir, config_path, tmp_path / 'loaded')
+    run_utility(utility, input_dir, config_path, tmp_path / 'chunked', memory_budget=MEMORY_BUDGET)
+
+    loaded = get_outputs(tmp_path / 'loaded')
+    chunked = get_outputs(tmp_path / 'chunked')
+    assert len(loaded)
+    assert sorted(loaded.keys()) == sorted(chunked.keys())
+
+    for name in loaded.keys():
+        # stop_times not grouped by trip is written a partition at a time, so only its rows match
+        if grouped:
+            assert loaded[name] == chunked[name], name
+        else:
+            assert get_sorted_rows(loaded[name]) == get_sorted_rows(chunked[name]), name
@@ -1,3 +1,6 @@
+# keep in sync with setup.py (cached feeds are keyed by it)
+__version__ = '0.0'
+
 from . import gtfs
 from . import utilities
 from . import config
\ No newline at end of file
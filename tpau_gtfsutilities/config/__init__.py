@@ -1,2 +1,3 @@
 from . import utilityconfig
-from . import utilityoutput
\ No newline at end of file
+from . import utilityoutput
+from . import utilityprofile
\ No newline at end of file
@@ -0,0 +1,251 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+
+from tpau_gtfsutilities import __version__
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    # caching is skipped without pyarrow, and feeds are always read from their zips
+    pyarrow = None
+    pq = None
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# source files (or directories of them) that decide what cached tables hold: table definitions
+# (dtypes, index, time and categorical columns), how tables are read, preprocessed and rebuilt
+# from the cache, and the cache's own layout. Entries are keyed by a hash of them (see get_code_hash),
+# so changing any of them makes feeds be read from their zips again
+CACHED_CODE_PATHS = [
+    'gtfs/tables',
+    'gtfs/properties.py',
+    'gtfs/gtfs.py',
+    'gtfs/gtfsreader.py',
+    'gtfs/process/preprocess.py',
+    'helpers/datetimecolumns.py',
+    'config/utilitycache.py',
+]
+
+INFO_EXTENSION = '.json'
+HASH_CHUNK_BYTES = 1024 * 1024
+
+class _UtilityCache:
+    # on-disk cache of feeds' tables after loading and preprocessing, so later runs on the
+    # same zip read typed parquet files instead of parsing csv. Entries are keyed by the zip's
+    # contents and the code and library versions, and the least recently used are removed once the
+    # cache is larger than max_bytes. Kept in a per-user directory unless cache_dir is set
+    # (see get_default_cache_dir). Disabled with --no-cache
+    enabled = True
+    cache_dir = None
+    max_bytes = 2 * 1024 * 1024 * 1024
+    code_hash = None
+
+    def disable(self):
+        self.enabled = False
+
+    def is_available(self):
+        return self.enabled and pq is not None
+
+    def set_cache_dir(self, dir):
+        self.cache_dir = dir
+
+    def get_cache_dir(self):
+        dir = self.cache_dir if self.cache_dir else get_default_cache_dir()
+        return dir
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+
+    def get_feed_key(self, filepath):
+        # hash of the zip's contents and the versions (of libraries and code) that tables are read/typed with
+        hasher = hashlib.sha256()
+        with open(filepath, 'rb') as zip_file:
+            for chunk in iter(lambda: zip_file.read(HASH_CHUNK_BYTES), b''):
+                hasher.update(chunk)
+        hasher.update(self.get_versions().encode())
+        return hasher.hexdigest()
+
+    def get_code_hash(self):
+        # hash of the source files in CACHED_CODE_PATHS, computed once
+        if self.code_hash is None:
+            hasher = hashlib.sha256()
+            for path in get_source_files(CACHED_CODE_PATHS):
+                hasher.update(os.path.relpath(path, PACKAGE_DIR).replace(os.sep, '/').encode())
+                with open(path, 'rb') as source_file:
+                    hasher.update(source_file.read())
+            self.code_hash = hasher.hexdigest()
+        return self.code_hash
+
+    def get_versions(self):
+        return ' '.join([
+            'tpau_gtfsutilities=' + __version__,
+            'code=' + self.get_code_hash(),
+            'pandas=' + pd.__version__,
+            'pyarrow=' + (pyarrow.__version__ if pyarrow else ''),
+        ])
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.get_cache_dir(), key)
+
+    def get_feed_entry(self, filepath):
+        # returns FeedCacheEntry of the feed's zip at filepath, marked as recently used
+        key = self.get_feed_key(filepath)
+        entry_dir = self.get_entry_dir(key)
+        if os.path.isdir(entry_dir):
+            os.utime(entry_dir)
+        return FeedCacheEntry(self, key)
+
+    def evict(self, keep=None):
+        # removes least recently used entries (other than keep) until the cache is within max_bytes
+        cache_dir = self.get_cache_dir()
+        entries = []
+        for key in os.listdir(cache_dir):
+            entry_dir = os.path.join(cache_dir, key)
+            if not os.path.isdir(entry_dir):
+                continue
+            entries.append((os.path.getmtime(entry_dir), key, get_dir_bytes(entry_dir)))
+
+        total_bytes = sum([entry_bytes for _, _, entry_bytes in entries])
+        for _, key, entry_bytes in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+            total_bytes -= entry_bytes
+
+    def get_state(self):
+        # cache settings set on this instance, to be restored in worker processes
+        return dict(vars(self))
+
+    def set_state(self, state):
+        vars(self).update(state)
+
+def get_source_files(paths):
+    # python files at paths (relative to the package), including those in directories, in a stable order
+    files = []
+    for path in paths:
+        path = os.path.join(PACKAGE_DIR, *path.split('/'))
+        if os.path.isdir(path):
+            files.extend(sorted([os.path.join(path, filename) for filename in os.listdir(path) if filename.endswith('.py')]))
+        else:
+            files.append(path)
+    return files
+
+def get_default_cache_dir():
+    # per-user cache directory, so runs from any directory share it without writing into
+    # the working directory: %LOCALAPPDATA% on windows, otherwise $XDG_CACHE_HOME or ~/.cache
+    base_dir = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else os.environ.get('XDG_CACHE_HOME')
+    if not base_dir:
+        base_dir = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base_dir, 'tpau_gtfsutilities')
+
+class FeedCacheEntry:
+    # cached tables of a feed (see _UtilityCache.get_feed_entry), in a directory named by its key.
+    # Each table is stored once it has been read and preprocessed (see GTFS.load_table), so an
+    # entry has the tables runs on the feed have used. A table's files are written under temporary
+    # names and moved into place, and its info file last, so a partly written table is never read
+    # (i.e. by another run on the same feed)
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.entry_dir = cache.get_entry_dir(key)
+
+    def get_info_path(self, tablename):
+        return os.path.join(self.entry_dir, tablename + INFO_EXTENSION)
+
+    def read_table(self, tablename):
+        # returns dict of dtype, columns and read, a function returning (df, original_df) with only
+        # some columns if provided (see GTFS.read_cached_table), or None if the table isn't cached.
+        # The table is read when read is called
+        info_path = self.get_info_path(tablename)
+        if not os.path.exists(info_path):
+            return None
+
+        try:
+            with open(info_path) as info_file:
+                table_info = json.load(info_file)
+
+            for filename in [table_info['file'], table_info['original_file']]:
+                if filename and not os.path.exists(os.path.join(self.entry_dir, filename)):
+                    raise FileNotFoundError(filename)
+        # incomplete or unreadable tables are read from the zip again, and replaced
+        except (OSError, ValueError, KeyError) as e:
+            print("WARNING: could not read cached " + tablename + ", reading zip instead: ", e)
+            os.remove(info_path)
+            return None
+
+        return {
+            'dtype': table_info['dtype'],
+            'columns': table_info['columns'],
+            'read': lambda columns=None: read_table_files(self.entry_dir, table_info, columns),
+        }
+
+    def store_table(self, tablename, table):
+        # table: dict of df, original_df, dtype and columns
+        if os.path.exists(self.get_info_path(tablename)):
+            return
+        os.makedirs(self.entry_dir, exist_ok=True)
+        temp_suffix = '.' + str(os.getpid()) + '.tmp'
+
+        try:
+            filename = tablename + '.parquet'
+            write_parquet(table['df'], os.path.join(self.entry_dir, filename + temp_suffix))
+            os.replace(os.path.join(self.entry_dir, filename + temp_suffix), os.path.join(self.entry_dir, filename))
+
+            # original only stored if it differs (i.e. changed by preprocessing)
+            original_filename = None
+            if table['original_df'] is not table['df']:
+                original_filename = tablename + '.original.parquet'
+                write_parquet(table['original_df'], os.path.join(self.entry_dir, original_filename + temp_suffix))
+                os.replace(os.path.join(self.entry_dir, original_filename + temp_suffix), os.path.join(self.entry_dir, original_filename))
+
+            table_info = {
+                'versions': self.cache.get_versions(),
+                'file': filename,
+                'original_file': original_filename,
+                'dtype': table['dtype'],
+                'columns': table['columns'],
+            }
+            info_path = self.get_info_path(tablename)
+            with open(info_path + temp_suffix, 'w') as info_file:
+                json.dump(table_info, info_file, indent=4)
+            os.replace(info_path + temp_suffix, info_path)
+        except (OSError, ValueError, TypeError, pyarrow.ArrowException) as e:
+            # caching is best effort, the table has already been loaded
+            print("WARNING: could not cache " + tablename + ": ", e)
+        finally:
+            for filename in os.listdir(self.entry_dir):
+                if filename.endswith(temp_suffix):
+                    os.remove(os.path.join(self.entry_dir, filename))
+
+        self.cache.evict(keep=self.key)
+
+def write_parquet(df, path):
+    # index (i.e. trip_id) and dtypes (categories, nullable integer times) are kept in
+    # the file's pandas metadata, so tables read back exactly as they were
+    pq.write_table(pyarrow.Table.from_pandas(df, preserve_index=True), path)
+
+def read_parquet(path, columns=None):
+    # memory mapped, so the file is read without copying it through a buffer first.
+    # Only columns (and the index) are read if provided
+    if columns is not None:
+        index_columns = pq.read_schema(path).pandas_metadata['index_columns']
+        columns = [col for col in columns if col not in index_columns]
+    return pq.read_table(path, columns=columns, use_pandas_metadata=True, memory_map=True).to_pandas()
+
+def read_table_files(entry_dir, table_info, columns=None):
+    # returns (df, original_df) of a cached table (the same df if the original wasn't changed)
+    df = read_parquet(os.path.join(entry_dir, table_info['file']), columns=columns)
+    if not table_info['original_file']:
+        return df, df
+    return df, read_parquet(os.path.join(entry_dir, table_info['original_file']), columns=columns)
+
+def get_dir_bytes(dir):
+    return sum([os.path.getsize(os.path.join(dir, filename)) for filename in os.listdir(dir)])
+
+utilitycache = _UtilityCache()
@@ -9,6 +9,7 @@ class _UtilityConfig:
     config_file = None
     input_dir = None
     settings = None
+    memory_budget_mb = None # if set, large tables are read in chunks that fit (see ChunkedTable)
 
     def set_utility(self, utility):
         # utiltiy is one of:
@@ -35,6 +36,12 @@ class _UtilityConfig:
         dir = self.input_dir if self.input_dir else default_input_dir
         return dir
     
+    def set_memory_budget(self, memory_budget_mb):
+        self.memory_budget_mb = memory_budget_mb
+
+    def get_memory_budget(self):
+        return self.memory_budget_mb
+
     def get_input_file_path(self, file):
         return os.path.join(self.get_input_dir(), file)
     
@@ -55,4 +62,11 @@ class _UtilityConfig:
     def get_current_time_range(self):
         return self.current_time_range
 
+    def get_state(self):
+        # configuration set on this instance, to be restored in worker processes
+        return dict(vars(self))
+
+    def set_state(self, state):
+        vars(self).update(state)
+
 utilityconfig = _UtilityConfig()
\ No newline at end of file
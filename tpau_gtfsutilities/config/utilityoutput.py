@@ -1,12 +1,23 @@
+import io
 import os
+import json
+import shutil
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# rows written to csv at a time when writing feeds
+CSV_CHUNK_ROWS = 100000
+
 class _UtilityOutput:
     utility = None
     dir_index = 0
     parent_output_dir = None
     _feedname = None
+    _staging_dir = None # set in worker processes when running feeds in parallel
+    zip_compression_level = None
+    zip_write_threads = 1
 
     def initialize_utility(self, utility):
         # utiltiy is one of:
@@ -35,15 +46,61 @@ class _UtilityOutput:
         dirname = self.utility + '_' + str(self.dir_index) if self.dir_index > 0 else self.utility
         return os.path.join(self.get_parent_output_dir(), dirname)
     
+    def get_output_root(self):
+        # utility output dir, or the job's staging dir if running in a worker process
+        return self._staging_dir if self._staging_dir else self.get_utility_output_dir()
+
     def get_output_dir(self):
         if self._feedname:
-            out_dir = os.path.join(self.get_utility_output_dir(), self._feedname)
+            out_dir = os.path.join(self.get_output_root(), self._feedname)
         else:
-            out_dir = self.get_utility_output_dir()
+            out_dir = self.get_output_root()
         if not (os.path.exists(out_dir)):
-            os.mkdir(out_dir)
+            os.makedirs(out_dir)
         return out_dir
 
+    def get_staging_dir(self, job):
+        # output dir for a single job (feed) when running feeds in parallel
+        return os.path.join(self.get_utility_output_dir(), '.jobs', str(job))
+
+    def set_staging_dir(self, dir):
+        self._staging_dir = dir
+
+    def merge_staged_output(self, staging_dir):
+        # moves output written by a job to the utility output dir. csvs that already
+        # exist are appended to (without the staged header), so merging jobs in feed order
+        # gives the same output as running feeds one after another
+
+        for root, dirs, files in os.walk(staging_dir):
+            out_dir = os.path.join(self.get_utility_output_dir(), os.path.relpath(root, staging_dir))
+            if not (os.path.exists(out_dir)):
+                os.makedirs(out_dir)
+
+            for file in sorted(files):
+                staged_file = os.path.join(root, file)
+                out_file = os.path.join(out_dir, file)
+
+                if file.endswith('.csv') and os.path.exists(out_file):
+                    with open(staged_file, 'rb') as staged, open(out_file, 'ab') as out:
+                        staged.readline() # header
+                        shutil.copyfileobj(staged, out)
+                else:
+                    shutil.move(staged_file, out_file)
+
+        shutil.rmtree(staging_dir)
+
+    def remove_staging_dirs(self):
+        jobs_dir = os.path.join(self.get_utility_output_dir(), '.jobs')
+        if os.path.exists(jobs_dir):
+            shutil.rmtree(jobs_dir)
+
+    def get_state(self):
+        # output settings set on this instance, to be restored in worker processes
+        return dict(vars(self))
+
+    def set_state(self, state):
+        vars(self).update(state)
+
     def write_metadata(self, settings):
         filename = 'metadata.txt'
         f = open(os.path.join(self.get_utility_output_dir(), filename), 'a')
@@ -55,6 +112,12 @@ class _UtilityOutput:
             text = setting + ': ' + value + '\n'
             f.write(text)
 
+    def write_profile(self, profile):
+        # profile: dict of stage timings etc., see utilityprofile
+        filename = 'profile.json'
+        with open(os.path.join(self.get_utility_output_dir(), filename), 'w') as f:
+            json.dump(profile, f, indent=2)
+
     def write_or_append_to_output_csv(self, df, filename, index=False, write_gtfs_filename=False):
         csvfile = os.path.join(self.get_output_dir(), filename)
         if write_gtfs_filename:
@@ -64,42 +127,69 @@ class _UtilityOutput:
         else:
             df.to_csv(csvfile, index=index)
         
-    def write_to_zip(self, df_dict, feedname):
-        # df_dict: dict of dataframess by tablename
-
-        feed_folder = os.path.join(self.get_output_dir(), feedname)
-
-        def write_txt_to_folder(tablename, df):
-            filename = tablename + '.txt'
-            df.to_csv(os.path.join(feed_folder, filename), index=False)
-
-        def write_feed_txts():
-            os.mkdir(feed_folder)
-            for table in df_dict:
-                write_txt_to_folder(table, df_dict[table])
-
-        def zip_feed():
-            zip_path = os.path.join(self.get_output_dir(), feedname + '.zip')
-            zip_writer = zipfile.ZipFile(zip_path, 'w')
-
-            for root, dirs, files in os.walk(feed_folder):
-                for file in files:
-                    zip_writer.write(os.path.join(root, file),os.path.basename(file), compress_type = zipfile.ZIP_DEFLATED)
-
-            zip_writer.close()
-
-        def cleanup():
-            for table in df_dict:
-                txt_file = os.path.join(feed_folder, table + '.txt')
-                if os.path.exists(txt_file):
-                    os.remove(txt_file)
-            try:
-                os.rmdir(feed_folder)
-            except (FileNotFoundError, OSError) as e:
-                print ("Error: could not clean up directory %s - %s." % (e.filename, e.strerror))
-
-        write_feed_txts()
-        zip_feed()
-        cleanup()
+    def set_zip_options(self, compression_level=None, write_threads=1):
+        # compression_level: zlib level (0-9) for output feeds, None for zlib's default
+        # write_threads: number of tables written at once, each to an in-memory buffer
+        self.zip_compression_level = compression_level
+        self.zip_write_threads = write_threads
+
+    def write_to_zip(self, tables, feedname):
+        # tables: dict of dataframes by tablename, or iterable of (tablename, dataframe) pairs
+        # (i.e. a generator, so tables don't all need to be held at once).
+        # Each table is written as csv straight into its zip entry, in chunks of rows.
+        # Instead of a dataframe, a table can be a function opening a binary stream of its csv
+        # (i.e. from the input zip), which is copied as is
+
+        if isinstance(tables, dict):
+            tables = tables.items()
+
+        zip_path = os.path.join(self.get_output_dir(), feedname + '.zip')
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=self.zip_compression_level) as zip_writer:
+            if self.zip_write_threads > 1:
+                self.write_tables_in_threads(zip_writer, tables)
+            else:
+                for tablename, table in tables:
+                    with zip_writer.open(tablename + '.txt', 'w', force_zip64=True) as entry:
+                        write_table(table, entry)
+
+    def write_tables_in_threads(self, zip_writer, tables):
+        # tables are written to in-memory csvs in threads, and added to the zip in order as they
+        # finish. At most zip_write_threads tables (and their csvs) are held at a time
+
+        with ThreadPoolExecutor(max_workers=self.zip_write_threads) as executor:
+            pending = deque()
+
+            def add_oldest_to_zip():
+                tablename, written = pending.popleft()
+                zip_writer.writestr(tablename + '.txt', written.result())
+
+            for tablename, table in tables:
+                pending.append((tablename, executor.submit(get_table_bytes, table)))
+                if len(pending) >= self.zip_write_threads:
+                    add_oldest_to_zip()
+
+            while pending:
+                add_oldest_to_zip()
+
+def write_csv(df, binary_file):
+    # writes df as csv to an open binary file (i.e. a zip entry)
+    text_file = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+    df.to_csv(text_file, index=False, chunksize=CSV_CHUNK_ROWS)
+    text_file.flush()
+    # leave binary_file open for its owner to close
+    text_file.detach()
+
+def write_table(table, binary_file):
+    # writes a dataframe as csv, or copies a table's csv unchanged (see write_to_zip)
+    if callable(table):
+        with table() as csv:
+            shutil.copyfileobj(csv, binary_file)
+    else:
+        write_csv(table, binary_file)
+
+def get_table_bytes(table):
+    buffer = io.BytesIO()
+    write_table(table, buffer)
+    return buffer.getvalue()
 
 utilityoutput = _UtilityOutput()
\ No newline at end of file
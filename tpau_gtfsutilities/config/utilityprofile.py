@@ -0,0 +1,100 @@
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, where peak memory is not recorded
+    resource = None
+
+def get_peak_rss_mb():
+    # peak resident memory of this process so far, in MB
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on mac and kilobytes elsewhere
+    peak_rss_kb = peak_rss / 1024 if sys.platform == 'darwin' else peak_rss
+    return round(peak_rss_kb / 1024, 1)
+
+class _UtilityProfile:
+    # records wall time, rows in/out and peak memory of utility stages
+    # (i.e. loading tables, filters, analyses) when enabled with --profile
+    enabled = False
+    stages = []
+    _feedname = None
+    _depth = 0
+
+    def enable(self):
+        self.enabled = True
+        self.stages = []
+
+    def set_feedname(self, feedname):
+        self._feedname = feedname
+
+    @contextmanager
+    def stage(self, name, count_rows=None):
+        # times the enclosed block as a stage of the current feed.
+        # count_rows is an optional function returning the number of rows the stage
+        # works on, called before and after it runs for rows in/out. Otherwise rows_out
+        # can be set on the record yielded
+        if not self.enabled:
+            yield {}
+            return
+
+        record = {
+            'feed': self._feedname,
+            'stage': name,
+            'depth': self._depth,
+            'rows_in': count_rows() if count_rows else None,
+            'rows_out': None,
+        }
+        self._depth += 1
+        start = time.perf_counter()
+
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = round(time.perf_counter() - start, 6)
+            if count_rows:
+                record['rows_out'] = count_rows()
+            # peak is for the process so far, so it includes earlier stages
+            record['peak_rss_mb'] = get_peak_rss_mb()
+            self._depth -= 1
+            self.stages.append(record)
+
+    def profiled(self, name):
+        # decorator recording each call of a function as a stage, with rows out
+        # as the length of what it returns (i.e. a report dataframe)
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name) as record:
+                    result = func(*args, **kwargs)
+                    if hasattr(result, '__len__'):
+                        record['rows_out'] = len(result)
+                return result
+            return wrapper
+        return decorator
+
+    def add_stages(self, stages):
+        # adds stages recorded elsewhere (i.e. in a worker process)
+        self.stages.extend(stages)
+
+    def get_profile(self, utility):
+        return {
+            'utility': utility,
+            'peak_rss_mb': get_peak_rss_mb(),
+            'stages': self.stages,
+        }
+
+    def get_state(self):
+        # profile settings set on this instance, to be restored in worker processes
+        return { 'enabled': self.enabled }
+
+    def set_state(self, state):
+        vars(self).update(state)
+        self.stages = []
+
+utilityprofile = _UtilityProfile()
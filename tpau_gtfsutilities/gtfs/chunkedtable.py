@@ -0,0 +1,374 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
+from .properties import GTFS_ENCODING
+from .tables.gtfstable import _versions
+
+# rough working memory of a row while a chunk is processed (parsed values,
+# intermediate arrays, merges and its csv), used to size chunks to a memory budget
+CHUNK_ROW_BYTES = 2000
+
+def get_chunk_rows(memory_budget_mb):
+    # rows per chunk that fit in memory_budget_mb
+    return max(int(memory_budget_mb * 1024 * 1024 / CHUNK_ROW_BYTES), 1)
+
+def is_in_index(values, index):
+    # returns boolean array of whether each of values is in index (a unique pd.Index), or missing.
+    # Categorical values are looked up by category
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        found = np.append(index.get_indexer(values.cat.categories) >= 0, True)
+        return found[codes]
+    return np.asarray(pd.isna(values)) | (index.get_indexer(values) >= 0)
+
+class ChunkedTable:
+    # A table too large to load (i.e. stop_times of a large feed), read from the feed's zip
+    # in chunks of about chunk_rows rows, each with whole trips (all rows of each value of key).
+    # Changes aren't made to the table itself: filters add transforms, and cascades add
+    # references it is pruned by, which are applied to each chunk as it is read (see get_chunk_pairs).
+    # If rows aren't grouped by key in the feed, they are first split into partition files
+    # of whole trips in a temporary directory (under TMPDIR if set)
+
+    def __init__(self, feed, gtfsreader, tablename, table_class, dtype, chunk_rows, key='trip_id'):
+        # feed: GTFS the table is in, whose tables it is pruned by
+        # dtype: dict of column: dtype to read columns with (see get_dtypes_dict)
+        self._feed = feed
+        self._gtfsreader = gtfsreader
+        self.tablename = tablename
+        self.table_class = table_class
+        self.dtype = dtype
+        self.chunk_rows = chunk_rows
+        self.key = key
+
+        self.index = table_class.index
+        self.columns = list(gtfsreader.contents[tablename])
+        self.downstream_columns = table_class.downstream_columns
+        self.upstream_columns = table_class.upstream_columns
+
+        # functions of a chunk returning it changed, applied in order (see add_transform)
+        self.transforms = []
+        # references (sources, ColumnRef) to this table, whose sources' values rows must be found in
+        self.pruned_by = []
+        # function of a chunk returning it preprocessed, once the feed has been (see GTFS.preprocess)
+        self.preprocess = None
+        # tables this table references that haven't been pruned by its changes yet
+        # (see GTFS.sync_chunked_tables)
+        self.unsynced = set()
+
+        self._dir = None
+        self._partitions = None # partition files, if rows aren't grouped by key
+        self._original_keys = None # distinct values of key in the feed
+        self._keys = {} # distinct values by column, with the version they were read in (see get_keys)
+        self._rows = None # number of rows, with the version they were read in (see get_rows)
+
+        self.version = next(_versions)
+        self.original_version = next(_versions)
+
+    def get_columns(self, index=False):
+        if not index:
+            return [col for col in self.columns if col not in self.index]
+        return list(self.columns)
+
+    def get_version(self, original=False):
+        # current chunks also depend on the tables pruning them
+        if original:
+            return self.original_version
+
+        feed = self._feed
+        pruning_tables = sorted(set([source for sources, ref in self.pruned_by for source, col in sources]))
+        pruning_versions = tuple([feed.get_loaded_table(source).get_version() if feed.has_table(source, check_empty=False) else None \
+            for source in pruning_tables])
+        return (self.version, pruning_versions)
+
+    def add_transform(self, transform, cascade=True):
+        # transform: function of a chunk (of whole trips) returning a new df with any changes,
+        # without modifying it, applied to each chunk as it is read. If cascade, tables this table
+        # references are pruned by the changed chunks when they are next used, like GTFS.update_table
+        self.transforms.append(transform)
+        self.version = next(_versions)
+        if cascade:
+            self.set_unsynced()
+
+    def add_pruning_reference(self, sources, ref):
+        # rows are pruned by ref's sources (from a cascade) from now on, i.e. by trips after
+        # trips are filtered
+        if not any(pruning_sources == sources and pruning_ref.column == ref.column \
+            for pruning_sources, pruning_ref in self.pruned_by):
+            self.pruned_by.append((sources, ref))
+            self.version = next(_versions)
+        self.set_unsynced()
+
+    def set_unsynced(self):
+        references = self._feed.get_table_references()[self.tablename]
+        self.unsynced = set([ref.table for sources, ref in references \
+            if ref.cascade_row and ref.table != self.tablename])
+
+    def rows_changed(self):
+        # True if rows within trips may differ from the feed's, rather than only whole
+        # trips having been removed
+        return len(self.transforms) > 0 \
+            or any(ref.column != self.key for sources, ref in self.pruned_by)
+
+    def reset(self):
+        self.transforms = []
+        self.pruned_by = []
+        self.unsynced = set()
+        self._keys = {}
+        self._rows = None
+        self.version = next(_versions)
+
+    def get_rows(self):
+        # number of rows in the current chunks, or None if they haven't all been read
+        # since they last changed (see get_chunk_pairs)
+        if self._rows is not None and self._rows[0] == self.get_version():
+            return self._rows[1]
+        return None
+
+    def get_keys(self, column):
+        # distinct values of column in the current chunks
+        version = self.get_version()
+        if column in self._keys and self._keys[column][0] == version:
+            return self._keys[column][1]
+
+        if column == self.key and not self.rows_changed():
+            # only whole trips have been removed, so these are the feed's trips still referenced,
+            # found without reading the chunks again
+            keys = self.get_original_keys()
+            for sources, ref in self.pruned_by:
+                source_keys = self._feed.get_source_keys(sources)
+                if source_keys is not None:
+                    keys = keys[pd.Series(keys).isin(source_keys).to_numpy()]
+            self._keys[column] = (version, keys)
+            return keys
+
+        # reads the values of every reference column at once
+        for chunk in self.get_chunks_collecting_keys(columns=[]):
+            pass
+        return self._keys[column][1] if column in self._keys else None
+
+    def get_original_keys(self):
+        self.read_layout()
+        return self._original_keys
+
+    def get_reference_columns(self):
+        # columns that reference other tables (or are referenced)
+        return [col for col in self.get_columns(index=True) \
+            if col in self.downstream_columns.keys() or col in self.upstream_columns.keys()]
+
+    def get_chunk_pairs(self, columns=None):
+        # yields (original, current) chunks of whole trips, with only columns (and columns needed
+        # to prune them) if provided. Current chunks have preprocessing, transforms and pruning by
+        # other tables applied, original chunks are as in the feed
+
+        # pruned by values found when reading starts, indexed once so each chunk is only
+        # looked up in them rather than hashing them again
+        pruning = [(ref.column, self._feed.get_source_keys(sources)) for sources, ref in self.pruned_by]
+        pruning = [(col, pd.Index(keys).unique()) for col, keys in pruning if keys is not None]
+
+        # transforms may use any column
+        if columns is not None and not len(self.transforms):
+            columns = list(columns) + [col for col, keys in pruning]
+        else:
+            columns = None
+
+        version = self.get_version()
+        rows = 0
+        for original in self.read_chunks(columns=columns):
+            chunk = original
+            if self.preprocess is not None:
+                chunk = self.preprocess(chunk)
+            for transform in self.transforms:
+                chunk = self.clean_transformed(transform(chunk))
+
+            keep = np.ones(len(chunk), dtype=bool)
+            for col, keys in pruning:
+                keep &= is_in_index(chunk[col], keys)
+            if not keep.all():
+                chunk = chunk[keep]
+
+            rows += len(chunk)
+            yield original, chunk
+
+        # rows of the current chunks, once all have been read (see get_rows)
+        self._rows = (version, rows)
+
+    def get_chunks(self, columns=None, original=False):
+        # returns generator of current (or original) chunks (see get_chunk_pairs)
+        if original:
+            return self.read_chunks(columns=columns)
+        return (chunk for original_chunk, chunk in self.get_chunk_pairs(columns=columns))
+
+    def get_chunks_collecting_keys(self, columns=None):
+        # yields current chunks like get_chunks, and once all have been read stores the distinct
+        # values of each column the table references other tables by (see get_keys)
+        version = self.get_version()
+        key_columns = self.get_reference_columns()
+        values = { col: [np.array([], dtype=object)] for col in key_columns }
+
+        read_columns = list(columns) + key_columns if columns is not None else None
+        for chunk in self.get_chunks(columns=read_columns):
+            for col in key_columns:
+                values[col].append(np.asarray(chunk[col].dropna().unique(), dtype=object))
+            yield chunk
+
+        for col in key_columns:
+            self._keys[col] = (version, pd.unique(np.concatenate(values[col])))
+
+    def get_read_columns(self, columns=None):
+        # feed columns (in feed order) to read for columns, always including key
+        if columns is None:
+            return self.get_columns(index=True)
+        return [col for col in self.get_columns(index=True) if col in columns or col == self.key]
+
+    def read_chunks(self, columns=None):
+        # yields cleaned chunks of whole trips, as they are in the feed, with only columns if provided
+        read_columns = self.get_read_columns(columns)
+        dtype = { col: self.dtype[col] for col in read_columns }
+
+        for raw_chunk in self.read_raw_chunks(read_columns, dtype):
+            yield self.clean(raw_chunk, dtype)
+
+    def clean(self, raw_chunk, dtype):
+        return self.table_class(df=raw_chunk, dtype=dtype).df
+
+    def clean_transformed(self, chunk):
+        # returns transformed chunk cleaned like an updated table (see GTFSTable.update), with
+        # only the table's columns and their dtypes
+        columns = [col for col in self.get_columns(index=True) if col in chunk.columns]
+        return self.clean(chunk[columns], { col: self.dtype[col] for col in columns })
+
+    def read_raw_chunks(self, columns, dtype):
+        # yields chunks of whole trips as read from the csv, from the feed's zip if rows are grouped
+        # by key (in feed order), otherwise from partition files
+        self.read_layout()
+
+        if self._partitions is not None:
+            for path in self._partitions:
+                raw_chunk = pd.read_csv(path, dtype=dtype, usecols=columns, encoding=GTFS_ENCODING)
+                if len(raw_chunk):
+                    yield raw_chunk
+            return
+
+        carried = None
+        with self._gtfsreader.open_table(self.tablename) as csv:
+            for raw_chunk in pd.read_csv(csv, dtype=dtype, usecols=columns, encoding=GTFS_ENCODING, chunksize=self.chunk_rows):
+                if carried is not None:
+                    raw_chunk = pd.concat([carried, raw_chunk], ignore_index=True)
+                if not len(raw_chunk):
+                    continue
+
+                # rows of the last trip, which may continue in the next chunk, are carried over to it.
+                # Rows are grouped, so they follow the last row of any other trip
+                keys = raw_chunk[self.key]
+                last_key = keys.iloc[-1]
+                in_last_trip = keys.isna() if pd.isna(last_key) else keys == last_key
+                other_rows = np.flatnonzero(~in_last_trip.to_numpy())
+                split = other_rows[-1] + 1 if len(other_rows) else 0
+
+                carried = raw_chunk.iloc[split:]
+                if split:
+                    yield raw_chunk.iloc[:split].reset_index(drop=True)
+
+        if carried is not None and len(carried):
+            yield carried.reset_index(drop=True)
+
+    def read_layout(self):
+        # reads key values of all rows to find whether rows are grouped by key, otherwise
+        # splits the table into partition files of whole trips
+
+        if self._original_keys is not None:
+            return
+
+        with utilityprofile.stage('read_layout:' + self.tablename) as record:
+            keys = set()
+            rows = 0
+            grouped = True
+            previous = None
+
+            with self._gtfsreader.open_table(self.tablename) as csv:
+                for chunk in pd.read_csv(csv, dtype=str, usecols=[self.key], encoding=GTFS_ENCODING, \
+                    keep_default_na=False, chunksize=self.chunk_rows):
+
+                    values = chunk[self.key].to_numpy()
+                    if not len(values):
+                        continue
+                    rows += len(values)
+
+                    # first value of each run of the same key
+                    run_starts = values[np.r_[True, values[1:] != values[:-1]]]
+                    if run_starts[0] == previous:
+                        run_starts = run_starts[1:]
+                    previous = values[-1]
+
+                    if grouped and (len(set(run_starts)) < len(run_starts) or not keys.isdisjoint(run_starts)):
+                        grouped = False
+                    keys.update(run_starts)
+
+            record['rows_out'] = rows
+
+        if not grouped:
+            self.write_partitions(rows)
+
+        # blank keys are read as missing
+        keys.discard('')
+        self._original_keys = np.asarray(sorted(keys), dtype=object)
+
+    def write_partitions(self, rows):
+        # splits rows between partition files of about chunk_rows rows by a hash of key, so each
+        # has whole trips (in feed order). Chunks are read a partition at a time, so output feeds
+        # have the trips of each partition in turn rather than rows in feed order
+
+        with utilityprofile.stage('write_partitions:' + self.tablename, count_rows=lambda: rows):
+            num_partitions = max(int(np.ceil(rows / self.chunk_rows)), 1)
+            partitions = [os.path.join(self.get_dir(), 'partition_' + str(i) + '.csv') for i in range(num_partitions)]
+            files = [open(path, 'w', encoding='utf-8', newline='') for path in partitions]
+
+            try:
+                headers_written = np.zeros(num_partitions, dtype=bool)
+                with self._gtfsreader.open_table(self.tablename) as csv:
+                    # values are written back exactly as read
+                    for chunk in pd.read_csv(csv, dtype=str, encoding=GTFS_ENCODING, keep_default_na=False, chunksize=self.chunk_rows):
+                        partition = pd.util.hash_array(chunk[self.key].to_numpy(dtype=object)) % num_partitions
+                        for p in np.unique(partition):
+                            chunk[partition == p].to_csv(files[p], header=not headers_written[p], index=False)
+                            headers_written[p] = True
+            finally:
+                for file in files:
+                    file.close()
+
+        self._partitions = [path for p, path in enumerate(partitions) if headers_written[p]]
+
+    def write_csv(self):
+        # writes the current chunks to a csv file as they should be written to a feed
+        # (see GTFSTable.get_output_df), finding the values they reference as they are read
+        # (see get_keys), returns its path
+        path = os.path.join(self.get_dir(), self.tablename + '.txt')
+        header = True
+        with open(path, 'w', encoding='utf-8', newline='') as csv:
+            for chunk in self.get_chunks_collecting_keys():
+                self.get_output_df(chunk).to_csv(csv, header=header, index=False)
+                header = False
+            if header:
+                pd.DataFrame(columns=self.get_columns(index=True)).to_csv(csv, index=False)
+        return path
+
+    def get_output_df(self, chunk):
+        table = self.table_class(df=chunk, dtype=self.dtype, columns=self.get_columns(index=True), cleaned=True)
+        return table.get_output_df()
+
+    def get_dir(self):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='tpau_' + self.tablename + '_')
+        return self._dir
+
+    def close(self):
+        # removes partition and output files
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+            self._partitions = None
+            self._original_keys = None
@@ -1,10 +1,10 @@
 import pandas as pd
 import numpy as np
-import os
 
-from .gtfsreader import GTFSReader
-from tpau_gtfsutilities.config.utilityconfig import utilityconfig
+from .gtfsreader import GTFSReader, csv_has_rows
+from .chunkedtable import ChunkedTable
 from tpau_gtfsutilities.config.utilityoutput import utilityoutput
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
 from tpau_gtfsutilities.gtfs.process import preprocess
 from .properties import REQUIRED_TABLES, TABLE_INDECES, NUMERIC_DTYPES, DOWS
 from .gtfserrors import MissingRequiredFileError
@@ -17,6 +17,7 @@ from .tables.stops import Stops
 from .tables.stop_times import StopTimes
 from .tables.trips import Trips
 from .tables.board_alight import BoardAlight
+from .tables.frequencies import Frequencies
 from .tables.gtfstable import GTFSTable
 
 table_classes = {
@@ -29,162 +30,582 @@ table_classes = {
     'stop_times': StopTimes,
     'trips': Trips,
     'board_alight': BoardAlight,
+    'frequencies': Frequencies,
 }
 
+def get_table_class(tablename):
+    return table_classes[tablename] \
+        if tablename in table_classes.keys() \
+        else GTFSTable
+
+def get_dtypes_dict(columns):
+    # dtypes to read columns of a feed's csv with
+    dtypes = {}
+    for col in columns:
+        if col in NUMERIC_DTYPES.keys():
+            dtypes[col] = NUMERIC_DTYPES[col]
+        else:
+            dtypes[col] = 'str'
+    return dtypes
+
+def make_table(table_class, df, original_df, dtype, columns):
+    # returns table of already cleaned df and original_df (the same frame if the original is unchanged),
+    # with only columns (including index columns). Frames are only sliced if they have other columns
+    frame_columns = [col for col in columns if col not in table_class.index]
+    select = lambda frame: frame if frame.columns.tolist() == frame_columns else frame[frame_columns]
+    dtype = { col: dt for col, dt in dtype.items() if col in columns }
+
+    table = table_class(df=select(original_df), dtype=dtype, columns=columns, cleaned=True)
+    if df is not original_df:
+        table.update(select(df), cleaned=True)
+    return table
+
 class GTFS:
     _gtfsreader = None
     _tables = {} # collection of GTFSTables
-
-    def load_feed(self, gtfsreader):
-        gtfsreader.unpack_csvs()
-
-        def get_dtypes_dict(columns):
-            dtypes = {}
-            for col in columns:
-                if col in NUMERIC_DTYPES.keys():
-                    dtypes[col] = NUMERIC_DTYPES[col]
-                else:
-                    dtypes[col] = 'str'
-            return dtypes
+    # tables in the feed that haven't been loaded yet, by tablename: function returning the table.
+    # See load_feed
+    _deferred = {}
+
+    def __init__(self):
+        self._tables = {}
+        self._deferred = {}
+        self._tablenames = [] # all tables in the feed, in feed order
+        # deferred tables reached by a cascade, which are pruned when they are loaded
+        self._stale = set()
+        # tables loaded with only some of their columns, which can't be written
+        self._column_pruned = set()
+        self._preprocessed = False
+        # FeedCacheEntry tables are loaded from and cached in, if caching (see load_table)
+        self._cache = None
+        # tables read from the zip that haven't been preprocessed (and cached) yet, by tablename:
+        # columns to keep once they have been (None for all). See preprocess
+        self._unprocessed = {}
+        # tables read in chunks rather than loaded (see ChunkedTable), by tablename
+        self._chunked = {}
+        # derived dataframes (i.e. trips_extended) by (name, original, source tables),
+        # stored with the source table versions they were computed from
+        self._derived = {}
+        self._derived_stats = {}
+
+    def reset_tables(self, gtfsreader):
+        self.close_chunked_tables()
+        self._gtfsreader = gtfsreader
+        self._tables = {}
+        self._deferred = {}
+        self._tablenames = []
+        self._stale = set()
+        self._column_pruned = set()
+        self._preprocessed = False
+        self._cache = None
+        self._unprocessed = {}
+        self._chunked = {}
+        self._derived = {}
+
+    def load_feed(self, gtfsreader, tables=None, chunked_tables=None, chunk_rows=None, cache=None):
+        # tables are parsed straight from the zip members, nothing is extracted.
+        # tables: dict of tablename: list of columns (None for all columns) to load now (see
+        # GTFSUtility.tables), or None to load every table. Other tables are loaded when first
+        # used, and written to output feeds straight from the zip if never used
+        # chunked_tables: tables to read in chunks of whole trips of about chunk_rows rows
+        # instead (see ChunkedTable), i.e. stop_times of feeds too large to load
+        # cache: FeedCacheEntry of the feed (see utilitycache) to load tables from if they are cached,
+        # and to cache them in once they are read and preprocessed, or None
+        gtfsreader.read_contents()
+
+        self.reset_tables(gtfsreader)
+        self._cache = cache
 
         for tablename in gtfsreader.contents:
-            csv = os.path.join(utilityconfig.get_input_dir(), tablename + '.csv')
-            columns = gtfsreader.contents[tablename]
+            self._tablenames.append(tablename)
+
+            if chunked_tables is not None and tablename in chunked_tables:
+                self._chunked[tablename] = ChunkedTable(self, gtfsreader, tablename, get_table_class(tablename), \
+                    get_dtypes_dict(gtfsreader.contents[tablename]), chunk_rows)
+                continue
+
+            if tables is not None and tablename not in tables.keys():
+                self._deferred[tablename] = lambda tablename=tablename: self.load_table(tablename)
+                continue
+
+            columns = tables[tablename] if tables is not None else None
+            self._tables[tablename] = self.load_table(tablename, columns=columns)
+
+    def load_table(self, tablename, columns=None):
+        # returns table from the cache if it is cached, otherwise read from the zip, with only
+        # columns (and index columns) if provided. Tables read from the zip are preprocessed and
+        # cached (see preprocess_tables), so if caching they are read whole and columns are kept after
+        if self._cache is not None:
+            cached = self._cache.read_table(tablename)
+            if cached is not None:
+                return self.read_cached_table(tablename, cached, columns=columns)
+
+        self._unprocessed[tablename] = columns
+        return self.read_table(tablename, columns=columns if self._cache is None else None)
+
+    def select_columns(self, tablename, table_columns, columns=None):
+        # returns table_columns (in order) that are in columns or index columns, all if columns is None.
+        # Tables loaded with only some of their columns can't be written
+        if columns is None:
+            return list(table_columns)
+        table_class = get_table_class(tablename)
+        selected = [col for col in table_columns if col in columns or col in table_class.index]
+        if len(selected) < len(table_columns):
+            self._column_pruned.add(tablename)
+        return selected
+
+    def read_table(self, tablename, columns=None):
+        # returns table read from the zip, with only columns (and index columns) if provided
+
+        table_class = get_table_class(tablename)
+
+        feed_columns = self._gtfsreader.contents[tablename]
+        usecols = None
+        if columns is not None:
+            usecols = self.select_columns(tablename, feed_columns, columns)
+            feed_columns = usecols
+
+        # the table isn't in the feed until it is returned, so its rows are counted here
+        with utilityprofile.stage('load_table:' + tablename) as record:
+            with self._gtfsreader.open_table(tablename) as csv:
+                table = table_class(csv, dtype=get_dtypes_dict(feed_columns), usecols=usecols)
+            record['rows_out'] = len(table.df)
+
+        return table
+
+    def read_cached_table(self, tablename, cached, columns=None):
+        # returns table already read and preprocessed from the cache (see FeedCacheEntry.read_table),
+        # with only columns (and index columns) if provided
+        with utilityprofile.stage('load_cached_table:' + tablename) as record:
+            columns = self.select_columns(tablename, cached['columns'], columns)
+            df, original_df = cached['read'](columns)
+            table = make_table(get_table_class(tablename), df, original_df, cached['dtype'], columns)
+            record['rows_out'] = len(table.df)
+        return table
+
+    def get_loaded_table(self, tablename):
+        # returns GTFSTable for tablename (loading it if deferred), or None if not in feed
+        if self.is_chunked(tablename):
+            raise ValueError(tablename + ' is read in chunks, so it can only be read with get_chunked_table')
+        if tablename in self._deferred.keys():
+            self.load_deferred_table(tablename)
+        return self._tables[tablename] if tablename in self._tables.keys() else None
+
+    def get_table_object(self, tablename):
+        # returns GTFSTable or ChunkedTable for tablename (loading it if deferred), or None if not
+        # in feed. Both have the columns, references, versions, keys and row counts used here
+        if self.is_chunked(tablename):
+            return self._chunked[tablename]
+        return self.get_loaded_table(tablename)
+
+    def get_table_objects(self):
+        # (tablename, GTFSTable or ChunkedTable) of each table loaded or read in chunks
+        return list(self._tables.items()) + list(self._chunked.items())
+
+    def load_deferred_table(self, tablename):
+        load = self._deferred.pop(tablename)
+        self._tables[tablename] = load()
+
+        # tables read from the zip once the feed has been preprocessed are preprocessed now
+        if self._preprocessed and tablename in self._unprocessed.keys():
+            self.preprocess_tables([tablename])
+
+        # catch up with cascades from other tables since the feed was loaded
+        if tablename in self._stale:
+            self._stale.remove(tablename)
+            self.prune_table(tablename)
+
+    def load_all_tables(self):
+        for tablename in list(self._deferred.keys()):
+            self.load_deferred_table(tablename)
+
+    def open_feed_table(self, tablename):
+        # returns binary stream of the table's csv in the input zip
+        return self._gtfsreader.open_table(tablename)
+
+    def is_deferred(self, tablename):
+        return tablename in self._deferred.keys()
+
+    def is_chunked(self, tablename):
+        return tablename in self._chunked.keys()
+
+    def get_chunked_table(self, tablename):
+        # returns ChunkedTable of a table read in chunks, to read (see ChunkedTable.get_chunks)
+        # or change (see ChunkedTable.add_transform)
+        return self._chunked[tablename]
+
+    def sync_chunked_tables(self, tablename=None):
+        # prunes tablename (or all tables) by chunked tables that have changed since, i.e. removes
+        # trips and stops no longer in stop_times, as a cascade from stop_times would. This is done
+        # when tables are next read rather than in each cascade, since it needs the chunks to be read
+        for chunked, table in self._chunked.items():
+            for target in list(table.unsynced):
+                if tablename is None or target == tablename:
+                    table.unsynced.discard(target)
+                    self.sync_chunked_table(chunked, target)
+
+    def sync_chunked_table(self, chunked, target):
+        if self.is_deferred(target):
+            self._stale.add(target)
+            return
+        if target not in self._tables.keys():
+            return
 
-            table_class = table_classes[tablename] \
-                if tablename in table_classes.keys() \
-                else GTFSTable
+        references = [(sources, ref) for sources, ref in self.get_table_references()[chunked] if ref.table == target]
+        removed = self._tables[target].keep_rows(self.get_referenced_rows(target, references))
 
-            self._tables[tablename] = table_class(csv, dtype=get_dtypes_dict(columns))
+        # chunks are already pruned by target (if it prunes them)
+        if removed:
+            self.cascade_update(target, exclude_tables=[chunked])
 
-        gtfsreader.cleanup_gtfs_files_in_data_dir()
+    def close_chunked_tables(self):
+        # removes temporary files of chunked tables
+        for table in self._chunked.values():
+            table.close()
 
     def preprocess(self):
-        preprocess.remove_all_wrapping_quotations_in_gtfs(self)
+        # preprocesses tables read from the zip (cached tables already have been)
+        tablenames = [tablename for tablename in self._tables.keys() if tablename in self._unprocessed.keys()]
+        with utilityprofile.stage('preprocess', count_rows=lambda: self.count_rows(tablenames)):
+            self.preprocess_tables(tablenames)
+        # deferred tables are preprocessed when they are loaded, and chunks as they are read
+        self._preprocessed = True
+        for table in self._chunked.values():
+            table.preprocess = preprocess.remove_wrapping_quotations_in_table
+
+    def preprocess_tables(self, tablenames):
+        # preprocesses tables read from the zip, then caches them (if caching) before any other
+        # changes, and keeps only the columns they were loaded for
+        preprocess.remove_all_wrapping_quotations_in_gtfs(self, tablenames=tablenames)
+
+        for tablename in tablenames:
+            columns = self._unprocessed.pop(tablename)
+            if self._cache is None:
+                continue
+
+            table = self._tables[tablename]
+            with utilityprofile.stage('cache_table:' + tablename):
+                self._cache.store_table(tablename, {
+                    'df': table.df,
+                    'original_df': table.original_df,
+                    'dtype': table.dtype,
+                    'columns': table.columns,
+                })
+
+            if columns is not None:
+                columns = self.select_columns(tablename, table.columns, columns)
+                self._tables[tablename] = make_table(get_table_class(tablename), table.df, table.original_df, table.dtype, columns)
 
     def write_feed(self, feedname):
-        tables = {}
-        for tablename in self._tables.keys():
-            table = self.get_table(tablename, index=False) 
-            tables[tablename] = table[self.get_columns(tablename, index=True)]
-        utilityoutput.write_to_zip(tables, feedname)
-
-    def get_table(self, tablename, index=True, original=False, column=None):
-        if tablename not in self._tables.keys():
+        if len(self._column_pruned):
+            raise ValueError('cannot write feed loaded with only some columns of ' + ', '.join(sorted(self._column_pruned)))
+
+        # chunked tables are written to csv files first, which finds the values they still
+        # reference, so the tables they reference can be pruned before they are written
+        chunked_files = {}
+        chunked_rows = {}
+        for tablename, table in self._chunked.items():
+            with utilityprofile.stage('write_chunks:' + tablename) as record:
+                chunked_files[tablename] = table.write_csv()
+                record['rows_out'] = chunked_rows[tablename] = table.get_rows()
+        self.sync_chunked_tables()
+
+        # deferred tables that have been pruned need loading to be written
+        for tablename in list(self._stale):
+            self.load_deferred_table(tablename)
+
+        def get_output_table(tablename):
+            # tables never loaded are copied from the input zip unchanged
+            if self.is_deferred(tablename):
+                return lambda: self.open_feed_table(tablename)
+            if self.is_chunked(tablename):
+                return lambda: open(chunked_files[tablename], 'rb')
+            return self._tables[tablename].get_output_df()
+
+        # rows written from memory and from chunks (tables copied from the zip aren't counted)
+        count_written_rows = lambda: self.count_rows(self._tables.keys()) + sum([rows or 0 for rows in chunked_rows.values()])
+        with utilityprofile.stage('write_feed', count_rows=count_written_rows):
+            # output dfs are made as each table is written, rather than all at once
+            tables = ((tablename, get_output_table(tablename)) for tablename in self._tablenames \
+                if tablename in self._tables.keys() or self.is_deferred(tablename) or self.is_chunked(tablename))
+            utilityoutput.write_to_zip(tables, feedname)
+
+    def count_rows(self, tablenames):
+        # total rows of tablenames (none for tables not in the feed), for profiling, or None if
+        # they aren't all known: deferred tables until they are loaded, and chunked tables until
+        # their current chunks have all been read (see ChunkedTable.get_rows)
+        rows = 0
+        for tablename in tablenames:
+            if self.is_deferred(tablename):
+                return None
+            table = self.get_table_object(tablename)
+            table_rows = table.get_rows() if table is not None else 0
+            if table_rows is None:
+                return None
+            rows += table_rows
+        return rows
+
+    def get_table(self, tablename, index=True, original=False, column=None, view=False):
+        # returns a copy of the table, unless view=True: views share their data with
+        # the feed, so they are only for reading (i.e. filtering, merging, grouping)
+        if not original:
+            self.sync_chunked_tables(tablename)
+        table = self.get_loaded_table(tablename)
+        if table is None:
             return pd.DataFrame()
-        
-        table = self._tables[tablename]
 
-        df = table.get_df(original=original)
+        df = table.get_df(original=original, view=True)
+        copied = False
         if not index and len(table.index):
             df = df.reset_index()
+            copied = True
+
+        if column and self.table_has_column(tablename, column):
+            df = df[column]
+
+        return df if view or copied else df.copy()
+
+    def get_table_versions(self, tablenames, original=False):
+        # version of each table (None if not in feed). Versions change whenever a
+        # table is updated or reset, so unchanged versions mean unchanged tables
+        if not original:
+            for tablename in tablenames:
+                self.sync_chunked_tables(tablename)
+
+        versions = []
+        for tablename in tablenames:
+            table = self.get_table_object(tablename)
+            versions.append(table.get_version(original=original) if table else None)
+        return tuple(versions)
+
+    def get_derived(self, name, tablenames, compute, original=False):
+        # returns compute(), reusing the last result until any of tablenames changes.
+        # compute must only depend on tablenames (from original tables if original=True).
+        # Results are shared, so callers should copy them before modifying
+
+        key = (name, original, tuple(tablenames))
+        versions = self.get_table_versions(tablenames, original=original)
+        stats = self._derived_stats.setdefault(name, {'hits': 0, 'misses': 0})
 
-        if column and table_has_column(tablename, column):
-            return df.copy()[column]
-            
-        return df.copy()
+        if key in self._derived and self._derived[key][0] == versions:
+            stats['hits'] += 1
+            return self._derived[key][1]
+
+        stats['misses'] += 1
+        result = compute()
+        self._derived[key] = (versions, result)
+        return result
+
+    def get_derived_stats(self):
+        # hit/miss counts of derived results by name
+        return { name: dict(stats) for name, stats in self._derived_stats.items() }
 
     def has_table(self, tablename, check_empty=True):
+        # chunked tables aren't read to check if they're empty
+        if self.is_chunked(tablename):
+            return True
+        in_feed = tablename in self._tables.keys() or self.is_deferred(tablename)
+        # tables not loaded yet (and not reached by cascades) are checked without loading them
+        if check_empty and self.is_deferred(tablename) and tablename not in self._stale:
+            with self.open_feed_table(tablename) as file:
+                return csv_has_rows(file)
         if check_empty:
-            return tablename in self._tables.keys() and not self.get_table(tablename).empty
-        return tablename in self._tables.keys()
+            return in_feed and not self.get_table(tablename, view=True).empty
+        return in_feed
 
     def update_original_tables(self):
+        if len(self._chunked):
+            raise ValueError('cannot update original tables of a feed with tables read in chunks')
+        # pruned deferred tables are loaded, so their originals are pruned too
+        for tablename in list(self._stale):
+            self.load_deferred_table(tablename)
         for table in self._tables.keys():
             self._tables[table].update_original()
     
     def reset_to_original_tables(self):
         for table in self._tables.keys():
             self._tables[table].reset_to_original()
+        # deferred tables are loaded as their originals
+        self._stale = set()
+        for table in self._chunked.values():
+            table.reset()
 
-    def table_has_column(self, tablename, column):
-        return column in self.get_columns(tablename)
+    def table_has_column(self, tablename, column, index=False):
+        return column in self.get_columns(tablename, index=index)
 
     def get_columns(self, tablename, index=False):
         if (not self.has_table(tablename, check_empty=False)):
             return []
-        return self._tables[tablename].get_columns(index=index)
+        return self.get_table_object(tablename).get_columns(index=index)
 
     def update_table(self, tablename, df, cascade=True, exclude_tables=None):
+        # updates table, and if cascade, prunes other tables that referred to removed rows
+        # or are no longer referred to (see cascade_update)
+        # returns dict of tablename: number of rows removed, for each cascaded table that changed
         if exclude_tables is None: 
             exclude_tables = []
+        if self.is_chunked(tablename):
+            raise ValueError(tablename + ' is read in chunks, so it can only be changed with ChunkedTable.add_transform')
         if not self.has_table(tablename):
-            return
+            return {}
         table = self._tables[tablename]
         table.update(df)
 
-        if cascade:
-            self.update_downstream_tables(tablename, exclude_tables)
-            self.update_upstream_tables(tablename, exclude_tables)
+        if not cascade:
+            return {}
+        with utilityprofile.stage('cascade:' + tablename) as record:
+            rows_removed = self.cascade_update(tablename, exclude_tables)
+            # rows of the tables the cascade changed, before and after
+            if utilityprofile.enabled:
+                record['rows_out'] = self.count_rows(rows_removed.keys())
+                record['rows_in'] = record['rows_out'] + sum(rows_removed.values())
+            return rows_removed
+
+    def get_table_references(self):
+        # references from each table in the feed, built from table downstream/upstream columns
+        # returns dict of tablename: list of (sources, ColumnRef), where sources is a list of
+        # (tablename, column) whose values ColumnRef's column may refer to
+        references = {}
+
+        for tablename, table in self.get_table_objects():
+            table_references = []
+
+            for col in table.downstream_columns.keys():
+                downstream_obj = table.downstream_columns[col]
+                sources = [(tablename, col)]
+
+                # i.e. trips can refer to either calendar or calendar_dates
+                if 'with_table_col' in downstream_obj.keys():
+                    sources.append(downstream_obj['with_table_col'])
 
-    def update_downstream_tables(self, tablename, exclude_tables=None):
-        # removes downstream references that no longer exist
-        if exclude_tables is None: 
-            exclude_tables = []
+                for ref in downstream_obj['references']:
+                    table_references.append((sources, ref))
 
-        table = self._tables[tablename]
-        original_df = table.get_df().copy()
+            for col in table.upstream_columns.keys():
+                for ref in table.upstream_columns[col]['references']:
+                    table_references.append(([(tablename, col)], ref))
 
-        for col in table.downstream_columns.keys():
-            downstream_obj = table.downstream_columns[col]
-            
-            # if multiple downstream tables (i.e. calendar and calendar_dates for trips),
-            # supply all tables to prune function
-            for ref in downstream_obj['references']:
-                columns = {}
-                columns[tablename] = col
+            references[tablename] = table_references
 
-                if 'with_table_col' in downstream_obj.keys():
-                    source = [tablename]
-                    with_tab, with_col = downstream_obj['with_table_col']
-                    source.append(with_tab)
-                    columns[with_tab] = with_col
-                else:
-                    source = tablename
-
-                down_table = ref.table
-                down_col = ref.column
-                columns[down_table] = down_col
-                cascade_row = ref.cascade_row
-                
-                if down_table not in exclude_tables and self.has_table(down_table):
-                    if cascade_row:
-                        updated_table = self.prune_table_from_table_column(down_table, source, columns=columns)
-                    else:
-                        # TODO cleanup -- this call can only accept a single source, so source here must be a single table name
-                        updated_table = self.remove_invalid_references_to_table_column(down_table, down_col, source, col)
-                    if tablename not in exclude_tables:
-                        exclude_tables.append(tablename)
-                    if not updated_table.equals(original_df):
-                        self.update_table(down_table, updated_table, exclude_tables=exclude_tables, cascade=cascade_row)
-
-    def update_upstream_tables(self, tablename, exclude_tables=None):
-        # removes upstream references that are no longer used
+        return references
+
+    def cascade_update(self, tablename, exclude_tables=None):
+        # removes rows that reference values no longer in tablename (downstream), and rows
+        # that are no longer referenced (upstream), then does the same from each table reached.
+        # Tables are visited breadth first from tablename and each is filtered at most once,
+        # by the surviving keys of every visited table that references it. Tables that reference
+        # nothing (i.e. shapes) are filtered last, and references that only unset values
+        # (cascade_row=False) once all rows are removed.
+        # returns dict of tablename: number of rows removed, for each table that changed
         if exclude_tables is None: 
             exclude_tables = []
 
-        table = self._tables[tablename]
-        original_df = table.get_df().copy()
-
-        for col in table.upstream_columns.keys():
-            upstream = table.upstream_columns[col]
-
-            for ref in upstream['references']:
-                up_table = ref.table
-                up_col = ref.column
-                cascade_row = ref.cascade_row
-                if up_table not in exclude_tables and self.has_table(up_table):
-                    columns = {}
-                    columns[tablename] = col
-                    columns[up_table] = up_col
-                    if cascade_row:
-                        updated_table = self.prune_table_from_table_column(up_table, tablename, columns=columns)
-                    else:
-                        updated_table = self.remove_invalid_references_to_table_column(up_table, up_col, tablename, col)
-                    if tablename not in exclude_tables:
-                        exclude_tables.append(tablename)
-                    if not updated_table.equals(original_df):
-                        self.update_table(up_table, updated_table, exclude_tables=exclude_tables, cascade=cascade_row)
+        references = self.get_table_references()
+        keys = {} # (tablename, column): surviving values, computed once per cascade
+        visited = [tablename]
+        rows_removed = {}
+
+        def prune(target):
+            # filters target by every visited table referencing it
+            visited.append(target)
+            table = self._tables[target]
+            visited_references = [reference for source in visited for reference in references[source]]
+
+            removed = table.keep_rows(self.get_referenced_rows(target, visited_references, keys=keys))
+            if removed:
+                rows_removed[target] = removed
+                for (keys_table, col) in list(keys.keys()):
+                    if keys_table == target:
+                        del keys[(keys_table, col)]
+
+        queue = [tablename]
+        unreferencing = []
+        while len(queue):
+            source = queue.pop(0)
+            for sources, ref in references[source]:
+                target = ref.table
+                if not ref.cascade_row or target in visited or target in exclude_tables:
+                    continue
+                # chunked tables are pruned as each chunk is read
+                if self.is_chunked(target):
+                    self._chunked[target].add_pruning_reference(sources, ref)
+                    continue
+                # deferred tables are pruned when they are loaded, if ever
+                if self.is_deferred(target):
+                    self._stale.add(target)
+                    continue
+                if not self.has_table(target):
+                    continue
+                if not len(references[target]):
+                    if target not in unreferencing:
+                        unreferencing.append(target)
+                    continue
+                prune(target)
+                queue.append(target)
+
+        for target in unreferencing:
+            prune(target)
+
+        soft_references = []
+        for source in visited:
+            for sources, ref in references[source]:
+                if not ref.cascade_row and ref.table not in exclude_tables:
+                    soft_references.append((ref.table, ref.column, sources))
+
+        for target in self.remove_invalid_references(soft_references, keys=keys).keys():
+            rows_removed.setdefault(target, 0)
+
+        return rows_removed
+
+    def get_referenced_rows(self, target, references, keys=None):
+        # returns boolean array of the rows of (loaded) target with values found by every
+        # cascading reference to it (or missing values). references: list of (sources, ColumnRef)
+        table = self._tables[target]
+        keep = np.ones(len(table.df), dtype=bool)
+
+        for sources, ref in references:
+            if ref.table != target or not ref.cascade_row \
+                or not self.table_has_column(target, ref.column, index=True):
+                continue
+            source_keys = self.get_source_keys(sources, keys=keys)
+            if source_keys is None:
+                continue
+            values = table.get_values(ref.column)
+            keep &= np.asarray(pd.isna(values) | values.isin(source_keys))
+
+        return keep
+
+    def prune_table(self, tablename):
+        # prunes a table loaded after cascades reached it (see load_deferred_table) by the
+        # current values of every table referencing it, then cascades from it
+        references = self.get_table_references()
+        all_references = [reference for source in references.keys() for reference in references[source]]
+
+        removed = self._tables[tablename].keep_rows(self.get_referenced_rows(tablename, all_references))
+
+        soft_references = [(ref.table, ref.column, sources) for sources, ref in all_references \
+            if ref.table == tablename and not ref.cascade_row]
+        self.remove_invalid_references(soft_references)
+
+        if removed and len(references[tablename]):
+            self.cascade_update(tablename)
+
+    def get_source_keys(self, sources, keys=None):
+        # distinct values of the (tablename, column) sources combined, or None if no
+        # source is in the feed. keys is an optional cache of values by (tablename, column)
+        if keys is None:
+            keys = {}
+
+        sources = [(source, col) for (source, col) in sources \
+            if self.table_has_column(source, col, index=True)]
+        if not len(sources):
+            return None
+
+        for source_col in sources:
+            if source_col not in keys:
+                keys[source_col] = self.get_table_object(source_col[0]).get_keys(source_col[1])
+
+        return np.concatenate([keys[source_col] for source_col in sources])
 
     def clear_table(self, tablename):
         df = self.get_table(tablename)
@@ -198,87 +619,76 @@ class GTFS:
         return self.has_table('ride_feed_info')
 
     def is_multiagency(self):
-        return self.get_table('agency')['agency_name'].size > 1
+        return self.get_table('agency', view=True)['agency_name'].size > 1
 
     def defines_service_in_calendar_dates(self):
         # Returns true if the feed defines all service using calendar_dates
         if (not self.has_table('calendar')):
             return True
 
-        calendars_dows = self.get_table('calendar')[DOWS]
+        calendars_dows = self.get_table('calendar', view=True)[DOWS]
         has_any_service = calendars_dows.any(axis=None)
 
         return has_any_service
 
-    def run_function_on_all_tables(self, func, cascade=True):
-        # func should be a function that accepts a df
+    def run_function_on_all_tables(self, func, cascade=True, tablenames=None):
+        # func should be a function that accepts a df and returns a new df with any changes
+        # (without modifying it), or the same df if nothing changed, which skips updating the table.
+        # Runs on loaded tables, or tablenames if provided
 
-        for tablename in self._tables.keys():
-            df = self.get_table(tablename)
+        tablenames = tablenames if tablenames is not None else list(self._tables.keys())
+        for tablename in tablenames:
+            df = self.get_table(tablename, view=True)
             new_df = func(df)
-            self.update_table(tablename, new_df, cascade=cascade)
+            if new_df is not df:
+                self.update_table(tablename, new_df, cascade=cascade)
 
     def copy(self):
+        if len(self._chunked):
+            raise ValueError('cannot copy a feed with tables read in chunks')
+        self.load_all_tables()
+
         c = GTFS()
         table_copies = {}
         for tablename in self._tables.keys():
             table_copies[tablename] = self._tables[tablename].copy()
         c._tables = table_copies
+        c._tablenames = list(self._tablenames)
+        c._column_pruned = set(self._column_pruned)
+        c._preprocessed = self._preprocessed
+        c._cache = self._cache
+        c._unprocessed = dict(self._unprocessed)
         return c
 
-    def remove_invalid_references_to_table_column(self, target, target_col, source, source_col):
-        # unsets values in target table column that do not exist in source table column
-        # source can only be string here -- no practical need for multiple sources
-
-        if not self.has_table(target): return pd.DataFrame()
-        target_df = self.get_table(target, index=False)
-        
-        if not self.has_table(source): return target_df
-        if not self.table_has_column(target, target_col): return target_df
-
-        source_df = self.get_table(source, index=False)
-
-        target_df['ref_valid'] = (target_df[target_col].isna() | target_df[target_col].isin(source_df[source_col]))
-
-        target_df[target_col] = target_df.apply(lambda row: row[target_col] if row['ref_valid'] == True else np.nan, axis=1)
-
-        return target_df
-
-    def prune_table_from_table_column(self, target, source, columns={}):
-        # remove rows from target if column value not present in same column of source,  e.g.:
-        #   prune_table_from_table_column('transfers', 'stops', columns={'transfers': 'from_stop_id', 'stops': 'stop_id'})
-
-        if not self.has_table(target): return pd.DataFrame()
-
-        target_df = self.get_table(target, index=False)
-        target_col = columns[target]
-
-        if isinstance(source, list):
-            # make source columns consistent before concat
-            # new col name doesn't matter as long as its unique within table
-            source_dfs = {}
-            for tablename in source:
-                if self.has_table(tablename, check_empty=False):
-                    source_dfs[tablename] = self.get_table(tablename, index=False)
-
-            source_col = 'source_col'
-            for tablename in source_dfs.keys():
-                col_rename = {}
-                col_rename[columns[tablename]] = source_col
-                source_dfs[tablename] = source_dfs[tablename].rename(columns=col_rename)
-                columns[tablename] = source_col
-            
-            source_df = pd.concat( \
-                list(source_dfs.values()),
-                axis=0,
-                ignore_index=True
-            )
-        else:
-            if not self.has_table(source, check_empty=False): return target_df
-
-            source_df = self.get_table(source, index=False)
-            source_col = columns[source]
-
-        target_pruned = target_df[target_df[target_col].isna() | (target_df[target_col].isin(source_df[source_col]))]
-        
-        return target_pruned
+    def remove_invalid_references(self, references, keys=None):
+        # unsets values that do not exist in the column(s) they refer to, without cascading.
+        # references: list of (target, target_col, sources), where sources is a list of
+        # (tablename, column) that target_col may refer to, e.g.:
+        #   [('stops', 'parent_station', [('stops', 'stop_id')])]
+        # returns dict of tablename: number of values unset, for each table changed
+
+        values_unset = {}
+
+        for target, target_col, sources in references:
+            # chunked tables have no references that only unset values
+            if self.is_chunked(target):
+                continue
+            if self.is_deferred(target):
+                self._stale.add(target)
+                continue
+            if not self.has_table(target) or not self.table_has_column(target, target_col):
+                continue
+
+            source_keys = self.get_source_keys(sources, keys=keys)
+            if source_keys is None:
+                continue
+
+            table = self._tables[target]
+            values = table.get_values(target_col)
+            invalid = ~np.asarray(pd.isna(values) | (values == '') | values.isin(source_keys))
+
+            unset = table.unset_values(target_col, invalid)
+            if unset:
+                values_unset[target] = values_unset.get(target, 0) + unset
+
+        return values_unset
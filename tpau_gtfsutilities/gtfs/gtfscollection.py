@@ -23,7 +23,7 @@ class GTFSCollection:
         for feed in self.feeds.keys():
             gtfs = self.feeds[feed]
             if gtfs.has_table(tablename):
-                table = gtfs.get_table(tablename, index=False)
+                table = gtfs.get_table(tablename, index=False, view=True)
                 table_dict[feed] = table
 
         return combine_dfs_from_dict(table_dict, 'feed')
@@ -1,15 +1,23 @@
 import logging
 import os
+import io
 import csv
 import zipfile
 from tpau_gtfsutilities.config.utilityconfig import utilityconfig
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
+from .properties import GTFS_ENCODING
 
 logger = logging.getLogger(__name__)
 
 class GTFSReader:
+    # Reads GTFS tables directly from the members of the feed's zip file.
+    # Nothing is extracted to the input directory, so several runs can
+    # read the same input directory at once.
+
     def __init__(self, filename):
         self.filename = filename
         self.contents = {} # dict of filename (no ext): list of columns
+        self._members = {} # dict of filename (no ext): name of zip member
 
     def get_path(self):
         return os.path.join(utilityconfig.get_input_dir(), self.filename)
@@ -20,62 +28,60 @@ class GTFSReader:
     def update_table_columns(self, tablename, columns):
         self.contents[tablename] = columns
 
-    def __capture_feed_tables(self):
-        # records the filenames in the feed without extensions
-        zipreader = zipfile.ZipFile(self.get_path(), 'r')
-        filelist = zipreader.namelist()
-
-        self.__unzip()
-
-        for filename in filelist:
-            hidden = filename.startswith('.')
-
-            if not hidden:
-                tablename = filename.split('.')[0]
-
-                path = os.path.join(utilityconfig.get_input_dir(), tablename + '.txt')
-                with open(path, 'r', newline='') as file:
-                    csvin = csv.reader(file)
-                    headers = next(csvin, [])
-
-                    # Invalid csv files may be read as having no headers
-                    if len(headers):
-                        self.contents[tablename] = []
-                        self.contents[tablename] = headers
-
     def __validate_zipfile(self):
         filepath = self.get_path()
 
         assert os.path.exists(filepath), 'ERROR file not found at %s' % filepath
         assert zipfile.is_zipfile(filepath), 'ERROR %s not a valid zip file path' % filepath
 
-    def __unzip(self):
-        zip_reader = zipfile.ZipFile(self.get_path(), 'r')
-        zip_reader.extractall(utilityconfig.get_input_dir())
+    def __capture_feed_tables(self, zipreader):
+        # records the filenames in the feed without extensions, and the headers of each file
 
+        for member in zipreader.infolist():
+            if member.is_dir():
+                continue
 
-    def __convert_to_csv(self):
-        for tablename in self.contents:
-            filename = tablename + '.txt'
+            filename = os.path.basename(member.filename)
+            hidden = filename.startswith('.')
 
-            filename_no_extension = filename[:-4]
-            csv_filename = filename_no_extension + '.csv'
+            if not hidden:
+                tablename = filename.split('.')[0]
 
-            filepath = os.path.join(utilityconfig.get_input_dir(), filename)
-            dst_csv = os.path.join(utilityconfig.get_input_dir(), csv_filename)
+                with zipreader.open(member) as file:
+                    text = io.TextIOWrapper(file, encoding=GTFS_ENCODING, newline='')
+                    csvin = csv.reader(text)
+                    headers = next(csvin, [])
 
-            os.rename(filepath, dst_csv)
+                # Invalid csv files may be read as having no headers
+                if len(headers):
+                    self.contents[tablename] = headers
+                    self._members[tablename] = member.filename
 
-    def cleanup_gtfs_files_in_data_dir(self):
-        for tablename in self.contents:
-            filename = tablename + '.csv'
-            filepath = os.path.join(utilityconfig.get_input_dir(), filename)
-            os.remove(filepath)
+    def read_contents(self):
+        # reads table names and headers from the zip without extracting it
+        self.__validate_zipfile()
 
+        self.contents = {}
+        self._members = {}
+        with utilityprofile.stage('read_contents'):
+            with zipfile.ZipFile(self.get_path(), 'r') as zipreader:
+                self.__capture_feed_tables(zipreader)
 
-    def unpack_csvs(self):
-        self.__validate_zipfile()
-        self.__unzip()
-        self.__capture_feed_tables()
-        self.__convert_to_csv()
+    def open_table(self, tablename):
+        # returns a binary stream of the table's csv data, read straight from the zip.
+        # The stream should be closed by the caller (i.e. used in a with statement)
 
+        zipreader = zipfile.ZipFile(self.get_path(), 'r')
+        try:
+            stream = zipreader.open(self._members[tablename])
+        finally:
+            # the member stream stays readable after the archive handle is closed
+            zipreader.close()
+        return stream
+
+def csv_has_rows(file):
+    # True if a table's csv (binary stream) has any rows after its header, read only as far as the first one
+    csvin = csv.reader(io.TextIOWrapper(file, encoding=GTFS_ENCODING, newline=''))
+    next(csvin, None)
+    # blank lines are read as empty rows
+    return any(len(row) for row in csvin)
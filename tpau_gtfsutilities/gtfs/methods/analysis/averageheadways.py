@@ -3,11 +3,17 @@ import numpy as np
 
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
 from tpau_gtfsutilities.config.utilityoutput import utilityoutput
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
 from tpau_gtfsutilities.gtfs.methods.helpers import triphelpers
+from tpau_gtfsutilities.gtfs.methods.helpers.calendarhelpers import get_service_activity
 
 from tpau_gtfsutilities.helpers.datetimehelpers import seconds_since_zero
+from tpau_gtfsutilities.helpers.datetimecolumns import to_seconds_since_zero, to_military
 
-def calculate_average_headways(date, time_range):
+ROUTE_DIRECTION = ['route_id', 'direction_id']
+
+@utilityprofile.profiled('calculate_average_headways')
+def calculate_average_headways(dates, time_ranges=None):
     # For each route, and each specified time period, comma separated values, LF/CR for each new route/time period combo:
     #   Agency ID
     #   Agency Name
@@ -18,92 +24,163 @@ def calculate_average_headways(date, time_range):
     #   Route Name
     #   Route Frequency [for specified time period]
     #   Trip Start Time, Trip Start Time, Trip Start Time, … [for each trip that starts during specified time period(s)]
+    #
+    # dates: list of 'YYYYMMDD' dates, each using the trips with service active on it
+    # time_ranges: list of time ranges ({ start, end }), or None to use all trips. Trips (including
+    # each trip represented by frequencies) are counted in every time range they are wholly within.
+    # All dates and time ranges are calculated in one pass without filtering the feed,
+    # and rows are in dates then time_ranges order
+
+    service_activity = get_service_activity()
+
+    trip_times = get_trip_times()
+    ranges = time_ranges if time_ranges else [None]
+
+    # a row for each trip on each date it runs
+    trip_rows, date_positions = np.nonzero(service_activity.is_active_on_dates(trip_times['service_id'], dates))
+    trip_times = trip_times.iloc[trip_rows].assign(date_position=date_positions)
+    trip_times = assign_trips_to_time_ranges(trip_times, time_ranges)
+
+    # calculate deltas within each date, time range, route and direction
+    groupby_cols = ['date_position', 'time_range'] + ROUTE_DIRECTION
+    trip_times = trip_times.sort_values(groupby_cols + ['start_time_seconds'])
+    trip_times['delta_seconds'] = trip_times.groupby(groupby_cols)['start_time_seconds'].diff()
+
+    route_avg_headway_minutes = trip_times \
+        .groupby(groupby_cols)['delta_seconds'].mean() \
+        .fillna(0) \
+        .transform(lambda x: np.round(x / 60, decimals=3)) \
+        .rename('average_headway_minutes')
 
-    trips_extended = triphelpers.get_trips_extended().reset_index()
-    trips = gtfs.get_table('trips', original=True)
+    trip_times['start_time'] = to_military(trip_times['start_time_seconds'])
+    route_trip_starts_list = trip_times.groupby(groupby_cols)['start_time'].apply(list) \
+        .rename('trip_start_times')
+
+    headways = pd.concat([route_avg_headway_minutes, route_trip_starts_list], axis=1)
+    headway_date_positions = headways.index.get_level_values('date_position')
+    headway_range_positions = headways.index.get_level_values('time_range')
+
+    trips = gtfs.get_table('trips', index=False, view=True)
+    trips_active = service_activity.is_active_on_dates(trips['service_id'], dates)
+
+    reports = []
+    for date_position, date in enumerate(dates):
+        # with time ranges, only routes and directions with service on date are reported
+        date_trips = trips[trips_active[:, date_position]] if time_ranges else trips
+        output = get_route_direction_info(date_trips, date)
+
+        for range_position, time_range in enumerate(ranges):
+            report = output.copy()
+            report['start_time'] = time_range['start'] if time_range else ''
+            report['end_time'] = time_range['end'] if time_range else ''
+
+            range_headways = headways[ \
+                (headway_date_positions == date_position) & (headway_range_positions == range_position) \
+            ].droplevel(['date_position', 'time_range'])
+
+            report = report.merge(range_headways, \
+                how='left', \
+                left_index=True, \
+                right_index=True \
+            )
+            reports.append(report)
+
+    output = pd.concat(reports)
+
+    # fill empty trip start times with empty list
+    output['trip_start_times'] = output['trip_start_times'].apply(lambda d: d if isinstance(d, list) else [])
+
+    return output.reset_index()
+
+def get_route_direction_info(trips, date):
+    # returns df indexed by route_id, direction_id for every route and direction in trips,
+    # with agency and route information and date
 
     if not ('direction_id' in trips.columns):
-        trips['direction_id'] = ''
-        trips_extended['direction_id'] = ''
+        trips = trips.assign(direction_id='')
 
-    route_direction_pairs = trips[['route_id', 'direction_id']].drop_duplicates()
-    route_direction_pairs = route_direction_pairs.set_index(['route_id', 'direction_id'])
+    route_direction_pairs = trips[ROUTE_DIRECTION].drop_duplicates()
 
-    agency_info = gtfs.get_table('agency')[['agency_id','agency_name']]
+    agency_info = gtfs.get_table('agency', view=True)[['agency_id','agency_name']]
 
     if 'agency_id' in gtfs.get_columns('routes'):
         route_info = gtfs.get_table('routes', original=True, index=False)[['route_id', 'agency_id', 'route_long_name']]
 
-        output = route_direction_pairs.reset_index() \
+        output = route_direction_pairs \
             .merge(route_info, how='left', on='route_id') \
-            .set_index(['route_id', 'direction_id'])
-        output = output.reset_index() \
             .merge(agency_info, how='left', on='agency_id') \
-            .set_index(['route_id', 'direction_id'])
+            .set_index(ROUTE_DIRECTION)
 
     # No agency id in routes.txt means there is only one agency
     else:
         route_info = gtfs.get_table('routes', original=True, index=False)[['route_id', 'route_long_name']]
-        output = route_direction_pairs.reset_index() \
-            .merge(route_info.to_frame(), how='left', on='route_id') \
-            .set_index(['route_id', 'direction_id'])
-        
+        output = route_direction_pairs \
+            .merge(route_info, how='left', on='route_id') \
+            .set_index(ROUTE_DIRECTION)
+
         output['agency_id'] = agency_info['agency_id'].iloc[0]
         output['agency_name'] = agency_info['agency_name'].iloc[0]
 
     output['date'] = date
-    output['start_time'] = time_range['start'] if time_range else ''
-    output['end_time'] = time_range['end'] if time_range else ''
 
-    if trips_extended.empty:
-        output['trip_start_times'] = np.empty((len(output), 0)).tolist()
-        output['average_headway_mintes'] = 0
+    return output
 
-        return output.reset_index()
+def get_trip_times():
+    # returns df with a row for each occurring trip: single trips from their stop_times, and each
+    # trip represented by frequencies (instead of its stop_times), with columns
+    # route_id, direction_id, service_id, start_time_seconds, end_time_seconds
+
+    trips_extended = triphelpers.get_trips_extended().reset_index()
 
-    unwrapped_repeating_trips = triphelpers.get_unwrapped_repeating_trips()
+    if not ('direction_id' in trips_extended.columns):
+        trips_extended['direction_id'] = ''
 
-    trip_start_times = trips_extended[['trip_id', 'start_time']]
+    trip_times = trips_extended[['trip_id', 'start_time', 'end_time']]
+    trip_times = trip_times.assign( \
+        start_time_seconds=to_seconds_since_zero(trip_times['start_time']),
+        end_time_seconds=to_seconds_since_zero(trip_times['end_time'])
+    ).drop(columns=['start_time', 'end_time'])
 
-    if not unwrapped_repeating_trips.empty:
-        frequency_trip_ids = unwrapped_repeating_trips['trip_id']
+    frequency_blocks = triphelpers.get_frequency_blocks()
 
-        # remove stop_times for trips in frequencies as they should be ignored
-        trip_start_times = trip_start_times[~trip_start_times['trip_id'].isin(frequency_trip_ids)]
+    if not frequency_blocks.empty:
+        # ignore stop_times for trips in frequencies, and use their frequency trips instead
+        trip_times = trip_times[~trip_times['trip_id'].isin(frequency_blocks['trip_id'])]
 
-        unwrapped_repeating_trips = unwrapped_repeating_trips[['trip_id', 'trip_start']]
-        unwrapped_repeating_trips = unwrapped_repeating_trips.rename(columns={ 'trip_start': 'start_time' })
+        frequency_trips = triphelpers.unwrap_frequency_blocks(frequency_blocks)[['trip_id', 'trip_start', 'trip_end']]
+        frequency_trips = frequency_trips.rename(columns={ 'trip_start': 'start_time_seconds', 'trip_end': 'end_time_seconds' })
 
-        trip_start_times = pd.concat([trip_start_times, unwrapped_repeating_trips])
+        trip_times = pd.concat([trip_times, frequency_trips])
 
-    trip_start_times = trip_start_times.merge(trips_extended.reset_index()[['trip_id','route_id', 'direction_id']], how='left', on='trip_id')
-    trip_start_times['start_time_seconds'] = trip_start_times['start_time'].transform(seconds_since_zero)
+    trip_times = trip_times.merge(trips_extended[['trip_id', 'service_id'] + ROUTE_DIRECTION], how='left', on='trip_id')
 
-    # calculate deltas
-    trip_start_times.sort_values(['route_id', 'direction_id', 'start_time_seconds'], inplace=True)
-    trip_start_times['delta_seconds'] = trip_start_times['start_time_seconds'].diff()
-    first_trip_in_route_dir = (trip_start_times['route_id'] != trip_start_times['route_id'].shift(1)) \
-        | ( \
-            (trip_start_times['direction_id'] != '') \
-            & (trip_start_times['direction_id'] != trip_start_times['direction_id'].shift(1)) \
-        )
+    return trip_times[ROUTE_DIRECTION + ['service_id', 'start_time_seconds', 'end_time_seconds']]
 
-    trip_start_times.loc[first_trip_in_route_dir, 'delta_seconds'] = np.nan
+def assign_trips_to_time_ranges(trip_times, time_ranges):
+    # trip_times: df with start_time_seconds and end_time_seconds (see get_trip_times)
+    # returns trip_times with a row for each time range each trip is wholly within (inclusive),
+    # with the range's position in time_ranges as time_range. All trips are in range 0 if time_ranges is None
 
-    route_avg_headway_minutes = trip_start_times \
-        .groupby(['route_id', 'direction_id'])['delta_seconds'].mean() \
-        .fillna(0) \
-        .transform(lambda x: np.round(x / 60, decimals=3)) \
-        .rename('average_headway_minutes')
+    if not time_ranges:
+        return trip_times.assign(time_range=0)
 
-    route_trip_starts_list = trip_start_times.groupby(['route_id', 'direction_id'])['start_time'].apply(list) \
-        .rename('trip_start_times')
+    starts = trip_times['start_time_seconds'].to_numpy(dtype=np.float64, na_value=np.nan)
+    ends = trip_times['end_time_seconds'].to_numpy(dtype=np.float64, na_value=np.nan)
+    range_starts = np.array([seconds_since_zero(time_range['start']) for time_range in time_ranges])
+    range_ends = np.array([seconds_since_zero(time_range['end']) for time_range in time_ranges])
 
-    output['average_headway_minutes'] = route_avg_headway_minutes
-    output = output.merge(route_trip_starts_list, how='left', left_index=True, right_index=True)
+    # trips starting in each range are consecutive when sorted by start (missing starts sort last)
+    order = np.argsort(starts, kind='stable')
+    sorted_starts = starts[order]
+    first = np.searchsorted(sorted_starts, range_starts, side='left')
+    last = np.searchsorted(sorted_starts, range_ends, side='right')
+    trips_per_range = np.maximum(last - first, 0)
 
-    # fill empty trip start times with empty list
-    output['trip_start_times'] = output['trip_start_times'].apply(lambda d: d if isinstance(d, list) else [])
+    range_positions = np.repeat(np.arange(len(time_ranges)), trips_per_range)
+    range_offsets = np.repeat(np.cumsum(trips_per_range) - trips_per_range, trips_per_range)
+    rows = order[np.repeat(first, trips_per_range) + np.arange(len(range_positions)) - range_offsets]
 
-    return output.reset_index()
+    # of those, keep trips also ending in range
+    wholly_within = ends[rows] <= range_ends[range_positions]
 
+    return trip_times.iloc[rows[wholly_within]].assign(time_range=range_positions[wholly_within])
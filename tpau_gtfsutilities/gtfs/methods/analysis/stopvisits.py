@@ -3,8 +3,12 @@ import numpy as np
 
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs as gtfs_singleton
 from tpau_gtfsutilities.config.utilityoutput import utilityoutput
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
 from tpau_gtfsutilities.gtfs.methods.helpers import triphelpers
-from tpau_gtfsutilities.gtfs.methods.helpers.calendarhelpers import GTFSServiceCalendar
+from tpau_gtfsutilities.gtfs.methods.helpers.calendarhelpers import get_service_activity
+
+# columns of get_service_stop_visits, summed by the others
+SERVICE_STOP_VISITS_COLUMNS = ['route_id', 'stop_id', 'agency_id', 'service_id', 'trip_visits']
 
 def calculate_stop_visits(gtfs_override=None):
     # For each stop, comma separated values, CR/LF for new stop/row
@@ -25,48 +29,71 @@ def calculate_stop_visits(gtfs_override=None):
 
     return stops_report
 
-def calculate_stop_visits(gtfs_override=None):
-    # use original so report includes stops that have been filtered by polygon or date/time
+@utilityprofile.profiled('calculate_stop_visits')
+def calculate_stop_visits(gtfs_override=None, date_ranges=None, include_zero_visits=False):
+    # date_ranges: list of date ranges ({ start, end }), to report visits on the days in each
+    # (one after another, with start_date and end_date columns) from the same feed.
+    # If None, visits are counted on all days in the feed
+    # include_zero_visits: also report route and stop pairs served in the original feed
+    # without visits (i.e. filtered by polygon or date/time), with visit counts of 0
     
     gtfs = gtfs_override if gtfs_override else gtfs_singleton
 
+    # visits on each service, so counting visits within a date range only needs its active days
+    service_stop_visits = get_service_stop_visits(gtfs_override=gtfs)
+    service_activity = get_service_activity(gtfs_override=gtfs)
+    route_stops = get_route_stops(gtfs_override=gtfs) if include_zero_visits else None
+
+    if date_ranges is None:
+        stop_trip_counts = get_stop_visit_counts(service_stop_visits, service_activity.num_active_days())
+        return get_stop_visits_report(stop_trip_counts, route_stops=route_stops, gtfs_override=gtfs)
+
+    reports = []
+    for date_range in date_ranges:
+        service_active_days = service_activity.num_active_days(date_range['start'], date_range['end'])
+        stop_trip_counts = get_stop_visit_counts(service_stop_visits, service_active_days)
+
+        report = get_stop_visits_report(stop_trip_counts, route_stops=route_stops, gtfs_override=gtfs)
+        report['start_date'] = date_range['start']
+        report['end_date'] = date_range['end']
+        reports.append(report)
+
+    return pd.concat(reports)
+
+def get_stop_visits_report(stop_trip_counts, route_stops=None, gtfs_override=None):
+    # stop_trip_counts: visit counts for route and stop pairs (see get_stop_visit_counts)
+    # route_stops: route and stop pairs to also report if they have no visits (see get_route_stops)
+    # returns report with a row for each route and stop pair with visits (and route_stops)
+    # use original so report includes stops that have been filtered by polygon or date/time
+
+    gtfs = gtfs_override if gtfs_override else gtfs_singleton
+
     stops = gtfs.get_table('stops', original=True)
     stops = stops[['stop_name', 'stop_lat', 'stop_lon']]
 
-    stop_trip_counts = get_stop_visit_counts(gtfs_override=gtfs)
-
-    # left join visits against all route/stop pairs
-    routes = gtfs.get_table('routes', original=True).reset_index()
+    routes = gtfs.get_table('routes', original=True, view=True)
 
-    # for building cross product
-    stops['_key'] = 1
-    routes['_key'] = 1
+    # only pairs with visits, rather than every route and stop
+    stop_trip_counts = stop_trip_counts.reset_index()
+    stop_trip_counts = stop_trip_counts[stop_trip_counts['visit_counts'] > 0]
+    stop_trip_counts = stop_trip_counts[['route_id', 'stop_id', 'visit_counts']] \
+        .astype({'route_id': object, 'stop_id': object})
 
-    route_stops = routes.merge( \
-        stops.reset_index(),
-        on='_key'
-    ) \
-        .set_index(['route_id', 'stop_id'])
-    
-    route_stops = route_stops.drop(route_stops.columns, 1) # just keep the index
+    if route_stops is not None:
+        visited = pd.MultiIndex.from_frame(stop_trip_counts[['route_id', 'stop_id']])
+        unvisited = route_stops[~pd.MultiIndex.from_frame(route_stops).isin(visited)]
+        stop_trip_counts = pd.concat([stop_trip_counts, unvisited.assign(visit_counts=0)])
 
-    stop_trip_counts = route_stops.merge( \
-        stop_trip_counts,
-        how='left',
-        left_index=True,
-        right_index=True
-    ) \
-        .fillna(0) \
+    # routes and stops in the feed
+    stop_trip_counts = stop_trip_counts[stop_trip_counts['route_id'].isin(routes.index)] \
         .astype({'visit_counts': 'int32'})
 
-    stops = stops.merge(stop_trip_counts.reset_index(), \
-        how='left', \
-        left_index=True, \
-        right_on='stop_id' \
+    stops = stop_trip_counts.merge(stops, \
+        how='inner', \
+        left_on='stop_id', \
+        right_index=True \
     ) \
-        .fillna(0) \
-        .astype({'visit_counts': 'int32'})
-
+        .set_index(['route_id', 'stop_id'])
 
     # service date is included here because board/alight information isn't useful if 
     # it is not known to be within specified daterange
@@ -74,7 +101,7 @@ def calculate_stop_visits(gtfs_override=None):
 
     if gtfs.has_table('board_alight') and all(col in gtfs.get_columns('board_alight') for col in necessary_board_alight_cols):
         board_alight = gtfs.get_table('board_alight').reset_index()
-        trip_routes = gtfs.get_table('trips', column='route_id')
+        trip_routes = gtfs.get_table('trips', column='route_id', view=True)
         board_alight = board_alight.merge(trip_routes, how=left, left_on='trip_id', right_index=True)
         stop_boardings = board_alight[['route_id', 'stop_id', 'boardings']].groupby(['route_id', 'stop_id']).sum()
         stop_alightings = board_alight[['route_id', 'stop_id', 'alightings']].groupby(['route_id', 'stop_id']).sum()
@@ -93,7 +120,7 @@ def calculate_stop_visits(gtfs_override=None):
         stops['alightings'] = 'N/A'
 
     # add agency info (id already included if multifeed)
-    agency = gtfs.get_table('agency')
+    agency = gtfs.get_table('agency', view=True)
     agency_row = agency.iloc[0]
     stops['agency_name'] = agency_row['agency_name']
     if 'agency_id' in agency.columns:
@@ -116,87 +143,112 @@ def calculate_stop_visits(gtfs_override=None):
 
     return stops_report.sort_values(by=['agency_id', 'route_id', 'stop_id'])
 
-def get_stop_visit_counts(gtfs_override=None):
-    # get visit counts for route and stop pairs as series
+def get_route_stops(gtfs_override=None):
+    # returns df of the distinct route_id and stop_id pairs served by trips in the original feed
+    # (from stop_times, so only pairs that can have visits rather than every route and stop)
+
+    gtfs = gtfs_override if gtfs_override else gtfs_singleton
+
+    trip_routes = gtfs.get_table('trips', original=True, column='route_id', view=True)
+
+    columns = ['trip_id', 'stop_id']
+    if gtfs.is_chunked('stop_times'):
+        chunks = gtfs.get_chunked_table('stop_times').get_chunks(columns=columns, original=True)
+    else:
+        chunks = [gtfs.get_table('stop_times', original=True, view=True)[columns]]
+
+    route_stops = [get_stop_times_route_stops(chunk, trip_routes) for chunk in chunks]
+    if not len(route_stops):
+        return pd.DataFrame(columns=['route_id', 'stop_id'])
+
+    return pd.concat(route_stops).drop_duplicates()
+
+def get_stop_times_route_stops(stop_times, trip_routes):
+    # stop_times: trip_id and stop_id of stop_times rows, trip_routes: route_id by trip_id
+    # returns distinct route_id and stop_id pairs of stop_times rows
+    route_stops = pd.DataFrame({
+        'route_id': triphelpers.lookup_by_trip(trip_routes, stop_times['trip_id']).to_numpy(),
+        'stop_id': np.asarray(stop_times['stop_id'], dtype=object),
+    })
+    return route_stops.dropna().drop_duplicates()
+
+def get_service_stop_visits(gtfs_override=None):
+    # returns df of trip visits to route and stop pairs on a single day of each service
+    #   columns: route_id, stop_id, agency_id, service_id, trip_visits
 
     gtfs = gtfs_override if gtfs_override else gtfs_singleton
 
-    trip_actual_scheduled_stops = gtfs.get_table('stop_times')[['trip_id', 'stop_id']]
+    repeating_trip_counts = triphelpers.get_frequency_trip_counts(gtfs_override=gtfs) \
+        if gtfs.has_table('frequencies') else None
+    trip_services = gtfs.get_table('trips', column='service_id', view=True)
+    trips = triphelpers.get_trips_extended(gtfs_override=gtfs, original=True)[['agency_id', 'route_id']]
+
+    columns = ['trip_id', 'stop_id']
+    if not gtfs.is_chunked('stop_times'):
+        return sum_service_stop_visits( \
+            gtfs.get_table('stop_times', view=True)[columns], \
+            gtfs.get_table('stop_times', original=True, view=True)[columns], \
+            repeating_trip_counts, trip_services, trips \
+        )
+
+    # chunks have whole trips, so visits summed within each chunk are summed again across them
+    chunk_visits = [sum_service_stop_visits(chunk[columns], original[columns], repeating_trip_counts, trip_services, trips) \
+        for original, chunk in gtfs.get_chunked_table('stop_times').get_chunk_pairs(columns=columns)]
+    if not len(chunk_visits):
+        return pd.DataFrame(columns=SERVICE_STOP_VISITS_COLUMNS)
+
+    return pd.concat(chunk_visits) \
+        .groupby(SERVICE_STOP_VISITS_COLUMNS[:-1], observed=True).sum().reset_index()
+
+def sum_service_stop_visits(stop_times, original_stop_times, repeating_trip_counts, trip_services, trips):
+    # stop_times, original_stop_times: trip_id and stop_id of stop_times rows, for the same trips
+    # repeating_trip_counts: see get_frequency_trip_counts (None if no frequencies)
+    # trip_services: service_id by trip_id, trips: agency_id and route_id by trip_id
+    # returns trip visits to route and stop pairs on a single day of each service (see get_service_stop_visits)
+
+    trip_actual_scheduled_stops = stop_times.copy()
     trip_actual_scheduled_stops['visits'] = 1
 
-    trip_scheduled_stops = gtfs.get_table('stop_times', original=True)[['trip_id', 'stop_id']]
-    trip_scheduled_stops = trip_scheduled_stops.merge( \
+    trip_scheduled_stops = original_stop_times.merge( \
         trip_actual_scheduled_stops,
         how='left',
         on=['trip_id', 'stop_id']
     ).fillna(0)
 
-    has_frequencies = gtfs.has_table('frequencies')
-    if has_frequencies:
-        unwrapped_repeating_trips = triphelpers.get_unwrapped_repeating_trips(gtfs_override=gtfs)
-        repeating_trip_counts = unwrapped_repeating_trips['trip_id'].value_counts().rename('trip_counts')
-        trip_scheduled_stops = trip_scheduled_stops.merge( \
-            repeating_trip_counts.to_frame(), \
-            how='left', \
-            left_on='trip_id', \
-            right_index=True \
-        ) \
-        .fillna(1) \
-        .astype({'trip_counts': 'int32'})
+    # trip counts, service_id and route_id are looked up by trip_id rather than merged, so a
+    # chunk's trips are found without hashing every trip in the feed
+    trip_ids = trip_scheduled_stops['trip_id']
+    lookup = lambda df: triphelpers.lookup_by_trip(df, trip_ids).set_axis(trip_scheduled_stops.index, axis=0)
+
+    if repeating_trip_counts is not None:
+        trip_scheduled_stops['trip_counts'] = lookup(repeating_trip_counts).fillna(1).astype('int32')
     else:
         # single trips have a trip_count of 1
         trip_scheduled_stops['trip_counts'] = 1
 
-    trip_service_counts = get_trip_service_counts(gtfs_override=gtfs)
-
-    trip_scheduled_stops_with_service = trip_scheduled_stops.merge( \
-        trip_service_counts.rename('active_days').to_frame(), \
-        how='left', \
-        left_on='trip_id', \
-        right_index=True \
-    )
+    trip_scheduled_stops['trip_visits'] = trip_scheduled_stops['visits'] * trip_scheduled_stops['trip_counts']
 
-    trip_scheduled_stops_with_service['service_trips'] = \
-        trip_scheduled_stops_with_service['visits'] * trip_scheduled_stops_with_service['trip_counts'] * trip_scheduled_stops_with_service['active_days']
+    # add service_id (trips no longer in the feed have none, so no visits)
+    trip_scheduled_stops['service_id'] = lookup(trip_services)
 
     # add route_id
-    trips = triphelpers.get_trips_extended(gtfs_override=gtfs, original=True)[['agency_id', 'route_id']]
+    trip_scheduled_stops = trip_scheduled_stops.join(lookup(trips))
 
-    trip_scheduled_stops_with_service = trip_scheduled_stops_with_service.merge( \
-        trips, \
-        how='left', \
-        left_on='trip_id', \
-        right_index=True \
-    )
-
-    cols = ['route_id', 'stop_id', 'service_trips', 'agency_id']
-    groupby_cols = ['route_id', 'stop_id', 'agency_id']
+    return trip_scheduled_stops[SERVICE_STOP_VISITS_COLUMNS] \
+        .groupby(SERVICE_STOP_VISITS_COLUMNS[:-1], observed=True).sum().reset_index()
 
-    stop_service_counts = trip_scheduled_stops_with_service[cols].groupby(groupby_cols).sum()
+def get_stop_visit_counts(service_stop_visits, service_active_days):
+    # service_stop_visits: see get_service_stop_visits
+    # service_active_days: series of number of active days by service_id
+    # returns visit counts for route and stop pairs, over the active days of each service
 
-    return stop_service_counts.rename(columns={'service_trips':'visit_counts'})
-
-
-def get_trip_service_counts(gtfs_override=None):
-    # Returns a series with the number of service days each trip has
-
-    gtfs = gtfs_override if gtfs_override else gtfs_singleton
+    groupby_cols = ['route_id', 'stop_id', 'agency_id']
 
-    trips_extended = triphelpers.get_trips_extended(gtfs_override=gtfs)
-    calendar = gtfs.get_table('calendar').reset_index()
+    service_trips = service_stop_visits['trip_visits'] \
+        * service_stop_visits['service_id'].map(service_active_days)
 
+    stop_service_counts = service_trips.groupby( \
+        [service_stop_visits[col] for col in groupby_cols], observed=True \
+    ).sum()
 
-    calendar_active_days = calendar['service_id'].to_frame().reset_index()
-    
-    calendar_active_days['active_days'] = calendar_active_days['service_id'].apply(lambda id: \
-        GTFSServiceCalendar(id, gtfs_override=gtfs).num_active_days() \
-    )
-
-    # https://stackoverflow.com/questions/11976503/how-to-keep-index-when-using-pandas-merge
-    trips_extended = trips_extended.reset_index().merge( \
-        calendar_active_days, \
-        how='left', \
-        on='service_id' \
-    ).set_index('trip_id').drop_duplicates()
-
-    return trips_extended['active_days']
\ No newline at end of file
+    return stop_service_counts.to_frame('visit_counts')
@@ -2,10 +2,12 @@ import numpy as np
 import pandas as pd
 import geopandas as gpd
 
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
 from tpau_gtfsutilities.gtfs.gtfscollectionsingleton import gtfs_collection
 from tpau_gtfsutilities.gtfs.methods.helpers.triphelpers import get_trips_extended
 from tpau_gtfsutilities.gtfs.methods.analysis.stopvisits import calculate_stop_visits
 
+@utilityprofile.profiled('cluster_stops')
 def cluster_stops(radius):
     clusters = get_clusters(radius)
 
@@ -62,11 +64,6 @@ def get_clusters(radius):
     stops_gdf = stops_gdf.to_crs(epsg=2992)
      
     radius_in_feet = float(radius) * 5280
-    stops_gdf['buffer'] = stops_gdf['geometry'].buffer(radius_in_feet)
-
-    # will populate with stop to cluster into, if any
-    stops_gdf['cluster_stop_id'] = np.nan
-    stops_gdf['dist'] = np.nan
 
     # cluster to premium mode stops first with priority to: 1. lift, 2. rail and 3. tram
     stop_modes = gtfs_collection.get_combined_computed_table(get_stop_modes)
@@ -77,34 +74,72 @@ def get_clusters(radius):
         right_on=['stop_id', 'feed']
     )
 
-    stops_gdf = sort_stops_by_visits(stops_gdf)
-
-    lift_stops = stops_gdf[stops_gdf['lift']]
-    rail_stops = stops_gdf[stops_gdf['rail']]
-    tram_stops = stops_gdf[stops_gdf['tram']]
-    stops_gdf['not_premium'] = stops_gdf.apply(lambda row: (not row['tram'] and not row['lift'] and not row['rail']), axis=1)
-    other_stops = stops_gdf[stops_gdf['not_premium']]
-
-    def cluster_nearby_stops(stops_slice):
-        # could probably be faster to compute in df rather than iterating 
-
-        for cand_idx, cand in stops_slice.iterrows():
-            for stop_idx, stop in stops_gdf.iterrows():
-                not_clustered = type(cand['cluster_stop_id']) == float and np.isnan(cand['cluster_stop_id'])
-                cand_available = cand['stop_id'] != stop['stop_id'] and not_clustered
-                if cand['stop_id'] != stop['stop_id'] and cand_available and not_clustered and cand['buffer'].contains(stop['geometry']):
-                    stops_gdf.loc[cand_idx, 'cluster_stop_id'] = cand['stop_id']
-                    stops_gdf.loc[stop_idx, 'cluster_stop_id'] = cand['stop_id']
-                    stops_gdf.loc[cand_idx, 'cluster_feed'] = cand['feed']
-                    stops_gdf.loc[stop_idx, 'cluster_feed'] = cand['feed']
-    
-    cluster_nearby_stops(lift_stops)
-    cluster_nearby_stops(rail_stops)
-    cluster_nearby_stops(tram_stops)
-    cluster_nearby_stops(other_stops)
+    stops_gdf = sort_stops_by_visits(stops_gdf).reset_index(drop=True)
+
+    not_premium = ~(stops_gdf['tram'] | stops_gdf['lift'] | stops_gdf['rail'])
+
+    # positions of stops in the order they cluster nearby stops. A stop is a candidate
+    # once for each of its slices (i.e. both lift and rail)
+    candidates = np.concatenate([ \
+        np.flatnonzero(stops_gdf['lift']),
+        np.flatnonzero(stops_gdf['rail']),
+        np.flatnonzero(stops_gdf['tram']),
+        np.flatnonzero(not_premium),
+    ])
+
+    clustered_to = cluster_nearby_stops(stops_gdf, candidates, radius_in_feet)
+    clustered = clustered_to >= 0
+
+    # will populate with stop to cluster into, if any
+    stops_gdf['cluster_stop_id'] = np.nan
+    stops_gdf['cluster_feed'] = np.nan
+    stops_gdf.loc[clustered, 'cluster_stop_id'] = stops_gdf['stop_id'].to_numpy()[clustered_to[clustered]]
+    stops_gdf.loc[clustered, 'cluster_feed'] = stops_gdf['feed'].to_numpy()[clustered_to[clustered]]
 
     return stops_gdf[['feed', 'stop_id', 'cluster_stop_id', 'cluster_feed']].set_index(['feed', 'stop_id'])
 
+def cluster_nearby_stops(stops_gdf, candidates, radius_in_feet):
+    # stops_gdf: projected stops (in feet) with stop_id
+    # candidates: positions of stops in stops_gdf, in the order they cluster nearby stops
+    # returns array with the position of the stop each stop clusters to, or -1 if not clustered
+    #
+    # Each candidate clusters every stop within radius that has a different stop_id, and itself
+    # if there are any. Later candidates take over stops clustered by earlier ones, so each stop
+    # goes to the last candidate that reaches it. Stops within radius are found with a spatial
+    # join against the same buffers as checking each pair, so results are the same
+
+    buffers = gpd.GeoDataFrame( \
+        { 'candidate': np.arange(len(candidates)) },
+        geometry=stops_gdf.geometry.iloc[candidates].buffer(radius_in_feet).values,
+        crs=stops_gdf.crs
+    )
+    points = gpd.GeoDataFrame( \
+        { 'stop': np.arange(len(stops_gdf)) },
+        geometry=stops_gdf.geometry.values,
+        crs=stops_gdf.crs
+    )
+
+    nearby = gpd.sjoin(buffers, points, how='inner', predicate='contains')
+    nearby_candidates = nearby['candidate'].to_numpy()
+    nearby_stops = nearby['stop'].to_numpy()
+
+    stop_ids = stops_gdf['stop_id'].to_numpy()
+    other_stop = stop_ids[candidates[nearby_candidates]] != stop_ids[nearby_stops]
+    nearby_candidates = nearby_candidates[other_stop]
+    nearby_stops = nearby_stops[other_stop]
+
+    clustering_candidates = np.unique(nearby_candidates)
+    claims = pd.DataFrame({ \
+        'candidate': np.concatenate([nearby_candidates, clustering_candidates]),
+        'stop': np.concatenate([nearby_stops, candidates[clustering_candidates]]),
+    })
+    last_claims = claims.groupby('stop')['candidate'].max()
+
+    clustered_to = np.full(len(stops_gdf), -1)
+    clustered_to[last_claims.index.to_numpy()] = candidates[last_claims.to_numpy()]
+
+    return clustered_to
+
 def sort_stops_by_visits(stops_df):
 
     stop_visits = gtfs_collection.get_combined_computed_table(lambda gtfs: calculate_stop_visits(gtfs_override=gtfs))
@@ -118,6 +153,8 @@ def sort_stops_by_visits(stops_df):
         left_on=['feed','stop_id'],
         right_index=True
     )
+    # stops without visits aren't in the report
+    stops_df['visit_counts'] = stops_df['visit_counts'].fillna(0).astype(stop_visits['visit_counts'].dtype)
 
     stops_df = stops_df.sort_values(by=['visit_counts'])
 
@@ -127,7 +164,7 @@ def sort_stops_by_visits(stops_df):
 def get_stop_modes(gtfs):
     # returns df of stop mode usage for tram, rail and lift
 
-    trip_scheduled_stops = gtfs.get_table('stop_times')[['trip_id', 'stop_id', 'arrival_time', 'departure_time']]
+    trip_scheduled_stops = gtfs.get_table('stop_times', view=True)[['trip_id', 'stop_id', 'arrival_time', 'departure_time']]
     trip_stop_pairs = trip_scheduled_stops[['trip_id', 'stop_id']]
 
     trips_extended = get_trips_extended(gtfs_override=gtfs)
@@ -142,7 +179,7 @@ def get_stop_modes(gtfs):
     )
 
     stop_mode_list = trip_stop_pairs[['stop_id', 'route_type']].drop_duplicates() \
-        .groupby('stop_id')['route_type'] \
+        .groupby('stop_id', observed=True)['route_type'] \
         .agg(list) \
         .rename('modes')
 
@@ -193,7 +230,7 @@ def remove_clustered_stops_from_stops(gtfs, feed, cluster_taps):
     clustered_stops = cluster_taps.dropna().reset_index()
     clustered_stops = clustered_stops[clustered_stops['feed'] == feed]
 
-    stops = gtfs.get_table('stops', index=False)
+    stops = gtfs.get_table('stops', index=False, view=True)
     stops_clustered_removed = stops[~stops['stop_id'].isin(clustered_stops['stop_id'])]
 
     gtfs.update_table('stops', stops_clustered_removed)
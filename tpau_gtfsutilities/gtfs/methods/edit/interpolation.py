@@ -1,104 +1,179 @@
 import numpy as np
+import pandas as pd
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
-from tpau_gtfsutilities.helpers.datetimehelpers import seconds_since_zero, seconds_to_military
+from tpau_gtfsutilities.helpers.datetimecolumns import SECONDS_DTYPE
 
-def interpolate_stop_times():
-    # returns false if interpolation not possible
+# stop_times rows interpolated at a time (chunks are split between trips), to bound the
+# memory used by intermediate arrays on large feeds
+INTERPOLATION_CHUNK_ROWS = 1000000
 
-    stop_times = gtfs.get_table('stop_times')
-    shapes = gtfs.get_table('shapes')
+# distances used for trips without shape_dist_traveled, if configured
+DISTANCE_FALLBACKS = ['stop_sequence', 'great_circle']
 
-    no_shape_dist_traveled = 'shape_dist_traveled' not in stop_times.columns \
-        or stop_times['shape_dist_traveled'].isna().all()
+EARTH_RADIUS_METERS = 6371008.8
 
-    no_shapes_txt = not gtfs.has_table('shapes') or shapes.empty
+@utilityprofile.profiled('interpolate_stop_times')
+def interpolate_stop_times(distance_fallback=None):
+    # fills in missing arrival/departure times between the timepoints (stops with times) before
+    # and after them in each trip, in proportion to shape_dist_traveled.
+    # distance_fallback ('stop_sequence' or 'great_circle') is used instead for trips missing
+    # shape_dist_traveled, or all trips if the feed has no shapes
+    # returns false if interpolation not possible
 
-    if (no_shape_dist_traveled or no_shapes_txt):
-        return False
+    if distance_fallback and distance_fallback not in DISTANCE_FALLBACKS:
+        raise ValueError('distance fallback must be one of ' + ', '.join(DISTANCE_FALLBACKS))
 
-    # build table with chunk information
+    if gtfs.is_chunked('stop_times'):
+        return interpolate_stop_times_in_chunks(distance_fallback=distance_fallback)
 
-    df = stop_times.copy()
-    df['has_arrival'] = df['arrival_time'].notna()
-    df['has_departure'] = df['departure_time'].notna()
+    stop_times = gtfs.get_table('stop_times', index=False, view=True)
 
-    df = df[df['has_arrival'] | df['has_departure']]
-    timepoints_only = df[df['has_arrival'] | df['has_departure']]
+    has_shape_dist_traveled = 'shape_dist_traveled' in stop_times.columns \
+        and stop_times['shape_dist_traveled'].notna().any() \
+        and gtfs.has_table('shapes')
 
-    # https://stackoverflow.com/questions/50411098/how-to-do-forward-rolling-sum-in-pandas
-    df['next_stop_sequence'] = timepoints_only.sort_values(by=['trip_id', 'stop_sequence']) \
-        .iloc[::-1] \
-        .groupby('trip_id')['stop_sequence'].transform(lambda x: x.rolling(2).max()) \
-        .iloc[::-1] \
+    if not (has_shape_dist_traveled or distance_fallback):
+        return False
 
-    # cleanup
-    df['next_stop_sequence'] = df['next_stop_sequence'].fillna(df['stop_sequence']).astype('int64')
+    stop_times = get_interpolated_stop_times(stop_times, has_shape_dist_traveled, distance_fallback)
+    gtfs.update_table('stop_times', stop_times, cascade=False)
 
-    df['stop_sequence_list'] = df.apply(lambda row: \
-        list(range(row['stop_sequence'], row['next_stop_sequence']) \
-        if row['stop_sequence'] != row['next_stop_sequence'] \
-        else [row['stop_sequence']] \
-    ), axis=1)
+    return True
 
-    df = df.explode('stop_sequence_list')
-    df = df.rename(columns={'stop_sequence': 'start_seq', 'next_stop_sequence': 'end_seq', 'stop_sequence_list': 'stop_sequence'})
+def interpolate_stop_times_in_chunks(distance_fallback=None):
+    # interpolates stop_times read in chunks (see interpolate_stop_times). Chunks have whole trips,
+    # so each is interpolated as it is read
 
-    chunks = df.set_index(['trip_id', 'stop_sequence']) \
-        [['start_seq', 'end_seq']]
+    stop_times = gtfs.get_chunked_table('stop_times')
+    has_shape_dist_traveled = gtfs.table_has_column('stop_times', 'shape_dist_traveled') \
+        and gtfs.has_table('shapes') \
+        and any(chunk['shape_dist_traveled'].notna().any() \
+            for chunk in stop_times.get_chunks(columns=['shape_dist_traveled']))
 
+    if not (has_shape_dist_traveled or distance_fallback):
+        return False
 
-    stop_times = stop_times.set_index(['trip_id', 'stop_sequence'])
-    stop_times = stop_times.merge(chunks, \
-        how='left',
-        right_index=True,
-        left_index=True,
+    stop_times.add_transform( \
+        lambda stop_times: get_interpolated_stop_times(stop_times, has_shape_dist_traveled, distance_fallback), \
+        cascade=False \
     )
 
-    start_time = stop_times['departure_time'].rename('start_time')
-    end_time = stop_times['arrival_time'].rename('end_time')
-    start_sdt = stop_times['shape_dist_traveled'].rename('start_sdt')
-    end_sdt = stop_times['shape_dist_traveled'].rename('end_sdt')
-
-    stop_times = stop_times.merge(start_time, \
-        left_on=['trip_id', 'start_seq'],
-        right_index=True
-    )
-    
-    stop_times = stop_times.merge(end_time, \
-        left_on=['trip_id', 'end_seq'],
-        right_index=True
-    )
-    
-    stop_times = stop_times.merge(start_sdt, \
-        left_on=['trip_id', 'start_seq'],
-        right_index=True
-    )
-    
-    stop_times = stop_times.merge(end_sdt, \
-        left_on=['trip_id', 'end_seq'],
-        right_index=True
+    return True
+
+def get_interpolated_stop_times(stop_times, has_shape_dist_traveled, distance_fallback=None):
+    # returns stop_times (of whole trips) with missing times interpolated (see interpolate_stop_times)
+
+    # sort by trip then stop_sequence, so each trip's stops are consecutive and in order
+    trip_codes = stop_times['trip_id'].astype('category').cat.codes.to_numpy()
+    stop_sequences = stop_times['stop_sequence'].to_numpy()
+    order = np.lexsort((stop_sequences, trip_codes))
+    trip_codes = trip_codes[order]
+
+    arrivals = stop_times['arrival_time'].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+    departures = stop_times['departure_time'].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+
+    if has_shape_dist_traveled:
+        distances = stop_times['shape_dist_traveled'].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+    else:
+        distances = np.full(len(order), np.nan)
+
+    if distance_fallback:
+        # trips with any stop missing shape_dist_traveled use fallback distances throughout
+        use_fallback = pd.Series(np.isnan(distances)).groupby(trip_codes).transform('any').to_numpy()
+        if use_fallback.any():
+            fallback_distances = get_fallback_distances(stop_times, order, trip_codes, distance_fallback)
+            distances = np.where(use_fallback, fallback_distances, distances)
+
+    interpolated_arrivals = np.empty(len(order))
+    interpolated_departures = np.empty(len(order))
+    for chunk in get_trip_chunks(trip_codes, INTERPOLATION_CHUNK_ROWS):
+        interpolated_arrivals[chunk], interpolated_departures[chunk] = interpolate_times( \
+            trip_codes[chunk], arrivals[chunk], departures[chunk], distances[chunk])
+
+    # back to stop_times order
+    arrival_times = np.empty(len(order))
+    arrival_times[order] = interpolated_arrivals
+    departure_times = np.empty(len(order))
+    departure_times[order] = interpolated_departures
+
+    return stop_times.assign( \
+        arrival_time=pd.Series(arrival_times, index=stop_times.index).astype(SECONDS_DTYPE),
+        departure_time=pd.Series(departure_times, index=stop_times.index).astype(SECONDS_DTYPE),
     )
 
-    def interpolate_row(row):
-        # happens if last stop or on 1-stop chunks (consecutive timepoints)
-        if (row['start_time'] == row['end_time']):
-            return row['start_time']
-
-        return seconds_to_military( \
-            seconds_since_zero(row['start_time']) + \
-                int(round( \
-                    ( \
-                        (row['shape_dist_traveled'] - row['start_sdt']) / (row['end_sdt'] - row['start_sdt']) \
-                    ) * ( \
-                        seconds_since_zero(row['end_time']) - seconds_since_zero(row['start_time']) \
-                    ) \
-                ))
-            )
-
-    stop_times['interp'] = stop_times.apply(lambda row: interpolate_row(row), axis=1)
-    stop_times['arrival_time'] = stop_times['arrival_time'].fillna(stop_times['interp'])
-    stop_times['departure_time'] = stop_times['departure_time'].fillna(stop_times['interp'])
-
-    gtfs.update_table('stop_times', stop_times.reset_index(), cascade=False)
-
-    return True
\ No newline at end of file
+def get_trip_chunks(trip_codes, chunk_rows):
+    # trip_codes: sorted array of trip codes by row
+    # returns slices of about chunk_rows rows (more if a single trip is longer), split between trips
+
+    trip_starts = np.flatnonzero(np.diff(trip_codes)) + 1
+    chunks = []
+    start = 0
+    while start < len(trip_codes):
+        # the first trip start at least chunk_rows after start, or the end
+        split = np.searchsorted(trip_starts, start + chunk_rows)
+        end = trip_starts[split] if split < len(trip_starts) else len(trip_codes)
+        chunks.append(slice(start, end))
+        start = end
+    return chunks
+
+def interpolate_times(trip_codes, arrivals, departures, distances):
+    # arrays by stop time for whole trips, sorted by trip and stop_sequence (times in seconds, NaN if missing)
+    # returns arrivals and departures with missing times interpolated between the timepoints
+    # before and after them in their trip (still NaN where there isn't one of each, or distances are missing)
+
+    num_rows = len(trip_codes)
+    positions = np.arange(num_rows)
+    timepoint = ~np.isnan(arrivals) | ~np.isnan(departures)
+
+    # position of the timepoint at or before (previous) and at or after (next) each stop time
+    previous = np.maximum.accumulate(np.where(timepoint, positions, -1))
+    following = np.minimum.accumulate(np.where(timepoint, positions, num_rows)[::-1])[::-1]
+    previous_in_trip = (previous >= 0) & (trip_codes[np.maximum(previous, 0)] == trip_codes)
+    following_in_trip = (following < num_rows) & (trip_codes[np.minimum(following, num_rows - 1)] == trip_codes)
+    previous = np.maximum(previous, 0)
+    following = np.minimum(following, num_rows - 1)
+
+    # leave from the previous timepoint, arrive at the next
+    start_times = np.where(np.isnan(departures), arrivals, departures)[previous]
+    end_times = np.where(np.isnan(arrivals), departures, arrivals)[following]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = (distances - distances[previous]) / (distances[following] - distances[previous])
+        interpolated = start_times + np.round(fraction * (end_times - start_times))
+
+    # consecutive timepoints with the same time, or timepoints themselves
+    interpolated = np.where(start_times == end_times, start_times, interpolated)
+    interpolated[~(previous_in_trip & following_in_trip) | ~np.isfinite(interpolated)] = np.nan
+
+    # timepoints missing one of their times use the other
+    interpolated = np.where(timepoint, start_times, interpolated)
+
+    return np.where(np.isnan(arrivals), interpolated, arrivals), \
+        np.where(np.isnan(departures), interpolated, departures)
+
+def get_fallback_distances(stop_times, order, trip_codes, distance_fallback):
+    # returns distance along trip of each stop time (in sorted order, see interpolate_stop_times)
+    # by stop_sequence or by great circle distance between consecutive stops
+
+    if distance_fallback == 'stop_sequence':
+        return stop_times['stop_sequence'].to_numpy(dtype=np.float64)[order]
+
+    stops = gtfs.get_table('stops', view=True)
+    stop_ids = stop_times['stop_id'].astype(object).to_numpy()[order]
+    lats = np.radians(stops['stop_lat'].reindex(stop_ids).to_numpy(dtype=np.float64))
+    lons = np.radians(stops['stop_lon'].reindex(stop_ids).to_numpy(dtype=np.float64))
+
+    # haversine distance from the previous stop, zero at the first stop of each trip
+    step_distances = np.zeros(len(order))
+    if len(order) > 1:
+        a = np.sin(np.diff(lats) / 2) ** 2 \
+            + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(np.diff(lons) / 2) ** 2
+        step_distances[1:] = 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+        step_distances[1:][np.diff(trip_codes) != 0] = 0
+
+    # cumulative distance within each trip
+    cumulative = np.cumsum(step_distances)
+    trip_start_positions = np.flatnonzero(np.r_[True, np.diff(trip_codes) != 0])
+    trip_lengths = np.diff(np.r_[trip_start_positions, len(order)])
+    return cumulative - np.repeat(cumulative[trip_start_positions], trip_lengths)
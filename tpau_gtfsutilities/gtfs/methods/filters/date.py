@@ -1,38 +1,13 @@
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
-from tpau_gtfsutilities.gtfs.methods.helpers.triphelpers import get_trips_extended
-from tpau_gtfsutilities.gtfs.gtfsenums import GTFSBool, GTFSExceptionType
-from tpau_gtfsutilities.helpers.datetimehelpers import GTFSDate
+from tpau_gtfsutilities.gtfs.methods.helpers.calendarhelpers import get_service_activity
 
 def filter_trips_by_date(date):
     # removes trips that do not occur on specified date
     # TODO consider replacing with filter_calendars_by_date, prune
 
-    trips_extended = get_trips_extended()
+    trips = gtfs.get_table('trips', view=True)
 
-    dow = GTFSDate(date).dow()
-
-    date_in_range = (trips_extended['start_date'] <= date) & (date <= trips_extended['end_date'])
-    dow_in_service = trips_extended[dow] == GTFSBool.TRUE
-
-    trips_filter = date_in_range & dow_in_service
-    
-    # filter calendar_dates for relevant calendar exceptions
-    if gtfs.has_table('calendar_dates'):
-        calendar_dates = gtfs.get_table('calendar_dates')
-        added_on_date = (calendar_dates['date'] == date) & (calendar_dates['exception_type'] == GTFSExceptionType.ADDED)
-        services_added_on_date = calendar_dates[added_on_date]['service_id']
-
-        removed_on_date = (calendar_dates['date'] == date) & (calendar_dates['exception_type'] == GTFSExceptionType.REMOVED)
-        services_removed_on_date = calendar_dates[removed_on_date]['service_id']
-        service_added_on_date = trips_extended['service_id'].isin(services_added_on_date)
-        service_removed_on_date = trips_extended['service_id'].isin(services_removed_on_date)
-
-        if gtfs.has_table('calendar'):
-            trips_filter = (date_in_range & dow_in_service & ~service_removed_on_date) | service_added_on_date
-        else:
-            trips_filter = service_added_on_date
-
-    trips_filtered_df = trips_extended[trips_filter]
-
-    gtfs.update_table('trips', trips_filtered_df)
+    services_active_on_date = get_service_activity().is_active_on(date)
+    trips_filter = trips['service_id'].map(services_active_on_date).fillna(False).astype(bool)
 
+    gtfs.update_table('trips', trips[trips_filter.to_numpy()])
@@ -1,63 +1,50 @@
 import numpy as np
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
 from tpau_gtfsutilities.gtfs.gtfsenums import GTFSBool
+from tpau_gtfsutilities.gtfs.properties import DOWS
+from tpau_gtfsutilities.gtfs.methods.helpers.calendarhelpers import get_service_activity
 from tpau_gtfsutilities.helpers.datetimehelpers import GTFSDateRange
-from tpau_gtfsutilities.helpers.datetimehelpers import GTFSDate
+from tpau_gtfsutilities.helpers.datetimecolumns import to_day_numbers, day_numbers_to_datestrings
 
 def filter_calendars_by_daterange(daterange):
 
     calendar = gtfs.get_table('calendar')
-    filter_daterange = GTFSDateRange(daterange['start'], daterange['end'])
-
-    calendar['_gtfs_daterange'] = calendar.apply(lambda row: GTFSDateRange(row['start_date'], row['end_date']), axis=1)
-    calendar['_overlap'] = calendar['_gtfs_daterange'].apply(lambda dr: \
-        filter_daterange.get_overlap(dr) \
-    )
-
-    # we want to remove calendar entries that don't overlap DOWs 
-    calendar['_dows_overlap'] = calendar.apply(lambda row: \
-        GTFSBool.TRUE in (row[dow] for dow in filter_daterange.days_of_week()),
-        axis=1
-    )
-    
-    # we want to keep calendar entries that are used in overlapping exceptions 
-    if gtfs.has_table('calendar_dates'):
-        calendar_dates = gtfs.get_table('calendar_dates')
-        calendar_dates['_date_overlap'] = calendar_dates.apply(lambda row: filter_daterange.includes(row['date']), axis=1)
-        calendar_dates = calendar_dates[calendar_dates['_date_overlap']]
-        calendar['_exception_overlap'] = calendar.index.to_series().isin(calendar_dates['service_id'])
-    else:
-        calendar['_exception_overlap'] = False
+    range_start, range_end = to_day_numbers([daterange['start'], daterange['end']])
+
+    # keep calendar entries with service (regular or added by exception) on any day in daterange
+    services_active = get_service_activity().is_active_between(daterange['start'], daterange['end'])
+    calendar = calendar[calendar.index.to_series().map(services_active).fillna(False).astype(bool).to_numpy()]
 
-    calendar = calendar[(calendar['_overlap'].notnull() & calendar['_dows_overlap']) | calendar['_exception_overlap']]
+    # trim bounds to fit within daterange. Entries only active in daterange through exceptions
+    # get no regular service there
+    start_days = np.maximum(to_day_numbers(calendar['start_date']), range_start)
+    end_days = np.minimum(to_day_numbers(calendar['end_date']), range_end)
+    no_overlap = start_days > end_days
+    start_days[no_overlap] = range_start
+    end_days[no_overlap] = range_end
 
-    # trim bounds to fit within daterange
-    calendar['start_date'] = calendar['_overlap'].apply(lambda dr: dr.start.datestring())
-    calendar['end_date'] = calendar['_overlap'].apply(lambda dr: dr.end.datestring())
+    calendar.loc[no_overlap, DOWS] = GTFSBool.FALSE
+    calendar['start_date'] = day_numbers_to_datestrings(start_days)
+    calendar['end_date'] = day_numbers_to_datestrings(end_days)
 
     gtfs.update_table('calendar', calendar)
 
 def filter_calendar_dates_by_daterange(daterange):
     if not gtfs.has_table('calendar_dates'): return
 
-    calendar_dates = gtfs.get_table('calendar_dates')
-    filter_daterange = GTFSDateRange(daterange['start'], daterange['end'])
-
-    calendar_dates['_gtfs_date'] = calendar_dates.apply(lambda row: GTFSDate(row['date']), axis=1)
-    calendar_dates['_inrange'] = calendar_dates.apply(lambda row: filter_daterange.includes(row['date']), axis=1)
-
-    calendar_dates_filtered = calendar_dates[calendar_dates['_inrange']]
+    calendar_dates = gtfs.get_table('calendar_dates', view=True)
+    calendar_dates_filtered = calendar_dates[in_daterange(calendar_dates['date'], daterange)]
 
     gtfs.update_table('calendar_dates', calendar_dates_filtered)
 
 def remove_trips_with_nonexistent_calendars():
-    calendar = gtfs.get_table('calendar', index=False)
+    calendar = gtfs.get_table('calendar', index=False, view=True)
     
-    trips = gtfs.get_table('trips')
+    trips = gtfs.get_table('trips', view=True)
     trips_filtered = trips[trips['service_id'].isin(calendar['service_id'])]
 
     if (gtfs.has_table('frequencies')):
-        frequencies = gtfs.get_table('frequencies')
+        frequencies = gtfs.get_table('frequencies', view=True)
         frequencies_filtered = frequencies[frequencies['trip_id'].isin(trips_filtered.index.to_series())]
         gtfs.update_table('frequencies', frequencies_filtered)
 
@@ -66,16 +53,19 @@ def remove_trips_with_nonexistent_calendars():
 def filter_board_alight_by_daterange(daterange):
     if not gtfs.has_table('board_alight'): return
 
-    board_alight = gtfs.get_table('board_alight', index=False)
+    board_alight = gtfs.get_table('board_alight', index=False, view=True)
     if 'service_date' not in board_alight.columns: return
 
-    filter_daterange = GTFSDateRange(daterange['start'], daterange['end'])
-
-    board_alight['_inrange'] = board_alight.apply(lambda row: filter_daterange.includes(row['service_date']), axis=1)
-    board_alight_filtered = board_alight[board_alight['_inrange']]
+    board_alight_filtered = board_alight[in_daterange(board_alight['service_date'], daterange)]
 
     gtfs.update_table('board_alight', board_alight_filtered)
 
+def in_daterange(dates, daterange):
+    # returns boolean array of whether each of dates ('YYYYMMDD' strings) is within daterange (inclusive)
+    range_start, range_end = to_day_numbers([daterange['start'], daterange['end']])
+    days = to_day_numbers(dates)
+    return (days >= range_start) & (days <= range_end)
+
 def reset_feed_dates(daterange):
     if not gtfs.has_table('feed_info'): return
 
@@ -88,12 +78,12 @@ def reset_feed_dates(daterange):
     gtfs.update_table('feed_info', feed_info)
 
 def get_feed_calendar_service_daterange():
-    calendar = gtfs.get_table('calendar')
+    calendar = gtfs.get_table('calendar', view=True)
     calendar_min_start = calendar['start_date'].min()
     calendar_max_end = calendar['end_date'].max()
     return GTFSDateRange(calendar_min_start, calendar_max_end)
 
 def get_feed_start_end_daterange():
     if not gtfs.has_table('feed_info'): return None
-    feed_info = gtfs.get_table('feed_info')
+    feed_info = gtfs.get_table('feed_info', view=True)
     return GTFSDateRange(feed_info.loc[0, 'feed_start_date'], feed_info.loc[0, 'feed_end_date'])
@@ -1,25 +1,103 @@
+import numpy as np
+import pandas as pd
 import geopandas as gpd
+from shapely.geometry import Point
+from shapely.prepared import prep
 
-from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
+from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs as gtfs_singleton
 
-def filter_stops_by_multipolygon(multipolygon):
+try:
+    # vectorized point in polygon checks (shapely 2), which prepare the polygon
+    from shapely import contains_xy
+except ImportError:
+    contains_xy = None
+
+# above this many stops, regions are found with a spatial join rather than per region
+SJOIN_MIN_STOPS = 10000
+
+def filter_stops_by_multipolygon(multipolygon, gtfs_override=None):
     # Note: this does not clean up the gtfs after removing stops
-    # multipolygon is a shapely MultiPolygon
+    # multipolygon is a shapely (Multi)Polygon
+
+    filter_stops_by_regions(gpd.GeoSeries([multipolygon], crs='EPSG:4326'), gtfs_override=gtfs_override)
+
+def filter_stops_by_regions(regions, gtfs_override=None):
+    # removes stops not within any of regions
+    # regions is a GeoSeries of (multi)polygons in EPSG:4326, indexed by region label
+    # returns series of region label for each remaining stop (by stop_id)
+
+    gtfs = gtfs_override if gtfs_override else gtfs_singleton
+
+    stops = gtfs.get_table('stops', view=True)
+    stop_regions = get_stop_regions(stops, regions)
+
+    gtfs.update_table('stops', stops[stop_regions.notna().to_numpy()])
+
+    return stop_regions.dropna()
+
+def get_stop_regions(stops, regions):
+    # stops: df with stop_lat and stop_lon (i.e. stops table)
+    # regions: GeoSeries of (multi)polygons in EPSG:4326, indexed by region label
+    # returns series with the label of the (first) region containing each stop, NaN if none
 
-    stops = gtfs.get_table('stops')
+    regions = regions.to_crs(epsg=4326)
+    x = stops['stop_lon'].to_numpy(dtype=float)
+    y = stops['stop_lat'].to_numpy(dtype=float)
 
-    stops_gdf = gpd.GeoDataFrame(stops, geometry=gpd.points_from_xy(stops['stop_lon'], stops['stop_lat']), crs='EPSG:4326')
+    if len(stops) >= SJOIN_MIN_STOPS:
+        region_positions = get_region_positions_by_sjoin(x, y, regions)
+    else:
+        region_positions = np.full(len(stops), -1)
+        # in reverse, so stops in overlapping regions go to the first region
+        for position in reversed(range(len(regions))):
+            region_positions[points_in_polygon(regions.iloc[position], x, y)] = position
 
-    stops_in_area = stops_gdf.geometry.transform(lambda g: multipolygon.contains(g)).rename('in_area')
+    labels = np.asarray(regions.index, dtype=object)
+    stop_regions = pd.Series(np.nan, index=stops.index, dtype=object, name='region')
+    in_region = region_positions >= 0
+    stop_regions[in_region] = labels[region_positions[in_region]]
 
-    stops = stops.merge(stops_in_area.to_frame(), \
-        how='left', \
-        left_index=True, \
-        right_index=True \
+    return stop_regions
+
+def points_in_polygon(polygon, x, y):
+    # returns boolean array of whether each point (x, y arrays) is within polygon.
+    # Only points within the polygon's bounding box are checked against the (prepared) polygon
+
+    inside = np.zeros(len(x), dtype=bool)
+    if polygon is None or polygon.is_empty:
+        return inside
+
+    minx, miny, maxx, maxy = polygon.bounds
+    candidates = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+    if not len(candidates):
+        return inside
+
+    if contains_xy is not None:
+        inside[candidates] = contains_xy(polygon, x[candidates], y[candidates])
+    else:
+        prepared = prep(polygon)
+        inside[candidates] = [prepared.contains(Point(px, py)) for px, py in zip(x[candidates], y[candidates])]
+
+    return inside
+
+def get_region_positions_by_sjoin(x, y, regions):
+    # returns position in regions of the first region containing each point, -1 if none
+
+    points = gpd.GeoDataFrame( \
+        { 'point': np.arange(len(x)) },
+        geometry=gpd.points_from_xy(x, y),
+        crs='EPSG:4326'
+    )
+    polygons = gpd.GeoDataFrame( \
+        { 'region': np.arange(len(regions)) },
+        geometry=regions.values,
+        crs='EPSG:4326'
     )
 
-    stops_filtered = stops[stops['in_area']]
+    within = gpd.sjoin(points, polygons, how='inner', predicate='within')
+    first_regions = within.groupby('point')['region'].min()
 
-    gtfs.update_table('stops', stops_filtered)
+    region_positions = np.full(len(x), -1)
+    region_positions[first_regions.index.to_numpy()] = first_regions.to_numpy()
 
-    
\ No newline at end of file
+    return region_positions
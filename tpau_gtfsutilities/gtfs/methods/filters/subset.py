@@ -1,12 +1,19 @@
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
 from tpau_gtfsutilities.gtfs.methods.filters.daterange import filter_calendars_by_daterange, filter_calendar_dates_by_daterange, filter_board_alight_by_daterange, reset_feed_dates
 from tpau_gtfsutilities.gtfs.methods.filters.timerange import filter_single_trips_by_timerange, filter_repeating_trips_by_timerange
 
 def subset_entire_feed(daterange, timerange=None, trim_trips=False):
-    filter_calendars_by_daterange(daterange)
-    filter_calendar_dates_by_daterange(daterange)
-    filter_board_alight_by_daterange(daterange)
+    # each filter's stage counts rows of the tables it filters (cascades have their own stages)
+    with utilityprofile.stage('filter_calendars_by_daterange', count_rows=lambda: gtfs.count_rows(['calendar'])):
+        filter_calendars_by_daterange(daterange)
+    with utilityprofile.stage('filter_calendar_dates_by_daterange', count_rows=lambda: gtfs.count_rows(['calendar_dates'])):
+        filter_calendar_dates_by_daterange(daterange)
+    with utilityprofile.stage('filter_board_alight_by_daterange', count_rows=lambda: gtfs.count_rows(['board_alight'])):
+        filter_board_alight_by_daterange(daterange)
     if timerange and timerange['start'] and timerange['end']:
-        filter_single_trips_by_timerange(timerange, trim_trips=trim_trips)
-        filter_repeating_trips_by_timerange(timerange, trim_trips=trim_trips)
+        with utilityprofile.stage('filter_single_trips_by_timerange', count_rows=lambda: gtfs.count_rows(['trips', 'stop_times'])):
+            filter_single_trips_by_timerange(timerange, trim_trips=trim_trips)
+        with utilityprofile.stage('filter_repeating_trips_by_timerange', count_rows=lambda: gtfs.count_rows(['frequencies', 'trips', 'stop_times'])):
+            filter_repeating_trips_by_timerange(timerange, trim_trips=trim_trips)
     reset_feed_dates(daterange)
\ No newline at end of file
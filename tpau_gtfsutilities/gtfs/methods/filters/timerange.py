@@ -3,7 +3,8 @@ import numpy as np
 from tpau_gtfsutilities.gtfs.methods.helpers import triphelpers
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
 
-from tpau_gtfsutilities.helpers.datetimehelpers import safe_seconds_since_zero, seconds_since_zero, seconds_to_military
+from tpau_gtfsutilities.helpers.datetimehelpers import seconds_since_zero
+from tpau_gtfsutilities.helpers.datetimecolumns import to_seconds_since_zero
 
 def time_range_in_range(start_time_a, end_time_a, start_time_b, end_time_b, wholly_within=True):
     # If wholly_within=True, returns True if range a is completely within range b (inclusive)
@@ -17,265 +18,161 @@ def time_in_range(time, range_start, range_end):
     return (range_start <= time) & (time <= range_end)
 
 def service_in_range(arrival, departure, range_start, range_end):
-    return ((arrival is not None) & time_in_range(arrival, range_start, range_end)) \
-        | ((departure is not None) & time_in_range(departure, range_start, range_end))
-
-def get_long_form_unwrapped_frequencies_inrange_df(time_range):
-
-    unwrapped_repeating_trips = triphelpers.get_unwrapped_repeating_trips()
-    if unwrapped_repeating_trips.empty:
-        return pd.DataFrame()
-    
-    unwrapped_repeating_trips['range_start'] = time_range['start']
-    unwrapped_repeating_trips['range_end'] = time_range['end']
-
-    kwargs_partial = {'partially_in_range' : lambda x: time_range_in_range( \
-        x['trip_start'].transform(seconds_since_zero), \
-        x['trip_end'].transform(seconds_since_zero), \
-        x['range_start'].transform(seconds_since_zero), \
-        x['range_end'].transform(seconds_since_zero), \
-        wholly_within=False \
-    )}
-    
-    kwargs_whole = {'wholly_in_range' : lambda x: time_range_in_range( \
-        x['trip_start'].transform(seconds_since_zero), \
-        x['trip_end'].transform(seconds_since_zero), \
-        x['range_start'].transform(seconds_since_zero), \
-        x['range_end'].transform(seconds_since_zero), \
-        wholly_within=True \
-    )}
-
-    unwrapped_repeating_trips = unwrapped_repeating_trips.assign(**kwargs_partial)
-    unwrapped_repeating_trips = unwrapped_repeating_trips.assign(**kwargs_whole)
-    return unwrapped_repeating_trips
+    # arrival and departure are seconds series, missing values are never in range
+    return (arrival.notna() & time_in_range(arrival, range_start, range_end)) \
+        | (departure.notna() & time_in_range(departure, range_start, range_end))
 
 def filter_repeating_trips_by_timerange(time_range, trim_trips=False):
     # edit start_time and end_time of frequencies partially in range (at least one but not all trips occur in range)
     # edit stop_times for trip if start_time has changed
 
-    unwrapped_long = get_long_form_unwrapped_frequencies_inrange_df(time_range)
+    frequency_blocks = triphelpers.get_frequency_blocks()
 
     # do nothing if no repeating trips
-    if (unwrapped_long.empty):
+    if (frequency_blocks.empty):
         return
 
-    unwrapped_grouped = unwrapped_long.groupby(['frequency_start', 'trip_id'])
-
-    # if trimming trips, we want to keep partially in range trips in trips.txt
-    trip_filter_on = 'partially_in_range' if trim_trips else 'wholly_in_range'
+    range_start = seconds_since_zero(time_range['start'])
+    range_end = seconds_since_zero(time_range['end'])
 
-    # Remove frequencies with no trips in range
-    any_trip_in_frequency_in_range_series = unwrapped_grouped[trip_filter_on].any() \
-            .rename('any_frequency_trip_in_range')
-    unwrapped_long = unwrapped_long \
-        .merge(any_trip_in_frequency_in_range_series.to_frame().reset_index(), on=['frequency_start', 'trip_id'])
-    unwrapped_long = unwrapped_long[unwrapped_long['any_frequency_trip_in_range'] == True] \
-        .drop('any_frequency_trip_in_range', axis='columns')
+    # trips in each block wholly in range are consecutive, from first to last in range
+    first_in_range, last_in_range = triphelpers.get_frequency_trip_orders_in_range( \
+        frequency_blocks, range_start, range_end, wholly_within=True)
+    frequency_blocks = frequency_blocks.assign( \
+        first_trip_order_in_range=first_in_range,
+        last_trip_order_in_range=last_in_range,
+        any_trip_in_range=last_in_range >= first_in_range
+    )
 
-    # Remove trip from trips.txt if trip_id not in any range in frequencies
-    trips_not_in_any_range_whole = unwrapped_long.groupby(['trip_id'])['wholly_in_range'].any()
-    trips_not_in_any_range_whole = trips_not_in_any_range_whole[trips_not_in_any_range_whole == False]
-    trips_not_in_any_range_partial = unwrapped_long.groupby(['trip_id'])['partially_in_range'].any()
-    trips_not_in_any_range_partial = trips_not_in_any_range_partial[trips_not_in_any_range_partial == False]
+    # Remove trip from trips.txt if none of its frequency trips are wholly in range, since
+    # it will have no frequencies left (partially in range trips are kept as single trips if trimming)
+    trips_in_any_range_whole = frequency_blocks.groupby('trip_id')['any_trip_in_range'].any()
+    trips_not_in_any_range_whole = trips_in_any_range_whole[~trips_in_any_range_whole].index.to_series()
 
-    trips_df = gtfs.get_table('trips', index=False)
-    trips_filtered_df = trips_df[~trips_df['trip_id'].isin(trips_not_in_any_range_partial.index.to_series())]
+    trips_df = gtfs.get_table('trips', index=False, view=True)
+    trips_filtered_df = trips_df[~trips_df['trip_id'].isin(trips_not_in_any_range_whole)]
 
     # if trimming, we need to create trimmed single trips for partially-in-range runs
     if trim_trips:
-        partial_trips = unwrapped_long.copy().loc[(unwrapped_long['partially_in_range'] == True) & (unwrapped_long['wholly_in_range'] == False)]
-
-        partial_trips['new_trip_id'] = partial_trips['trip_id'] + '_freq_' + partial_trips['trip_order'].apply(str)
+        first_partial, last_partial = triphelpers.get_frequency_trip_orders_in_range( \
+            frequency_blocks, range_start, range_end, wholly_within=False)
+        partial_trips = triphelpers.unwrap_frequency_blocks(frequency_blocks, first_partial, last_partial)
+        partial_trips = partial_trips[ \
+            (partial_trips['trip_order'] < partial_trips['first_trip_order_in_range']) \
+            | (partial_trips['trip_order'] > partial_trips['last_trip_order_in_range']) \
+        ].copy()
+
+        # trip_order is only unique within a block, so ids include the block's start (in seconds)
+        partial_trips['new_trip_id'] = partial_trips['trip_id'] \
+            + '_freq_' + partial_trips['frequency_start'].apply(str) \
+            + '_' + partial_trips['trip_order'].apply(str)
 
         # add new rows to trips for each partial trip
-        partial_trips_rows = trips_filtered_df.merge(
+        partial_trips_rows = trips_df.merge(
             partial_trips,
             left_on='trip_id',
             right_on='trip_id'
         )
         partial_trips_rows = partial_trips_rows.drop(columns=['trip_id']).rename(columns={ 'new_trip_id': 'trip_id' })
 
-        # now that new partial trips have been created, we can remove trips that were partially within
-        # the timerange but not wholly within
-        trips_filtered_df = trips_df[~trips_df['trip_id'].isin(trips_not_in_any_range_whole.index.to_series())]
-
         trips_filtered_df = pd.concat(
             [trips_filtered_df, partial_trips_rows],
             axis=0
         )
 
         # add new rows in range into stoptimes for new trips
-        stop_times = gtfs.get_table('stop_times')
+        trip_bounds = triphelpers.get_trip_bounds()
+        trip_ids = trips_filtered_df['trip_id']
+        add_partial_trips = lambda stop_times: add_partial_trip_stop_times( \
+            stop_times, partial_trips, trip_bounds, time_range, trip_ids)
 
-        partial_stop_times = stop_times.merge(
-            partial_trips[['trip_id', 'new_trip_id', 'trip_start']],
-            left_on='trip_id',
-            right_on='trip_id'
-        ).sort_values(['new_trip_id', 'stop_sequence'])
+        # stop_times read in chunks are changed as each chunk is read
+        if gtfs.is_chunked('stop_times'):
+            gtfs.get_chunked_table('stop_times').add_transform(add_partial_trips)
+        else:
+            gtfs.update_table('stop_times', add_partial_trips(gtfs.get_table('stop_times')))
 
-        trip_bounds = triphelpers.get_trip_bounds()
-        trip_bounds = trip_bounds.rename(columns={ 'start_time': 'first_arrival' })
+    gtfs.update_table('trips', trips_filtered_df.set_index('trip_id'))
 
-        partial_stop_times = partial_stop_times.merge(
-            trip_bounds['first_arrival'].to_frame(),
-            how='left',
-            left_on='trip_id',
-            right_on='trip_id'
-        )
-        def safe_transpose(val, diff_secs):
-            isnan = (type(val) == str and val == '') or (type(val) == float and np.isnan(val))
-            if isnan: return np.nan
-            transpose_secs = seconds_since_zero(val) + diff_secs
-            return seconds_to_military(transpose_secs)
-
-        # transpose stop times
-        partial_stop_times['arrival_time'] = partial_stop_times.apply(
-            lambda row: safe_transpose(
-                row['arrival_time'],
-                (seconds_since_zero(row['trip_start']) - \
-                    seconds_since_zero(row['first_arrival']))
-            ),
-            axis=1
-        )
-        partial_stop_times['departure_time'] = partial_stop_times.apply(
-            lambda row: safe_transpose(
-                row['departure_time'],
-                (seconds_since_zero(row['trip_start']) - \
-                    seconds_since_zero(row['first_arrival']))
-            ),
-            axis=1
-        )
-        partial_stop_times = partial_stop_times.rename(columns={
-            'trip_id': 'old_trip_id',
-            'new_trip_id': 'trip_id'
-        })
-
-        kwargs = {'inrange' : lambda df: service_in_range(
-            df['arrival_time'].apply(safe_seconds_since_zero),
-            df['departure_time'].apply(safe_seconds_since_zero),
-            seconds_since_zero(time_range['start']),
-            seconds_since_zero(time_range['end'])
-        )}
-
-        partial_stop_times = partial_stop_times.assign(**kwargs)
-        partial_stop_times = partial_stop_times[partial_stop_times['inrange'] == True]
-
-        stop_times_updated = pd.concat(
-            [stop_times, partial_stop_times],
-            axis=0
-        )
+    # Shorten frequencies to the trips wholly in range
+    filtered_frequencies_df = get_frequency_runs_in_range(frequency_blocks)
+
+    gtfs.update_table('frequencies', filtered_frequencies_df[gtfs.get_columns('frequencies')])
+
+def add_partial_trip_stop_times(stop_times, partial_trips, trip_bounds, time_range, trip_ids):
+    # stop_times: stop_times rows of whole trips (i.e. a chunk)
+    # partial_trips: unwrapped partially in range trips, with new_trip_id (see filter_repeating_trips_by_timerange)
+    # returns stop_times with rows added for each partial trip of its trips (its repeating trip's stop
+    # times moved to its start and trimmed to time_range), keeping only rows of trip_ids
+
+    partial_stop_times = stop_times.merge(
+        partial_trips[['trip_id', 'new_trip_id', 'trip_start']],
+        left_on='trip_id',
+        right_on='trip_id'
+    ).sort_values(['new_trip_id', 'stop_sequence'])
+
+    trip_bounds = trip_bounds.rename(columns={ 'start_time': 'first_arrival' })
+
+    partial_stop_times = partial_stop_times.merge(
+        trip_bounds['first_arrival'].to_frame(),
+        how='left',
+        left_on='trip_id',
+        right_on='trip_id'
+    )
+    # transpose stop times (missing times stay missing)
+    transpose_secs = to_seconds_since_zero(partial_stop_times['trip_start']) \
+        - to_seconds_since_zero(partial_stop_times['first_arrival'])
+    partial_stop_times['arrival_time'] = to_seconds_since_zero(partial_stop_times['arrival_time']) + transpose_secs
+    partial_stop_times['departure_time'] = to_seconds_since_zero(partial_stop_times['departure_time']) + transpose_secs
+    partial_stop_times = partial_stop_times.rename(columns={
+        'trip_id': 'old_trip_id',
+        'new_trip_id': 'trip_id'
+    })
 
-        # remove original partial trips from trips and stoptimes
-        stop_times_updated = stop_times_updated[stop_times_updated['trip_id'].isin(trips_filtered_df['trip_id'])]
-        stop_times_updated = stop_times_updated.sort_values(['trip_id', 'stop_sequence'])
-        gtfs.update_table('stop_times', stop_times_updated)
+    kwargs = {'inrange' : lambda df: service_in_range(
+        to_seconds_since_zero(df['arrival_time']),
+        to_seconds_since_zero(df['departure_time']),
+        seconds_since_zero(time_range['start']),
+        seconds_since_zero(time_range['end'])
+    )}
 
-    gtfs.update_table('trips', trips_filtered_df.set_index('trip_id'))
-    
-    # Shorten and/or push back frequencies if needed
-    unwrapped_grouped = unwrapped_long.groupby(['frequency_start', 'trip_id'])
-    last_trip_order = unwrapped_grouped['trip_order'].max().rename('last_trip_order')
+    partial_stop_times = partial_stop_times.assign(**kwargs)
+    partial_stop_times = partial_stop_times[partial_stop_times['inrange'] == True]
 
-    # only keep runs in frequencies that are completely in range
-    unwrapped_in_range_only_grouped = unwrapped_long[unwrapped_long['wholly_in_range'] == True].groupby(['frequency_start', 'trip_id'])
+    stop_times_updated = pd.concat(
+        [stop_times, partial_stop_times],
+        axis=0
+    )
 
-    # TODO: handle if unwrapped_in_range_only_grouped is empty here (all frequencies out of range), causes error
+    # remove original partial trips from trips and stoptimes
+    stop_times_updated = stop_times_updated[stop_times_updated['trip_id'].isin(trip_ids)]
+    return stop_times_updated.sort_values(['trip_id', 'stop_sequence'])
 
-    last_trip_order_in_range = unwrapped_in_range_only_grouped.apply(lambda g: g[g['trip_order'] == g['trip_order'].max()]) \
-        [['frequency_start', 'trip_id', 'trip_order', 'trip_end']]
-    last_trip_order_in_range = last_trip_order_in_range \
-        .rename(columns={ 'trip_order': 'last_trip_order_in_range', 'trip_end': 'last_trip_end_in_range' }) \
-        .reset_index(drop=True)
-    
-    first_trip_order_in_range = unwrapped_in_range_only_grouped.apply(lambda g: g[g['trip_order'] == g['trip_order'].min()]) \
-        [['frequency_start', 'trip_id', 'trip_order', 'trip_start']]
-    first_trip_order_in_range = first_trip_order_in_range \
-        .rename(columns={ 'trip_order': 'first_trip_order_in_range', 'trip_start': 'first_trip_start_in_range' }) \
-        .reset_index(drop=True)
-
-    unwrapped_long = unwrapped_long.merge(last_trip_order, left_on=['frequency_start', 'trip_id'], right_on=['frequency_start', 'trip_id'])
-    unwrapped_long = unwrapped_long.merge(first_trip_order_in_range, left_on=['frequency_start', 'trip_id'], right_on=['frequency_start', 'trip_id'])
-    unwrapped_long = unwrapped_long.merge(last_trip_order_in_range, left_on=['frequency_start', 'trip_id'], right_on=['frequency_start', 'trip_id'])
-
-    unwrapped_long.loc[unwrapped_long['last_trip_order'] > unwrapped_long['last_trip_order_in_range'], \
-        'frequency_end'] = unwrapped_long['last_trip_end_in_range']
-    
-    unwrapped_long.loc[unwrapped_long['first_trip_order_in_range'] > 0, \
-        'frequency_start'] = unwrapped_long['first_trip_start_in_range']
-
-    unwrapped_long = unwrapped_long[ \
-        (unwrapped_long['trip_order'] <= unwrapped_long['last_trip_order_in_range']) \
-        & (unwrapped_long['trip_order'] >= unwrapped_long['first_trip_order_in_range']) \
-    ]
-
-    # split frequencies on gaps
-
-    # agg individual in_range status
-    unwrapped_trips_out_of_range = unwrapped_long[unwrapped_long['wholly_in_range'] == False]
-
-    # copy over index columns we need to iteratively update
-    unwrapped_long = unwrapped_long \
-        .reset_index() \
-        .set_index(['frequency_start', 'trip_id', 'trip_order'], drop=False)
-    unwrapped_long = unwrapped_long.rename(columns={ \
-        'frequency_start': 'new_frequency_start', \
-        'trip_order': 'new_trip_order' \
-    })
+def get_frequency_runs_in_range(frequency_blocks):
+    # frequency_blocks: blocks (see triphelpers.get_frequency_blocks) with first_trip_order_in_range,
+    # last_trip_order_in_range and any_trip_in_range
+    # returns frequencies with a row for each block's run of trips wholly in range.
+    # A run ending before its block does ends at the headway after its last trip starts,
+    # so later (out of range) trips are not included in it
+
+    runs = frequency_blocks[frequency_blocks['any_trip_in_range']]
+
+    frequency_start = runs['frequency_start'].to_numpy(dtype=np.int64)
+    headway_secs = runs['headway_secs'].to_numpy(dtype=np.int64)
+    first_in_range = runs['first_trip_order_in_range'].to_numpy()
+    last_in_range = runs['last_trip_order_in_range'].to_numpy()
 
-    # Perform update for each out-of-range trip on adjacent in-range trips
-    for index, current_row in unwrapped_trips_out_of_range.iterrows():
-        cur_frequency_start = current_row['frequency_start']
-        cur_trip_id = current_row['trip_id']
-        cur_trip_order = current_row['trip_order']
-
-        # if next trip in range
-        if (unwrapped_long.loc[cur_frequency_start, cur_trip_id, cur_trip_order + 1]['wholly_in_range'] == True):
-            # update frequency start for all future trips in frequency
-            new_trip_start = unwrapped_long.loc[ \
-                (unwrapped_long['new_frequency_start'] == cur_frequency_start) \
-                    & (unwrapped_long['trip_id'] == cur_trip_id) \
-                    & (unwrapped_long['new_trip_order'] == cur_trip_order + 1), \
-            ]['trip_start'].tolist()[0]
-            unwrapped_long.loc[ \
-                (unwrapped_long['new_frequency_start'] == cur_frequency_start) \
-                    & (unwrapped_long['trip_id'] == cur_trip_id) \
-                    & (unwrapped_long['new_trip_order'] >= cur_trip_order), \
-                'new_frequency_start' \
-            ] = new_trip_start
-
-            # update trip order for all future trips in frequency
-            unwrapped_long['new_trip_order'] = unwrapped_long.apply(lambda unwrapped_long: \
-                unwrapped_long['new_trip_order'] - (cur_trip_order + 1) if ( \
-                    (unwrapped_long['new_frequency_start'] == cur_frequency_start) \
-                    & (unwrapped_long['trip_id'] == cur_trip_id) \
-                    & (unwrapped_long['new_trip_order'] >= cur_trip_order) \
-                ) else unwrapped_long['new_trip_order'], \
-            axis='columns')
-
-        # if previous trip in range
-        if (unwrapped_long.loc[cur_frequency_start, cur_trip_id, cur_trip_order - 1]['wholly_in_range'] == True):
-            # update frequency end for all previous trips in frequency
-            new_trip_end = unwrapped_long.loc[ \
-                (unwrapped_long['new_frequency_start'] == cur_frequency_start) \
-                    & (unwrapped_long['trip_id'] == cur_trip_id) \
-                    & (unwrapped_long['new_trip_order'] == cur_trip_order - 1), \
-            ]['trip_end'].tolist()[0]
-            unwrapped_long.loc[ \
-                (unwrapped_long['new_frequency_start'] == cur_frequency_start) \
-                    & (unwrapped_long['trip_id'] == cur_trip_id) \
-                    & (unwrapped_long['new_trip_order'] <= cur_trip_order), \
-                'frequency_end' \
-            ] = new_trip_end
-
-    # Now we can finally remove all out-of-range entries and reshape back into frequencies 
-    unwrapped_long = unwrapped_long[unwrapped_long['wholly_in_range'] == True]
-    unwrapped_long = unwrapped_long \
-        .reset_index(drop=True) \
-        .rename(columns={ 'new_frequency_start': 'start_time', 'frequency_end': 'end_time' })
-    filtered_frequencies_df = unwrapped_long[gtfs.get_columns('frequencies')] \
-        .drop_duplicates()
-
-    gtfs.update_table('frequencies', filtered_frequencies_df)
+    ends_with_block = last_in_range == runs['trip_count'].to_numpy() - 1
+    run_ends = np.where( \
+        ends_with_block,
+        runs['frequency_end'].to_numpy(dtype=np.int64),
+        frequency_start + (last_in_range + 1) * headway_secs
+    )
+
+    return runs.assign( \
+        frequency_start=frequency_start + first_in_range * headway_secs,
+        frequency_end=run_ends
+    ).rename(columns={ 'frequency_start': 'start_time', 'frequency_end': 'end_time' })
 
 
 def get_inrange(df, start_col, end_col, time_range, wholly_within=True):
@@ -287,8 +184,8 @@ def get_inrange(df, start_col, end_col, time_range, wholly_within=True):
     end = time_range['end']
 
     kwargs = {'inrange' : lambda df: time_range_in_range( \
-        df[start_col].transform(seconds_since_zero), \
-        df[end_col].transform(seconds_since_zero), \
+        to_seconds_since_zero(df[start_col]), \
+        to_seconds_since_zero(df[end_col]), \
         seconds_since_zero(start), \
         seconds_since_zero(end), \
         wholly_within=wholly_within \
@@ -324,25 +221,33 @@ def filter_single_trips_by_timerange(timerange, trim_trips=False):
 
     # filter stop_times if trim_trips is True
     if trim_trips:
-        stop_times = gtfs.get_table('stop_times')
-        stop_times = stop_times.merge(
-            trips_extended['is_repeating'].reset_index(),
-            how='left',
-            left_on='trip_id',
-            right_on='trip_id'
-        )
-
-        start = timerange['start']
-        end = timerange['end']
-
-        # IMPORTANT: to avoid inferring stop service time when not supplied, this will remove
-        # all stops outside of range AND all stops without stop times. 
-        kwargs = {'inrange' : lambda df: service_in_range(
-            df['arrival_time'].apply(safe_seconds_since_zero),
-            df['departure_time'].apply(safe_seconds_since_zero),
-            seconds_since_zero(start),
-            seconds_since_zero(end)
-        )}
-        stop_times = stop_times.assign(**kwargs)
-        stop_times = stop_times[(stop_times['inrange'] == True) | (stop_times['is_repeating'] == True)]
-        gtfs.update_table('stop_times', stop_times)
\ No newline at end of file
+        is_repeating = trips_extended['is_repeating']
+        trim = lambda stop_times: trim_stop_times(stop_times, is_repeating, timerange)
+
+        # stop_times read in chunks are trimmed as each chunk is read
+        if gtfs.is_chunked('stop_times'):
+            gtfs.get_chunked_table('stop_times').add_transform(trim)
+        else:
+            gtfs.update_table('stop_times', trim(gtfs.get_table('stop_times')))
+
+def trim_stop_times(stop_times, is_repeating, timerange):
+    # stop_times: stop_times rows (i.e. a chunk)
+    # is_repeating: series of whether each trip is repeating, by trip_id
+    # returns stop_times in timerange, and all stop times of repeating trips
+
+    # looked up by trip_id rather than merged, so a chunk's trips are found without hashing every trip
+    stop_times = stop_times.assign(is_repeating=triphelpers.lookup_by_trip(is_repeating, stop_times['trip_id']).to_numpy())
+
+    start = timerange['start']
+    end = timerange['end']
+
+    # IMPORTANT: to avoid inferring stop service time when not supplied, this will remove
+    # all stops outside of range AND all stops without stop times. 
+    kwargs = {'inrange' : lambda df: service_in_range(
+        to_seconds_since_zero(df['arrival_time']),
+        to_seconds_since_zero(df['departure_time']),
+        seconds_since_zero(start),
+        seconds_since_zero(end)
+    )}
+    stop_times = stop_times.assign(**kwargs)
+    return stop_times[(stop_times['inrange'] == True) | (stop_times['is_repeating'] == True)]
\ No newline at end of file
@@ -1,57 +1,138 @@
 import pandas as pd
-import datetime
 import numpy as np
 
-from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs as gtfssingleton
+from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs as gtfs_singleton
 from tpau_gtfsutilities.gtfs.gtfsenums import GTFSBool, GTFSExceptionType
 from tpau_gtfsutilities.gtfs.properties import DOWS
-from tpau_gtfsutilities.helpers.datetimehelpers import GTFSDateRange, GTFSDateRange, GTFSDate
-
-class GTFSServiceCalendar:
-    daterange = None
-    dows = {}
-    added_dates = [] # list of datestrings
-    removed_dates = [] # list of datestrings
-    _gtfs = None
-
-    def __init__(self, service_id, gtfs_override=None):
-        # TODO: ensure this works for alternate calendars method
-
-        self._gtfs = gtfs_override if gtfs_override else gtfs_singleton
-
-        calendar_row = self._gtfs.get_table('calendar').loc[service_id]
-        self.daterange = GTFSDateRange(calendar_row.loc['start_date'], calendar_row.loc['end_date'])
-
-        # dows
-        for day in DOWS:
-            self.dows[day] = (calendar_row.loc[day] == GTFSBool.TRUE)
-
-        # exceptions
-        if self._gtfs.has_table('calendar_dates'):
-            calendar_dates = self._gtfs.get_table('calendar_dates')
-            exceptions = calendar_dates[calendar_dates['service_id'] == service_id]
-            added_exceptions = exceptions[exceptions['exception_type'] == GTFSExceptionType.ADDED]
-            self.added_dates = added_exceptions['date'].astype(str).tolist()
-            removed_exceptions = exceptions[exceptions['exception_type'] == GTFSExceptionType.REMOVED]
-            self.removed_dates = removed_exceptions['date'].astype(str).tolist()
-
-    def num_active_days(self):
-        # hopefully this isn't slow on large calendars
-        day_count = 0
-
-        current_date = self.daterange.start
-
-        # add service days, not including days with removed service
-        while not current_date.after(self.daterange.end):
-            if self.dows[current_date.dow()] and (current_date.datestring() not in self.removed_dates):
-                day_count += 1
-            current_date.add_days(1)
-
-        # if added_dates are not in daterange or are not on served dow, add to day_count
-        for ad in self.added_dates:
-            added_date = GTFSDate(ad)
-            if (not self.daterange.includes(added_date)) or (not self.dows[added_date.dow()]):
-                day_count += 1
-
-        return day_count
-        
\ No newline at end of file
+from tpau_gtfsutilities.helpers.datetimecolumns import to_day_numbers, day_numbers_to_dows
+
+class GTFSServiceActivity:
+    # which days each service is active on, from calendar and calendar_dates. Regular service is kept
+    # for each service (rows, in service_ids order) as a range of days (numbers of days since 1970-01-01)
+    # and its served days of week, and exceptions as row and day pairs, so days are only expanded when
+    # queried rather than for every day calendars span (placeholder end dates can be decades away)
+    service_ids = None
+    start_days = None
+    end_days = None
+    served_dows = None
+    exception_rows = None
+    exception_days = None
+    exception_active = None
+
+    def __init__(self, calendar=None, calendar_dates=None):
+        # calendar, calendar_dates: dfs with service_id as a column, or None if not in feed
+
+        no_ids = np.array([], dtype=object)
+        calendar_ids = calendar['service_id'].to_numpy(dtype=object) if calendar is not None else no_ids
+        exception_ids = calendar_dates['service_id'].to_numpy(dtype=object) if calendar_dates is not None else no_ids
+        self.service_ids = pd.Index(pd.unique(np.concatenate([calendar_ids, exception_ids])), name='service_id')
+
+        # services without a calendar have no regular service (an empty range of days)
+        num_services = len(self.service_ids)
+        self.start_days = np.zeros(num_services, dtype=np.int64)
+        self.end_days = np.full(num_services, -1, dtype=np.int64)
+        self.served_dows = np.zeros((num_services, len(DOWS)), dtype=bool)
+
+        # regular service: days within calendar dates on a served day of week
+        if calendar is not None and len(calendar):
+            rows = self.service_ids.get_indexer(calendar_ids)
+            self.start_days[rows] = to_day_numbers(calendar['start_date'])
+            self.end_days[rows] = to_day_numbers(calendar['end_date'])
+            self.served_dows[rows] = (calendar[DOWS].to_numpy(dtype=object) == GTFSBool.TRUE)
+
+        exceptions = pd.DataFrame({'row': [], 'day': [], 'added': []})
+        if calendar_dates is not None and len(calendar_dates):
+            exception_types = calendar_dates['exception_type'].astype(str).str.strip().to_numpy()
+            exceptions = pd.DataFrame({
+                'row': self.service_ids.get_indexer(exception_ids),
+                'day': to_day_numbers(calendar_dates['date']),
+                'added': exception_types == GTFSExceptionType.ADDED,
+            })[(exception_types == GTFSExceptionType.ADDED) | (exception_types == GTFSExceptionType.REMOVED)]
+
+            # added service takes precedence over removed service on the same day
+            exceptions = exceptions.groupby(['row', 'day'])['added'].any().reset_index()
+
+        self.exception_rows = exceptions['row'].to_numpy(dtype=np.int64)
+        self.exception_days = exceptions['day'].to_numpy(dtype=np.int64)
+        self.exception_active = exceptions['added'].to_numpy(dtype=bool)
+
+    def is_regular_active(self, rows, days):
+        # rows, days: arrays of service rows and day numbers (broadcast together)
+        # returns boolean array of whether each row's regular service is active on each day
+        return (self.start_days[rows] <= days) & (days <= self.end_days[rows]) \
+            & self.served_dows[rows, day_numbers_to_dows(days)]
+
+    def get_active(self, days):
+        # days: array of distinct day numbers
+        # returns boolean matrix of services (rows) by days (columns) of whether each is active
+        active = self.is_regular_active(np.arange(len(self.service_ids))[:, None], days[None, :])
+
+        columns = pd.Index(days).get_indexer(self.exception_days)
+        queried = columns >= 0
+        active[self.exception_rows[queried], columns[queried]] = self.exception_active[queried]
+        return active
+
+    def num_active_days(self, start_date=None, end_date=None):
+        # returns series of the number of days each service is active (between dates, if provided)
+        start = to_day_numbers([start_date])[0] if start_date is not None else None
+        end = to_day_numbers([end_date])[0] if end_date is not None else None
+
+        # regular service: days of each day of week in the calendar range (clipped to dates),
+        # counted by day numbers' remainders (mod 7) rather than day by day
+        range_starts = np.maximum(self.start_days, start) if start is not None else self.start_days
+        range_ends = np.minimum(self.end_days, end) if end is not None else self.end_days
+        remainders = np.arange(7)
+        day_counts = (range_ends[:, None] - remainders) // 7 - (range_starts[:, None] - 1 - remainders) // 7
+        day_counts[range_starts > range_ends] = 0
+        counts = (day_counts * self.served_dows[:, day_numbers_to_dows(remainders)]).sum(axis=1)
+
+        # exceptions between dates add or remove a day where they differ from regular service
+        in_range = np.ones(len(self.exception_days), dtype=bool)
+        if start is not None:
+            in_range &= self.exception_days >= start
+        if end is not None:
+            in_range &= self.exception_days <= end
+        rows = self.exception_rows[in_range]
+        days = self.exception_days[in_range]
+        changes = self.exception_active[in_range].astype(np.int64) - self.is_regular_active(rows, days)
+        counts += np.bincount(rows, weights=changes, minlength=len(self.service_ids)).astype(np.int64)
+
+        return pd.Series(counts, index=self.service_ids, name='active_days')
+
+    def is_active_between(self, start_date, end_date):
+        # returns boolean series of whether each service is active on any day between dates
+        return self.num_active_days(start_date, end_date) > 0
+
+    def is_active_on(self, date):
+        # returns boolean series of whether each service is active on date
+        return self.is_active_between(date, date)
+
+    def is_active_on_dates(self, service_ids, dates):
+        # service_ids: array of service ids (i.e. of trips, may repeat or be missing from feed)
+        # returns boolean array of each service id (rows) by dates (columns) of whether it is active
+        rows = self.service_ids.get_indexer(np.asarray(service_ids, dtype=object))
+        days, columns = np.unique(to_day_numbers(dates), return_inverse=True)
+        service_active = self.get_active(days)[:, columns]
+        known = rows >= 0
+
+        active = np.zeros((len(rows), len(columns)), dtype=bool)
+        active[known] = service_active[rows[known]]
+        return active
+
+def get_service_activity(gtfs_override=None, original=False):
+    # returns GTFSServiceActivity for the feed's calendar and calendar_dates, which is
+    # reused until either table changes. Must not be modified
+
+    gtfs = gtfs_override if gtfs_override else gtfs_singleton
+
+    def get_calendar_table(tablename):
+        if not gtfs.has_table(tablename):
+            return None
+        return gtfs.get_table(tablename, index=False, original=original, view=True)
+
+    return gtfs.get_derived( \
+        'service_activity',
+        ['calendar', 'calendar_dates'],
+        lambda: GTFSServiceActivity(get_calendar_table('calendar'), get_calendar_table('calendar_dates')),
+        original=original
+    )
@@ -1,7 +1,7 @@
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
 
 def print_table(tablename, message='', all=False):
-    df = gtfs.get_table(tablename)
+    df = gtfs.get_table(tablename, view=True)
     prefix = 'DEBUG ' + tablename + ' ' + message + ': '
     if all:
         print(prefix, df.to_string())
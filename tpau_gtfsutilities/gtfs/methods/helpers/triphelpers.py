@@ -4,8 +4,10 @@ import numpy as np
 
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs as gtfs_singleton
 
-from tpau_gtfsutilities.helpers.datetimehelpers import seconds_since_zero
-from tpau_gtfsutilities.helpers.datetimehelpers import seconds_to_military
+from tpau_gtfsutilities.helpers.datetimecolumns import to_seconds_since_zero
+
+# tables that trips_extended is built from
+TRIPS_EXTENDED_TABLES = ['trips', 'calendar', 'stop_times', 'frequencies', 'agency', 'routes']
 
 def get_trip_duration_seconds(gtfs_override=None, trip_bounds=None):
     # returns trip duration series 'duration_seconds'
@@ -14,8 +16,8 @@ def get_trip_duration_seconds(gtfs_override=None, trip_bounds=None):
     trip_bounds = trip_bounds if trip_bounds is not None else get_trip_bounds(gtfs_override=gtfs)
     trip_durations_df = trip_bounds.assign( \
         duration_seconds = \
-            trip_bounds['end_time'].transform(seconds_since_zero) \
-                - trip_bounds['start_time'].transform(seconds_since_zero) \
+            to_seconds_since_zero(trip_bounds['end_time']) \
+                - to_seconds_since_zero(trip_bounds['start_time']) \
     )
 
     return trip_durations_df['duration_seconds']
@@ -24,44 +26,65 @@ def get_trip_duration_seconds(gtfs_override=None, trip_bounds=None):
 def get_trip_bounds(gtfs_override=None, original=False):
     # returns trip bounds dataframe
     #   index: trip_id
-    #   columns: start_time, end_time
+    #   columns: start_time, end_time (seconds since zero)
+    # cached on the feed, and only recomputed when stop_times changes
     gtfs = gtfs_override if gtfs_override else gtfs_singleton
 
-    stop_times = gtfs.get_table('stop_times', original=original)
+    trip_bounds = gtfs.get_derived('trip_bounds', ['stop_times'], \
+        lambda: compute_trip_bounds(gtfs, original=original), \
+        original=original \
+    )
+
+    return trip_bounds.copy()
 
-    def min_miliary_arrival_time(grouped):
-        trip_id = grouped.name
-        grouped_df = grouped.to_frame()
-        
-        grouped_df = grouped_df[grouped_df[trip_id] != ''] \
-            .assign(seconds_since_zero = lambda df: df[trip_id].transform(lambda t: seconds_since_zero(t)))
 
-        idx_of_min = grouped_df['seconds_since_zero'].idxmin(axis=0)
+def compute_trip_bounds(gtfs, original=False):
+    # first and last arrival of every trip, in a single grouped pass over stop_times
 
-        return grouped_df.loc[idx_of_min, trip_id]
+    if gtfs.is_chunked('stop_times'):
+        return compute_trip_bounds_in_chunks(gtfs, original=original)
 
-    def max_miliary_arrival_time(grouped):
-        trip_id = grouped.name
-        grouped_df = grouped.to_frame()
+    stop_times = gtfs.get_table('stop_times', original=original, view=True)
+    return get_stop_times_trip_bounds(stop_times)
 
-        grouped_df = grouped_df[grouped_df[trip_id] != ''] \
-            .assign(seconds_since_zero = lambda df: df[trip_id].transform(lambda t: seconds_since_zero(t)))
 
-        idx_of_max = grouped_df['seconds_since_zero'].idxmax(axis=0)
+def compute_trip_bounds_in_chunks(gtfs, original=False):
+    # trip bounds from stop_times read in chunks. Chunks have whole trips, so the bounds of
+    # each chunk's trips are final
 
-        return grouped_df.loc[idx_of_max, trip_id]
+    stop_times = gtfs.get_chunked_table('stop_times')
+    if not original and not stop_times.rows_changed():
+        # only whole trips have been removed, so the remaining trips' bounds are unchanged
+        trip_bounds = get_trip_bounds(gtfs_override=gtfs, original=True)
+        trip_ids = stop_times.get_keys('trip_id')
+        return trip_bounds[trip_bounds.index.isin(trip_ids)]
 
-    grouped_arrival_times = stop_times[stop_times['arrival_time'].notnull()].groupby('trip_id')['arrival_time']
-    
-    min_arrival_times = grouped_arrival_times \
-        .agg(min_miliary_arrival_time) \
-        .rename('start_time')
+    chunk_bounds = [get_stop_times_trip_bounds(chunk) for chunk in \
+        stop_times.get_chunks(columns=['trip_id', 'arrival_time'], original=original)]
+    if not len(chunk_bounds):
+        return get_stop_times_trip_bounds(pd.DataFrame(columns=['trip_id', 'arrival_time']))
+    return pd.concat(chunk_bounds)
 
-    max_arrival_times = grouped_arrival_times \
-        .agg(max_miliary_arrival_time) \
-        .rename('end_time')
 
-    return pd.concat([min_arrival_times, max_arrival_times], axis=1)
+def get_stop_times_trip_bounds(stop_times):
+    # returns first and last arrival by trip_id (see get_trip_bounds) of stop_times rows
+    arrival_times = stop_times[['trip_id', 'arrival_time']]
+    arrival_times = arrival_times[arrival_times['arrival_time'].notna()]
+
+    trip_bounds = arrival_times.groupby('trip_id', observed=True)['arrival_time'] \
+        .agg(['min', 'max']) \
+        .rename(columns={ 'min': 'start_time', 'max': 'end_time' })
+    trip_bounds.index = trip_bounds.index.astype(object)
+
+    return trip_bounds
+
+def lookup_by_trip(df, trip_ids):
+    # returns rows (or values) of df, indexed by trip_id, for each of trip_ids (missing where not
+    # found, as a left merge would), looked up in df's index so a chunk of stop_times is found
+    # without hashing every trip. Repeated trip_ids in df (invalid, but found in feeds) use their first row
+    if not df.index.is_unique:
+        df = df[~df.index.duplicated()]
+    return df.reindex(np.asarray(trip_ids, dtype=object))
 
 
 def get_trips_extended(gtfs_override=None, original=False):
@@ -75,12 +98,22 @@ def get_trips_extended(gtfs_override=None, original=False):
     # route_type
     # agency id
     # agency name
+    # cached on the feed, and only recomputed when one of its source tables changes
     gtfs = gtfs_override if gtfs_override else gtfs_singleton
 
+    trips_extended = gtfs.get_derived('trips_extended', TRIPS_EXTENDED_TABLES, \
+        lambda: compute_trips_extended(gtfs, original=original), \
+        original=original \
+    )
+
+    return trips_extended.copy()
+
+
+def compute_trips_extended(gtfs, original=False):
     trips_extended = gtfs.get_table('trips', original=original)
 
     if gtfs.has_table('calendar', check_empty=False):
-        calendar = gtfs.get_table('calendar', original=original)
+        calendar = gtfs.get_table('calendar', original=original, view=True)
         calendar_info = calendar[ \
             [
                 'start_date', 'end_date', \
@@ -96,13 +129,13 @@ def get_trips_extended(gtfs_override=None, original=False):
     
     trips_extended = trips_extended.merge(get_trip_duration_seconds(gtfs_override=gtfs, trip_bounds=trip_bounds), left_index=True, right_index=True)
 
-    frequencies = gtfs.get_table('frequencies', original=original)
+    frequencies = gtfs.get_table('frequencies', original=original, view=True)
     trips_extended['is_repeating'] = \
         trips_extended.index.to_series().isin(frequencies['trip_id']) \
         if gtfs.has_table('frequencies') else False
 
     # agency information
-    agency = gtfs.get_table('agency', original=original)
+    agency = gtfs.get_table('agency', original=original, view=True)
     if not gtfs.is_multiagency():
         agency_row = agency.iloc[0]
         trips_extended['agency_name'] = agency_row['agency_name']
@@ -111,7 +144,7 @@ def get_trips_extended(gtfs_override=None, original=False):
         else:
             trips_extended['agency_id'] = ''
     else:
-        route_agencies = gtfs.get_table('routes', original=original)['agency_id']
+        route_agencies = gtfs.get_table('routes', original=original, view=True)['agency_id']
         trips_extended = trips_extended.reset_index()
         trips_extended = trips_extended.merge( \
             route_agencies,
@@ -127,7 +160,7 @@ def get_trips_extended(gtfs_override=None, original=False):
         )
         trips_extended = trips_extended.set_index('trip_id')
 
-    route_types = gtfs.get_table('routes', original=original)['route_type']
+    route_types = gtfs.get_table('routes', original=original, view=True)['route_type']
     trips_extended = trips_extended \
         .reset_index() \
         .merge(
@@ -140,51 +173,89 @@ def get_trips_extended(gtfs_override=None, original=False):
     return trips_extended
 
 
-def get_unwrapped_repeating_trips(gtfs_override=None):
-    # returns dataframe with a row for every occurring trip represented by frequencies.txt
-    # dataframe returned has frequencies columns with changes/additions:
-    #   trip_order: sequence of trip in frequency (starting at 0)
-    #   start_time -> frequency_start 
+def get_frequency_blocks(gtfs_override=None):
+    # returns frequencies with a row per headway block, without a row for each trip it represents.
+    # The trips in a block start at frequency_start + trip_order * headway_secs, for trip_order
+    # from 0 to trip_count - 1. Columns are frequencies columns with changes/additions:
+    #   start_time -> frequency_start
     #   end_time -> frequency_end
-    #   trip_start, trip_end: individual trip bounds
+    #   trip_count: number of trips in block
+    #   duration_seconds: duration of each trip in block (from its stop_times)
+    # Blocks for trips without stop times are not included
     gtfs = gtfs_override if gtfs_override else gtfs_singleton
 
     if not gtfs.has_table('frequencies'):
         return pd.DataFrame()
 
-    frequencies = gtfs.get_table('frequencies')
+    frequencies = gtfs.get_table('frequencies', view=True)
+    frequencies = frequencies.rename(columns={'start_time': 'frequency_start', 'end_time': 'frequency_end' })
 
-    frequencies.rename(columns={'start_time': 'frequency_start', 'end_time': 'frequency_end' }, inplace=True)
+    frequency_seconds = frequencies['frequency_end'].astype(np.int64) - frequencies['frequency_start'].astype(np.int64)
+    headway_secs = frequencies['headway_secs'].astype(np.int64)
+    frequencies['trip_count'] = np.maximum(-(-frequency_seconds // headway_secs), 0)
 
-    # expand into row per each occurring trip
-    frequencies['trip_order'] = np.ceil( \
-            (frequencies['frequency_end'].transform(seconds_since_zero) - frequencies['frequency_start'].transform(seconds_since_zero)) \
-            / frequencies['headway_secs'].transform(int) \
-        ).transform(lambda x: list(range(int(x))))
-        
-    unwrapped_frequencies = frequencies.explode('trip_order')
+    return frequencies.merge(get_trip_duration_seconds(gtfs_override=gtfs), left_on='trip_id', right_index=True)
 
-    # calculate start time seconds for each trip
-    trip_start_kwargs = { \
-        'start_time' : \
-            lambda x: \
-                x['frequency_start'].transform(seconds_since_zero) + \
-                x['trip_order'] * x['headway_secs']
-    }
-    unwrapped_frequencies = unwrapped_frequencies.assign(**trip_start_kwargs)
 
-    # calculate end time seconds for each trip
-    unwrapped_frequencies = unwrapped_frequencies.merge(get_trip_duration_seconds(gtfs_override=gtfs), left_on='trip_id', right_index=True)
+def get_frequency_trip_counts(gtfs_override=None):
+    # returns series 'trip_counts' with the number of trips represented by frequencies, by trip_id
+    frequency_blocks = get_frequency_blocks(gtfs_override=gtfs_override)
+    if frequency_blocks.empty:
+        return pd.Series(dtype=np.int64, name='trip_counts')
+    return frequency_blocks.groupby('trip_id')['trip_count'].sum().rename('trip_counts')
 
-    unwrapped_frequencies = unwrapped_frequencies.assign( \
-            end_time=unwrapped_frequencies['start_time'] + unwrapped_frequencies['duration_seconds'] \
-        )
-    unwrapped_frequencies['start_time'] = unwrapped_frequencies['start_time'].transform(seconds_to_military)
-    unwrapped_frequencies['end_time'] = unwrapped_frequencies['end_time'].transform(seconds_to_military)
 
-    unwrapped_frequencies = unwrapped_frequencies \
-        .rename(columns={ 'start_time': 'trip_start', 'end_time': 'trip_end' }) \
-        .drop('duration_seconds', axis='columns')
+def get_frequency_trip_orders_in_range(frequency_blocks, range_start, range_end, wholly_within=True):
+    # returns arrays (first, last) of the trip_order of the first and last trips of each block
+    # in range (seconds since zero, inclusive). If wholly_within=False, trips partially in range
+    # are included. last is less than first for blocks with no trips in range
 
-    return unwrapped_frequencies
-    
+    frequency_start = frequency_blocks['frequency_start'].to_numpy(dtype=np.int64)
+    headway_secs = frequency_blocks['headway_secs'].to_numpy(dtype=np.int64)
+    duration = frequency_blocks['duration_seconds'].to_numpy(dtype=np.int64)
+
+    # trips start no earlier than earliest_start and no later than latest_start
+    earliest_start = range_start if wholly_within else range_start - duration
+    latest_start = range_end - duration if wholly_within else range_end
+
+    first = np.maximum(-((frequency_start - earliest_start) // headway_secs), 0)
+    last = np.minimum((latest_start - frequency_start) // headway_secs, frequency_blocks['trip_count'].to_numpy() - 1)
+
+    return first, last
+
+
+def unwrap_frequency_blocks(frequency_blocks, first=None, last=None):
+    # returns frequency_blocks with a row for each trip in block, or only for trip orders
+    # from first to last (arrays by block, i.e. from get_frequency_trip_orders_in_range), adding:
+    #   trip_order: sequence of trip in block (starting at 0)
+    #   trip_start, trip_end: individual trip bounds (seconds since zero)
+
+    first = np.zeros(len(frequency_blocks), dtype=np.int64) if first is None else first
+    last = frequency_blocks['trip_count'].to_numpy() - 1 if last is None else last
+    trips_per_block = np.maximum(last - first + 1, 0)
+
+    unwrapped = frequency_blocks.iloc[np.repeat(np.arange(len(frequency_blocks)), trips_per_block)]
+
+    # trip order counts up from the block's first trip order
+    block_offsets = np.repeat(np.cumsum(trips_per_block) - trips_per_block, trips_per_block)
+    trip_order = np.repeat(first, trips_per_block) + np.arange(len(unwrapped)) - block_offsets
+
+    trip_start = unwrapped['frequency_start'].to_numpy(dtype=np.int64) \
+        + trip_order * unwrapped['headway_secs'].to_numpy(dtype=np.int64)
+
+    return unwrapped.assign( \
+        trip_order=trip_order,
+        trip_start=trip_start,
+        trip_end=trip_start + unwrapped['duration_seconds'].to_numpy(dtype=np.int64)
+    ).drop('duration_seconds', axis='columns')
+
+
+def get_unwrapped_repeating_trips(gtfs_override=None):
+    # returns dataframe with a row for every occurring trip represented by frequencies.txt
+    # (see unwrap_frequency_blocks). Where only counts or in-range trips are needed, use
+    # get_frequency_blocks instead, which avoids a row per trip
+    frequency_blocks = get_frequency_blocks(gtfs_override=gtfs_override)
+    if frequency_blocks.empty:
+        return pd.DataFrame()
+
+    return unwrap_frequency_blocks(frequency_blocks).drop('trip_count', axis='columns')
@@ -1,17 +1,42 @@
 import pandas as pd
+from pandas.api.types import is_object_dtype, is_categorical_dtype
 
-def remove_all_wrapping_quotations_in_gtfs(gtfs):
-    gtfs.run_function_on_all_tables(remove_wrapping_quotations_in_table, cascade=False)
+def remove_all_wrapping_quotations_in_gtfs(gtfs, tablenames=None):
+    # tablenames: tables to preprocess, defaults to all loaded tables
+    gtfs.run_function_on_all_tables(remove_wrapping_quotations_in_table, cascade=False, tablenames=tablenames)
 
 def remove_wrapping_quotations_in_table(df):
-    def strip_quotes_from_strings(x):
-        if isinstance(x, str):
-            # allow wrapping quotes if quotation marks or commas used within field
-            # http://gtfs.org/reference/static/#file-requirements
+    # returns df with wrapping quotes removed from string values, or df itself if there
+    # are none. Only string columns with a quote character in them are changed
+    stripped_columns = {}
 
-            needs_quotes = x.count('"') > 2 or x.count(',') > 0
-            if not needs_quotes:
-                return x.strip('\"')
-        return x
+    for col in df.columns:
+        values = df[col]
+        if is_categorical_dtype(values.dtype):
+            if not values.cat.categories.astype(str).str.contains('"', regex=False).any():
+                continue
+            values = values.astype(object)
+        elif not is_object_dtype(values.dtype):
+            continue
 
-    return df.applymap(strip_quotes_from_strings)
\ No newline at end of file
+        # missing for values that aren't strings
+        has_quotes = values.str.contains('"', regex=False).fillna(False).to_numpy(dtype=bool)
+        if not has_quotes.any():
+            continue
+
+        # allow wrapping quotes if quotation marks or commas used within field
+        # http://gtfs.org/reference/static/#file-requirements
+        quoted = values[has_quotes]
+        needs_quotes = (quoted.str.count('"') > 2) | quoted.str.contains(',', regex=False)
+
+        strip = has_quotes.copy()
+        strip[has_quotes] = ~needs_quotes.to_numpy(dtype=bool)
+        if not strip.any():
+            continue
+
+        stripped_columns[col] = values.where(~strip, values.str.strip('"'))
+
+    if not stripped_columns:
+        return df
+
+    return df.assign(**stripped_columns)
@@ -1,3 +1,6 @@
+# GTFS files are UTF-8, and some producers write a byte order mark
+GTFS_ENCODING = 'utf-8-sig'
+
 REQUIRED_TABLES = [ \
     'agency' \
     'stops' \
@@ -8,5 +8,6 @@ from . import calendar
 from . import calendar_dates
 from . import fare_attributes
 from . import shapes
+from . import frequencies
 
-__all__ = ['gtfstable', 'helpers', 'stops', 'routes', 'trips', 'stop_times', 'calendar', 'calendar_dates', 'fare_attributes', 'shapes']
\ No newline at end of file
+__all__ = ['gtfstable', 'helpers', 'stops', 'routes', 'trips', 'stop_times', 'calendar', 'calendar_dates', 'fare_attributes', 'shapes', 'frequencies']
\ No newline at end of file
@@ -0,0 +1,4 @@
+from .gtfstable import GTFSTable
+
+class Frequencies(GTFSTable):
+    time_columns = ['start_time', 'end_time']
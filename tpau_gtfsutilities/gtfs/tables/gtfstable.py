@@ -1,5 +1,12 @@
+import itertools
+import numpy as np
 import pandas as pd
-from tpau_gtfsutilities.gtfs.properties import NUMERIC_DTYPES
+from tpau_gtfsutilities.gtfs.properties import NUMERIC_DTYPES, GTFS_ENCODING
+from tpau_gtfsutilities.helpers.datetimecolumns import to_seconds_since_zero, to_military
+
+# table versions are unique across all tables (and feeds), so a version
+# also identifies which table object it came from
+_versions = itertools.count(1)
 
 class GTFSTable:
     index = []
@@ -24,28 +31,64 @@ class GTFSTable:
     # when multiple tables supplied like above, column can reference either table as source id, so 
     # for example trips can reference calendar or calendar_dates for regular or exception-only calendars
     upstream_columns = {}
+    # GTFS time columns ('HH:MM:SS'), held as integer seconds since zero and
+    # only written back out as strings (see get_output_df)
+    time_columns = []
+    # id columns with many repeated values, held as categoricals
+    categorical_columns = []
     
-    def __init__(self, csv=None, df=None, dtype={}):
-        # must provide either csv or df
+    def __init__(self, csv=None, df=None, dtype={}, columns=None, cleaned=False, usecols=None):
+        # must provide either csv (a path or file-like object) or df
+        # columns must be provided if df already has its index set
+        # cleaned=True if df is already cleaned (i.e. from a cached feed), so it is used as is
+        # usecols: columns to read from csv, if not all of them
+
+        dtype = self.typed_dtypes(dtype)
 
-        if csv:
-            df = pd.read_csv(csv, dtype=dtype)
+        if csv is not None:
+            df = pd.read_csv(csv, dtype=self.read_dtypes(dtype), encoding=GTFS_ENCODING, usecols=usecols)
 
         self.dtype = dtype
-        self.columns = df.columns.tolist()
-        self.original_df = df.copy()
-        self.df = self.clean(df)
+        self.columns = columns.copy() if columns is not None else df.columns.tolist()
+        # stored frames are never modified in place (update replaces df), so
+        # df and original_df can share their data until the table is updated
+        self.df = df if cleaned else self.clean(df)
+        self.original_df = self.df
+
+        # changed whenever df/original_df change, so results derived from
+        # this table can tell if they are stale
+        self.version = next(_versions)
+        self.original_version = next(_versions)
+
+    def typed_dtypes(self, dtype):
+        # dtypes held in memory: times are parsed separately, ids may be categorical
+        typed = {}
+        for col in dtype.keys():
+            if col in self.time_columns:
+                continue
+            typed[col] = 'category' if col in self.categorical_columns else dtype[col]
+        return typed
+
+    def read_dtypes(self, dtype):
+        # dtypes used when reading csv: times are read as strings to be parsed
+        read = dict(dtype)
+        for col in self.time_columns:
+            read[col] = 'str'
+        return read
 
-    def update(self, df):
+    def update(self, df, cleaned=False):
         # updates dataframe (disallowing column changes) and trigger downstream and 
         # upstream changes
 
-        self.df = self.clean(df)
+        self.df = df if cleaned else self.clean(df)
+        self.version = next(_versions)
 
-    def get_df(self, original=False):
-        if original:
-            return self.clean(self.original_df).copy()
-        return self.df.copy()
+    def get_df(self, original=False, view=False):
+        # original_df is stored already cleaned, so neither df needs re-cleaning.
+        # view=True skips copying the data: the returned frame shares its values with
+        # the table, so it must only be read (columns can still be added to it)
+        df = self.original_df if original else self.df
+        return df.copy(deep=not view)
 
     def clean(self, df):
         # returns df with index correctly set (regardless of df), dtype set
@@ -56,20 +99,40 @@ class GTFSTable:
             for col in self.dtype.keys():
                 dt = self.dtype[col]
                 if dt == 'str':
-                    dataframe[col].fillna('', inplace=True)
+                    dataframe[col] = dataframe[col].fillna('')
+            return dataframe
+
+        def parse_times(dataframe):
+            for col in self.time_columns:
+                if col in dataframe.columns:
+                    dataframe[col] = to_seconds_since_zero(dataframe[col])
             return dataframe
 
         if len(self.index):
             df = df.reset_index()
             df = clean_empty_vals(df)
             df = df.astype(self.dtype)
+            df = parse_times(df)
             df = df.set_index(self.index)
         else:
-            df = clean_empty_vals(df)
+            # columns are set on a shallow copy, so df (i.e. a slice of another table) isn't changed
+            df = clean_empty_vals(df.copy(deep=False))
             df = df.astype(self.dtype)
+            df = parse_times(df)
 
         return df[self.get_columns()]
 
+    def get_output_df(self):
+        # returns df as it should be written to a feed:
+        # index as columns, columns in original order and times as 'HH:MM:SS'
+
+        df = self.df.reset_index() if len(self.index) else self.df.copy(deep=False)
+        for col in self.time_columns:
+            if col in df.columns:
+                df[col] = to_military(df[col])
+
+        return df[self.get_columns(index=True)]
+
     def get_columns(self, index=False):
         if not index:
             columns = list(filter(lambda x: x not in self.index, self.columns.copy()))
@@ -80,14 +143,54 @@ class GTFSTable:
 
     def update_original(self):
         # only needed for rare circumstances
-        self.original_df = self.df.copy()
+        self.original_df = self.df
+        self.original_version = next(_versions)
     
     def reset_to_original(self):
-        self.df = self.original_df.copy()
+        self.df = self.original_df
+        self.version = next(_versions)
+
+    def get_values(self, column):
+        # values of column (or index level) by row
+        if column in self.df.columns:
+            return self.df[column]
+        return self.df.index.get_level_values(column)
+
+    def get_keys(self, column):
+        # distinct values of column (or index level), without missing values
+        values = self.get_values(column)
+        return np.asarray(values[pd.notna(values)].unique(), dtype=object)
+
+    def keep_rows(self, keep):
+        # removes rows where boolean array keep is False, returns number of rows removed.
+        # rows only, so the df doesn't need cleaning again
+        removed = len(keep) - int(keep.sum())
+        if removed:
+            self.df = self.df[keep]
+            self.version = next(_versions)
+        return removed
+
+    def unset_values(self, column, unset):
+        # unsets values of (non-index) column where boolean array unset is True,
+        # returns number of values unset
+        count = int(unset.sum())
+        if count:
+            missing = '' if self.dtype.get(column) == 'str' else np.nan
+            df = self.df.copy(deep=False)
+            df[column] = df[column].mask(unset, missing)
+            self.df = df
+            self.version = next(_versions)
+        return count
+
+    def get_version(self, original=False):
+        return self.original_version if original else self.version
+
+    def get_rows(self):
+        return len(self.df)
 
     def copy(self):
         # returns a new class instance with
         # df and original_df set to current values
-        table_copy = self.__class__(df=self.original_df, dtype=self.dtype)
-        table_copy.update(self.df.copy())
+        table_copy = self.__class__(df=self.original_df, dtype=self.dtype, columns=self.columns)
+        table_copy.update(self.df)
         return table_copy
@@ -2,6 +2,8 @@ from .gtfstable import GTFSTable
 from .helpers import ColumnRef
 
 class StopTimes(GTFSTable):
+    time_columns = ['arrival_time', 'departure_time']
+    categorical_columns = ['trip_id', 'stop_id']
     upstream_columns = {
         'trip_id': {
             'references': [ColumnRef('trips', 'trip_id')]
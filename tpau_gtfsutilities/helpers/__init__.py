@@ -1 +1,2 @@
-from . import datetimehelpers
\ No newline at end of file
+from . import datetimehelpers
+from . import datetimecolumns
\ No newline at end of file
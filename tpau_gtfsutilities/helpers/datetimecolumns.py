@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype, infer_dtype
+
+# Column-at-a-time versions of the helpers in datetimehelpers.
+# GTFS times are parsed into nullable integer "seconds since zero" (blank
+# times become <NA>), and can be formatted back into 'HH:MM:SS' in bulk.
+# Times past 24:00:00 are valid GTFS and are kept as-is.
+
+SECONDS_DTYPE = 'Int32'
+
+_ZERO = ord('0')
+_COLON = ord(':')
+_TWO_DIGITS = np.array(['%02d' % i for i in range(100)], dtype=object)
+
+def to_seconds_since_zero(times):
+    # times: series of 'HH:MM:SS' (or 'H:MM:SS') strings, possibly blank or NaN.
+    # Already-parsed (numeric) series are returned as seconds unchanged.
+    # Returns an Int32 series with the same index
+
+    if is_numeric_dtype(times.dtype):
+        return times.astype(SECONDS_DTYPE)
+
+    kind = infer_dtype(times, skipna=True)
+    if kind in ('integer', 'floating', 'mixed-integer-float'):
+        return pd.to_numeric(times).astype(SECONDS_DTYPE)
+    if kind not in ('string', 'empty'):
+        # mix of parsed seconds and time strings, i.e. after concatenating
+        # a parsed column with unparsed times
+        is_text = times.map(lambda t: isinstance(t, str)).astype(bool)
+        seconds = pd.to_numeric(times.mask(is_text), errors='coerce').astype(SECONDS_DTYPE)
+        seconds[is_text] = to_seconds_since_zero(times[is_text].astype(str))
+        return seconds
+
+    values = times.to_numpy(dtype=object, na_value='')
+
+    try:
+        text = values.astype('S')
+    except UnicodeEncodeError:
+        raise ValueError('invalid GTFS time found in ' + str(times.name))
+
+    if text.dtype.itemsize and (text.view(np.uint8) == ord(' ')).any():
+        text = np.char.strip(text)
+
+    if text.dtype.itemsize == 0 or not len(text):
+        return _seconds_series(np.zeros(len(text), dtype=np.int32), np.ones(len(text), dtype=bool), times)
+
+    width = text.dtype.itemsize
+    chars = text.view(np.uint8).reshape(-1, width).astype(np.int16)
+    lengths = (chars != 0).sum(axis=1)
+    blank = lengths == 0
+
+    rows = np.arange(len(chars))
+
+    def char_at(offset_from_end):
+        return chars[rows, np.clip(lengths - offset_from_end, 0, width - 1)]
+
+    def digit_at(offset_from_end):
+        return char_at(offset_from_end) - _ZERO
+
+    # [H]H:MM:SS, read from the right so hours can have any width
+    hour_digits = lengths - 6
+    valid = (hour_digits >= 1) \
+        & (char_at(3) == _COLON) \
+        & (char_at(6) == _COLON)
+
+    seconds = digit_at(2) * 10 + digit_at(1)
+    minutes = digit_at(5) * 10 + digit_at(4)
+    for d in (digit_at(1), digit_at(2), digit_at(4), digit_at(5)):
+        valid &= (d >= 0) & (d <= 9)
+    valid &= (minutes < 60) & (seconds < 60)
+
+    hours = np.zeros(len(chars), dtype=np.int32)
+    for col in range(max(width - 6, 0)):
+        in_hours = col < hour_digits
+        d = chars[:, col] - _ZERO
+        valid &= ~in_hours | ((d >= 0) & (d <= 9))
+        hours = np.where(in_hours, hours * 10 + d, hours)
+
+    invalid = ~valid & ~blank
+    if invalid.any():
+        raise ValueError('invalid GTFS time ' + repr(values[invalid.argmax()]) + ' found in ' + str(times.name))
+
+    return _seconds_series(hours * 3600 + minutes * 60 + seconds, blank, times)
+
+def _seconds_series(values, missing, like):
+    parsed = pd.arrays.IntegerArray(values.astype(np.int32), missing)
+    return pd.Series(parsed, index=like.index, name=like.name)
+
+def to_military(seconds):
+    # seconds: numeric series of "seconds since zero", possibly with missing values
+    # returns series of 'HH:MM:SS' strings, with NaN where seconds are missing
+
+    secs = pd.Series(seconds).astype('Int64')
+    missing = secs.isna().to_numpy()
+    values = secs.to_numpy(dtype=np.int64, na_value=0)
+
+    hours, seconds_left = np.divmod(values, 3600)
+    minutes, secs_of_minute = np.divmod(seconds_left, 60)
+
+    hour_strings = _TWO_DIGITS[np.clip(hours, 0, 99)]
+    long_hours = hours > 99
+    if long_hours.any():
+        hour_strings[long_hours] = hours[long_hours].astype(str)
+
+    military = hour_strings + ':' + _TWO_DIGITS[minutes] + ':' + _TWO_DIGITS[secs_of_minute]
+    military[missing] = np.nan
+
+    return pd.Series(military, index=secs.index, name=secs.name)
+
+def to_day_numbers(dates):
+    # dates: series or array of GTFS 'YYYYMMDD' date strings
+    # returns int64 array of days since 1970-01-01, so dates can be compared,
+    # offset and turned into days of week with array operations
+
+    # columns repeat a few distinct dates, so only those are parsed
+    codes, unique_dates = pd.factorize(np.asarray(dates, dtype=object).astype(str))
+    parsed = pd.to_datetime(pd.Series(unique_dates).str.strip(), format='%Y%m%d')
+    unique_days = parsed.to_numpy().astype('datetime64[D]').astype(np.int64)
+    return unique_days[codes]
+
+def day_numbers_to_dows(day_numbers):
+    # returns array of day of week positions in DOWS (monday = 0) for day numbers
+    # (1970-01-01 was a thursday)
+    return (np.asarray(day_numbers) + 3) % 7
+
+def day_numbers_to_datestrings(day_numbers):
+    # returns array of GTFS 'YYYYMMDD' date strings for day numbers
+    days = np.asarray(day_numbers, dtype=np.int64).astype('datetime64[D]')
+    return np.char.replace(days.astype(str), '-', '').astype(object)
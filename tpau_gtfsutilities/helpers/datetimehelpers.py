@@ -86,6 +86,20 @@ class GTFSDate:
         self.date = self.date + datetime.timedelta(days=n)
 
 
+def to_date_ranges(dates):
+    # dates: list of 'YYYYMMDD' dates and/or date ranges ({ start, end }), i.e. from config
+    # returns list of date ranges, with a one day range for each date
+    return [date if isinstance(date, dict) else { 'start': date, 'end': date } for date in dates]
+
+def get_dates_in_range(daterange):
+    # returns list of 'YYYYMMDD' dates from daterange start to end (inclusive)
+    current_date = GTFSDate(daterange['start'])
+    dates = []
+    while current_date.before(daterange['end'], inclusive=True):
+        dates.append(current_date.datestring())
+        current_date.add_days(1)
+    return dates
+
 def to_date(gtfs_datestring):
     gtfs_datestring = str(gtfs_datestring)
     year = gtfs_datestring[:4]
@@ -96,10 +110,11 @@ def to_date(gtfs_datestring):
 
 def seconds_to_military(seconds_since_zero):
     # returns military time string from "seconds since zero"
+    # (not a datetime.time, since GTFS times can be past 24:00:00)
 
-    hours, seconds_left = divmod(seconds_since_zero, 3600)
+    hours, seconds_left = divmod(int(seconds_since_zero), 3600)
     minutes, seconds = divmod(seconds_left, 60)
-    return datetime.time(hours, minutes, seconds).strftime('%H:%M:%S')
+    return '%02d:%02d:%02d' % (hours, minutes, seconds)
 
 
 def seconds_since_zero(military):
@@ -1,14 +1,21 @@
 from .gtfsutility import GTFSUtility
 
 from tpau_gtfsutilities.config.utilityoutput import utilityoutput
-from tpau_gtfsutilities.gtfs.methods.filters.date import filter_trips_by_date
-from tpau_gtfsutilities.gtfs.methods.filters.timerange import filter_single_trips_by_timerange
-from tpau_gtfsutilities.gtfs.methods.filters.timerange import filter_repeating_trips_by_timerange
 from tpau_gtfsutilities.gtfs.methods.analysis.averageheadways import calculate_average_headways
-from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
+from tpau_gtfsutilities.helpers.datetimehelpers import to_date_ranges, get_dates_in_range
 
 class AverageHeadway(GTFSUtility):
     name = 'average_headway'
+    tables = {
+        'agency': None,
+        'routes': None,
+        'trips': None,
+        'calendar': None,
+        'calendar_dates': None,
+        'frequencies': None,
+        # only for trip start and end times
+        'stop_times': ['trip_id', 'arrival_time'],
+    }
     
     def run_on_gtfs_singleton(self, settings):
         output_file = 'average_headways.csv'
@@ -18,14 +25,11 @@ class AverageHeadway(GTFSUtility):
             and len(settings['time_ranges']) \
             and 'start' in settings['time_ranges'][0].keys()
 
-        filter_trips_by_date(settings['date'])
-        if not time_ranges_defined:
-            utilityoutput.write_or_append_to_output_csv(calculate_average_headways(settings['date'], None), output_file)
+        # dates and date ranges are all calculated from the same feed, using the trips active on each date
+        if self.dates_defined(settings):
+            dates = [date for daterange in to_date_ranges(settings['dates']) for date in get_dates_in_range(daterange)]
         else:
-            gtfs.update_original_tables() # update after filtering by date for easier processing
-            
-            for timerange in settings['time_ranges']:
-                filter_single_trips_by_timerange(timerange)
-                filter_repeating_trips_by_timerange(timerange)
-                utilityoutput.write_or_append_to_output_csv(calculate_average_headways(settings['date'], timerange), output_file, write_gtfs_filename=True)
-                gtfs.reset_to_original_tables()
+            dates = [settings['date']]
+
+        time_ranges = settings['time_ranges'] if time_ranges_defined else None
+        utilityoutput.write_or_append_to_output_csv(calculate_average_headways(dates, time_ranges), output_file, write_gtfs_filename=bool(time_ranges_defined))
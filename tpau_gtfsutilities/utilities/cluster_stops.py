@@ -1,6 +1,7 @@
 from .gtfsutility import GTFSUtility
 from tpau_gtfsutilities.config.utilityconfig import utilityconfig
 from tpau_gtfsutilities.config.utilityoutput import utilityoutput
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
 from tpau_gtfsutilities.gtfs.gtfscollectionsingleton import gtfs_collection
 from tpau_gtfsutilities.gtfs.gtfsreader import GTFSReader
@@ -13,13 +14,14 @@ from tpau_gtfsutilities.gtfs.methods.filters.subset import subset_entire_feed
 class ClusterStops(GTFSUtility):
     name = 'cluster_stops'
 
-    def run(self, continue_on_error=False):
-        # because this function aggregates results, continue_on_error is unused
+    def run(self, continue_on_error=False, jobs=1):
+        # because this function aggregates results, continue_on_error and jobs are unused
         # and utility is ran collectively on feeds rather than one-by-one
 
         settings = utilityconfig.get_settings()
 
         for feed in settings['gtfs_feeds']:
+            utilityprofile.set_feedname(feed)
             self.load_feed_into_gtfs_singleton(feed)
 
             time_range_defined = 'time_range' in settings.keys() \
@@ -35,6 +37,7 @@ class ClusterStops(GTFSUtility):
             feed_no_extension = feed[:-4]
             gtfs_collection.add_feed(gtfs.copy(), feed_no_extension)
 
+        utilityprofile.set_feedname(None)
         cluster_stops(settings['cluster_radius'])
 
         # reset original data so stop_visits reports with new stops
@@ -43,8 +46,9 @@ class ClusterStops(GTFSUtility):
             gtfsfeed.update_original_tables()
         
         # write stop visits report with clustered stops, ensure column order
+        include_zero_visits = self.setting_enabled(settings, 'include_zero_visits')
         combined_visits_report = gtfs_collection.get_combined_computed_table( \
-            lambda gtfs: calculate_stop_visits(gtfs_override=gtfs) \
+            lambda gtfs: calculate_stop_visits(gtfs_override=gtfs, include_zero_visits=include_zero_visits) \
         )
 
         # order columns for report (ordering is not preserved by get_combined_computed_table)
@@ -55,4 +59,6 @@ class ClusterStops(GTFSUtility):
         gtfs_collection.write_all_feeds()
 
         utilityoutput.write_metadata(settings)
+        if utilityprofile.enabled:
+            utilityoutput.write_profile(utilityprofile.get_profile(self.name))
 
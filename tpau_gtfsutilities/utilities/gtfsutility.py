@@ -1,58 +1,127 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 from tpau_gtfsutilities.config.utilityconfig import utilityconfig
 from tpau_gtfsutilities.config.utilityoutput import utilityoutput
+from tpau_gtfsutilities.config.utilityprofile import utilityprofile
+from tpau_gtfsutilities.config.utilitycache import utilitycache
 from tpau_gtfsutilities.gtfs.gtfssingleton import gtfs
 from tpau_gtfsutilities.gtfs.gtfsreader import GTFSReader
+from tpau_gtfsutilities.gtfs.chunkedtable import get_chunk_rows
 from tpau_gtfsutilities.gtfs.methods.filters import daterange
 from tpau_gtfsutilities.helpers.datetimehelpers import GTFSDateRange
 from tpau_gtfsutilities.helpers.datetimehelpers import GTFSDate
+from tpau_gtfsutilities.helpers.datetimehelpers import to_date_ranges
 
 # Base class for utilities
 class GTFSUtility:
     name = None
     write_feed = False # If set to True, will output feed after utility runs
+    # Tables the utility uses, by tablename: list of columns it needs (None for all), which are
+    # loaded with the feed. Other tables are loaded if used, and written to output feeds unchanged
+    # if not. Columns must be None for utilities that write feeds. If None, all tables are loaded
+    tables = None
+    # Tables the utility can process in chunks of whole trips (i.e. stop_times), which are read
+    # in chunks instead of loaded when a memory budget is set (see ChunkedTable)
+    chunked_tables = []
 
     def run_on_gtfs_singleton(self, settings):
         # Feed-level utility operations
         # In most cases, all utility operations go here
         pass
     
-    def run(self, continue_on_error=False):
+    def run(self, continue_on_error=False, jobs=1):
         # Runs the utilities with the loaded configuration
         # continue_on_error will continue running on rest of feeds if
         #   a common error (ValueError, KeyError, TypeError, FileNotFoundError) is encountered
         #   and is most useful for testing on multiple feeds at once
+        # jobs > 1 runs feeds in that many worker processes (see run_in_parallel)
 
         settings = utilityconfig.get_settings()
 
-        for feed in settings['gtfs_feeds']:
-            print("Processing " + feed + "...")
+        # feed cache directory (optional setting, see utilitycache)
+        if 'cache_dir' in settings.keys() and settings['cache_dir']:
+            utilitycache.set_cache_dir(settings['cache_dir'])
 
-            if continue_on_error:
-                try:
-                    self.load_and_run_on_feed(feed, settings)
-                # catch common errors so utils can continue running on other feeds
-                except (ValueError, KeyError, TypeError, FileNotFoundError, ZeroDivisionError) as e:
-                    print("ERROR: ", e)
-            else:
-                self.load_and_run_on_feed(feed, settings)
+        if jobs > 1 and len(settings['gtfs_feeds']) > 1:
+            self.run_in_parallel(settings, continue_on_error, jobs)
+        else:
+            for feed in settings['gtfs_feeds']:
+                self.run_on_feed(feed, settings, continue_on_error)
 
         utilityoutput.write_metadata(settings)
+        if utilityprofile.enabled:
+            utilityoutput.write_profile(utilityprofile.get_profile(self.name))
+
+    def run_in_parallel(self, settings, continue_on_error, jobs):
+        # Each feed runs in a worker process, which has its own gtfs singleton.
+        # Workers write to their own staging dir, and outputs are merged in feed order
+        # as each finishes, so csv reports are the same as when running one feed at a time
+
+        config_state = utilityconfig.get_state()
+        output_state = utilityoutput.get_state()
+        profile_state = utilityprofile.get_state()
+        cache_state = utilitycache.get_state()
+
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                runs = []
+                for job, feed in enumerate(settings['gtfs_feeds']):
+                    runs.append(executor.submit(run_feed_in_worker, \
+                        self.__class__, feed, settings, continue_on_error, \
+                        config_state, output_state, profile_state, cache_state, utilityoutput.get_staging_dir(job) \
+                    ))
+
+                for job, run in enumerate(runs):
+                    utilityprofile.add_stages(run.result())
+                    utilityoutput.merge_staged_output(utilityoutput.get_staging_dir(job))
+        finally:
+            utilityoutput.remove_staging_dirs()
+
+    def run_on_feed(self, feed, settings, continue_on_error=False):
+        print("Processing " + feed + "...")
+        utilityprofile.set_feedname(feed)
+
+        if continue_on_error:
+            try:
+                with utilityprofile.stage('feed'):
+                    self.load_and_run_on_feed(feed, settings)
+            # catch common errors so utils can continue running on other feeds
+            except (ValueError, KeyError, TypeError, FileNotFoundError, ZeroDivisionError) as e:
+                print("ERROR: ", e)
+        else:
+            with utilityprofile.stage('feed'):
+                self.load_and_run_on_feed(feed, settings)
 
     def load_and_run_on_feed(self, feed, settings):
-        self.load_feed_into_gtfs_singleton(feed)
-        self.warn_if_any_input_dates_outside_gtfs_singleton_bounds(settings)
-        self.configure_output(feed)
-        self.run_on_gtfs_singleton(settings)
-        if self.write_feed:
-            feed_no_extension = feed[:-4]
-            gtfs.write_feed(feed_no_extension)
+        try:
+            self.load_feed_into_gtfs_singleton(feed)
+            self.warn_if_any_input_dates_outside_gtfs_singleton_bounds(settings)
+            self.configure_output(feed)
+            self.run_on_gtfs_singleton(settings)
+            if self.write_feed:
+                feed_no_extension = feed[:-4]
+                gtfs.write_feed(feed_no_extension)
+        finally:
+            gtfs.close_chunked_tables()
 
     def load_feed_into_gtfs_singleton(self, feed):
-        # loads feed from config into singleton to be used by util
+        # loads feed from config into singleton to be used by util. Tables are loaded from the
+        # feed cache if runs on the feed have read them before, and cached once read (see utilitycache)
         gtfsreader = GTFSReader(feed)
-        gtfs.load_feed(gtfsreader)
+
+        cache = None
+        if utilitycache.is_available():
+            with utilityprofile.stage('hash_feed'):
+                cache = utilitycache.get_feed_entry(gtfsreader.get_path())
+
+        # chunked tables are read from the zip each time (other tables are still cached)
+        memory_budget = utilityconfig.get_memory_budget()
+        if memory_budget and len(self.chunked_tables):
+            gtfs.load_feed(gtfsreader, tables=self.tables, cache=cache, \
+                chunked_tables=self.chunked_tables, chunk_rows=get_chunk_rows(memory_budget))
+        else:
+            gtfs.load_feed(gtfsreader, tables=self.tables, cache=cache)
         gtfs.preprocess()
 
     def configure_output(self, feed):
@@ -93,7 +162,26 @@ class GTFSUtility:
             print("     Input daterange: (" + input_dr.start.datestring() + ", " + input_dr.end.datestring() + ")")
             print("     Feed start/end (as found in feed_info.txt) : (" + feed_dr.start.datestring() + ", " + feed_dr.end.datestring() + ")")
 
+    def dates_defined(self, settings):
+        # True if settings has a list of dates and/or date ranges to run on (see to_date_ranges),
+        # instead of a single date or date_range
+        return 'dates' in settings.keys() \
+            and isinstance(settings['dates'], list) \
+            and len(settings['dates']) > 0
+
+    def setting_enabled(self, settings, setting):
+        # True if an optional true/false setting is set to true (values are read as strings)
+        return setting in settings.keys() \
+            and str(settings[setting]).lower() in ['true', 'yes']
+
     def warn_if_any_input_dates_outside_gtfs_singleton_bounds(self, settings):
+        if self.dates_defined(settings):
+            for input_range in to_date_ranges(settings['dates']):
+                input_dr = GTFSDateRange(input_range['start'], input_range['end'])
+                self.warn_if_daterange_not_within_gtfs_calendar_bounds(input_dr)
+                self.warn_if_daterange_not_within_feed_bounds(input_dr)
+            return
+
         if 'date_range' in settings:
             input_dr = GTFSDateRange(settings['date_range']['start'], settings['date_range']['end'])
             self.warn_if_daterange_not_within_gtfs_calendar_bounds(input_dr)
@@ -102,4 +190,19 @@ class GTFSUtility:
         if 'date' in settings:
             input_date = GTFSDate(settings['date'])
             self.warn_if_date_not_within_gtfs_calendar_bounds(input_date)
-            self.warn_if_date_not_within_feed_bounds(input_date)
\ No newline at end of file
+            self.warn_if_date_not_within_feed_bounds(input_date)
+
+
+def run_feed_in_worker(utility_class, feed, settings, continue_on_error, config_state, output_state, profile_state, cache_state, staging_dir):
+    # runs a utility on a single feed in a worker process. Config, output, profile and cache settings
+    # are restored first, since workers may not inherit them from the main process.
+    # returns the profile stages recorded for the feed
+    utilityconfig.set_state(config_state)
+    utilityoutput.set_state(output_state)
+    utilityprofile.set_state(profile_state)
+    utilitycache.set_state(cache_state)
+    utilityoutput.set_staging_dir(staging_dir)
+    os.makedirs(staging_dir)
+
+    utility_class().run_on_feed(feed, settings, continue_on_error)
+    return utilityprofile.stages
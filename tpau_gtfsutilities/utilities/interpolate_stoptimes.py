@@ -1,12 +1,16 @@
-import geopandas as gpd
-
 from .gtfsutility import GTFSUtility
 from tpau_gtfsutilities.gtfs.methods.edit.interpolation import interpolate_stop_times
 
 class InterpolateStoptimes(GTFSUtility):
     name = 'interpolate_stoptimes'
     write_feed = True
+    tables = {
+        'stop_times': None,
+        'stops': None,
+    }
+    chunked_tables = ['stop_times']
 
     def run_on_gtfs_singleton(self, settings):
-        if not interpolate_stop_times():
-            print("Cannot interpolate stop times -- feed needs to have shapes.txt and needs to use shape_dist_traveled in stop_times.txt")
+        distance_fallback = settings['distance_fallback'] if 'distance_fallback' in settings.keys() else None
+        if not interpolate_stop_times(distance_fallback=distance_fallback or None):
+            print("Cannot interpolate stop times -- feed needs to have shapes.txt and needs to use shape_dist_traveled in stop_times.txt, or distance_fallback must be set")
@@ -5,6 +5,19 @@ from tpau_gtfsutilities.gtfs.methods.filters.subset import subset_entire_feed
 class OneDay(GTFSUtility):
     name = 'one_day'
     write_feed = True
+    tables = {
+        'agency': None,
+        'stops': None,
+        'routes': None,
+        'trips': None,
+        'stop_times': None,
+        'calendar': None,
+        'calendar_dates': None,
+        'frequencies': None,
+        'board_alight': None,
+        'feed_info': None,
+    }
+    chunked_tables = ['stop_times']
 
     def run_on_gtfs_singleton(self, settings):
         remove_exception_calendars()
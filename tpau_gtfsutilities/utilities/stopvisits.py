@@ -1,5 +1,4 @@
 import geopandas as gpd
-from shapely.geometry import MultiPolygon
 
 from .gtfsutility import GTFSUtility
 from tpau_gtfsutilities.config.utilityconfig import utilityconfig
@@ -7,19 +6,35 @@ from tpau_gtfsutilities.config.utilityoutput import utilityoutput
 
 from tpau_gtfsutilities.gtfs.methods.edit.calendars import remove_exception_calendars
 from tpau_gtfsutilities.gtfs.methods.filters.subset import subset_entire_feed
-from tpau_gtfsutilities.gtfs.methods.filters.polygon import filter_stops_by_multipolygon
+from tpau_gtfsutilities.gtfs.methods.filters.polygon import filter_stops_by_regions
 from tpau_gtfsutilities.gtfs.methods.analysis.stopvisits import calculate_stop_visits
+from tpau_gtfsutilities.helpers.datetimehelpers import to_date_ranges
 
 class StopVisits(GTFSUtility):
     name = 'stop_visits'
+    tables = {
+        'agency': None,
+        'routes': None,
+        'trips': None,
+        'calendar': None,
+        'calendar_dates': None,
+        'frequencies': None,
+        'board_alight': None,
+        'stops': ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+        'stop_times': ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time'],
+    }
+    chunked_tables = ['stop_times']
 
-    def read_multipolygon_from_file(self, filepath):
+    def read_regions_from_file(self, filepath, label_column=None):
         # Input: path to either shapefile or geojson
-        # returns a multipolygon so both polygon and multipolygon
-        # inputs can be read
+        # returns a GeoSeries with a (multi)polygon for each feature in the file,
+        # labeled by label_column if provided (otherwise by feature number)
 
         gdf = gpd.read_file(filepath).to_crs(epsg=4326)
-        return MultiPolygon(gdf.geometry.iloc[0])
+        regions = gdf.geometry
+        if label_column:
+            regions.index = gdf[label_column].astype(str)
+        return regions
 
     def run_on_gtfs_singleton(self, settings):
         time_range_defined = 'time_range' in settings.keys() \
@@ -27,19 +42,38 @@ class StopVisits(GTFSUtility):
             and 'start' in settings['time_range'].keys() \
             and 'end' in settings['time_range'].keys()
     
+        # with a list of dates and/or date ranges, the feed is subset once to the dates they span,
+        # and visits within each are counted from the same feed (with start_date and end_date columns)
+        if self.dates_defined(settings):
+            date_ranges = to_date_ranges(settings['dates'])
+            feed_daterange = {
+                'start': min(date_range['start'] for date_range in date_ranges),
+                'end': max(date_range['end'] for date_range in date_ranges)
+            }
+        else:
+            date_ranges = None
+            feed_daterange = settings['date_range']
+
         if time_range_defined:
-            subset_entire_feed(settings['date_range'], settings['time_range'], trim_trips=True)
+            subset_entire_feed(feed_daterange, settings['time_range'], trim_trips=True)
         else:
-            subset_entire_feed(settings['date_range'])
+            subset_entire_feed(feed_daterange)
 
         polygon_file = settings['polygon']
+        stop_regions = None
         
         if (polygon_file):
             polygon_file_path = utilityconfig.get_input_file_path(polygon_file)
-            multipolygon = self.read_multipolygon_from_file(polygon_file_path)
-            filter_stops_by_multipolygon(multipolygon)
+            label_column = settings['polygon_label'] if 'polygon_label' in settings.keys() else None
+            regions = self.read_regions_from_file(polygon_file_path, label_column=label_column)
+            stop_regions = filter_stops_by_regions(regions)
+
+        include_zero_visits = self.setting_enabled(settings, 'include_zero_visits')
+        stop_visits_report = calculate_stop_visits(date_ranges=date_ranges, include_zero_visits=include_zero_visits)
 
-        stop_visits_report = calculate_stop_visits()
+        # label stops by region when there is more than one (stops outside all regions are left blank)
+        if stop_regions is not None and len(regions) > 1:
+            stop_visits_report['region'] = stop_visits_report['stop_id'].map(stop_regions)
         if time_range_defined:
             stop_visits_report['start_time'] = settings['time_range']['start']
             stop_visits_report['end_time'] = settings['time_range']['end']